@@ -1,11 +1,15 @@
 from contextlib import contextmanager
 import datetime
+import time
 
 from sqlalchemy import (
     Column, DateTime, Integer, DDL
 )
 from sqlalchemy.engine.base import Engine
 import sqlalchemy
+# get_session's annotation needs it when the class is defined, so
+# scripts that import this module first don't fail on startup
+import sqlalchemy.orm
 
 
 def pkey(id_str, dtype=Integer):
@@ -21,24 +25,171 @@ def datetime_col(colname):
         colname,
         DateTime,
         nullable=False,
-        default="now()",
+        # a python default rather than "now()", which only postgres
+        # understands
+        default=datetime.datetime.now,
     )
 
 
+def sqlite_engine(filepath, schema_name):
+    """an engine for a sqlite file that stands in for the postgres
+    schema `schema_name`, e.g. for tests and benchmarks. the file is
+    attached under that name on every connection, so tables of the
+    schema live in it.
+    """
+    engine = sqlalchemy.create_engine('sqlite://')
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def attach(dbapi_conn, connection_record):
+        dbapi_conn.execute("ATTACH DATABASE '{}' AS {}".format(
+            filepath.replace("'", "''"), schema_name,
+        ))
+    return engine
+
+
 def create_tables(engine, SABase, schema_name):
-    engine.execute(DDL('CREATE SCHEMA IF NOT EXISTS {schema}'.format(
-        schema=schema_name,
-    )))
+    # sqlite has no schemas; see sqlite_engine()
+    if engine.dialect.name != 'sqlite':
+        engine.execute(DDL('CREATE SCHEMA IF NOT EXISTS {schema}'.format(
+            schema=schema_name,
+        )))
     SABase.metadata.create_all()
+    add_missing_columns(engine, SABase)
+    add_missing_indexes(engine, SABase)
+
+
+def add_missing_columns(engine, SABase):
+    """create_all() only creates missing tables, so columns that were
+    added to a model after its table was created are added here
+    """
+    inspector = sqlalchemy.inspect(engine)
+    for table in SABase.metadata.sorted_tables:
+        existing = set(
+            col['name']
+            for col in inspector.get_columns(table.name, schema=table.schema)
+        )
+        for col in table.columns:
+            if col.name in existing:
+                continue
+            engine.execute(DDL('ALTER TABLE {table} ADD COLUMN {col} {type}'.format(
+                table=table.fullname,
+                col=col.name,
+                type=col.type.compile(engine.dialect),
+            )))
+
+
+def add_missing_indexes(engine, SABase):
+    """like add_missing_columns, for indexes
+    """
+    for table in SABase.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 
 def drop_tables(SABase):
     SABase.metadata.drop_all()
 
+class WriteBuffer:
+    """Write-behind buffer for new rows
+
+    Rows passed to add() are inserted with one multi-row INSERT per
+    table once `batch_size` of them have accumulated or
+    `flush_interval_seconds` have passed, and the session is committed
+    right after. Everything else that is pending in the session is
+    committed with them, so a killed run loses at most the rows since
+    the last flush. Inserts aren't deduplicated by the database: callers
+    check find() and the table before adding a row.
+
+    Buffered rows are never added to the session, so they don't get
+    their primary key; use find() to look them up by their keys.
+
+    With `metrics` (see download_newsletter_archives/metrics.py), the
+    duration and size of every flush are recorded.
+    """
+    def __init__(self, sess, batch_size=100, flush_interval_seconds=30, metrics=None):
+        self.sess = sess
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.rows = list()
+        self.keys = dict()
+        self.last_flush = time.time()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row, keys=()):
+        """`keys` are values that find() should find the row by
+        """
+        self.rows.append(row)
+        for key in keys:
+            if key is not None:
+                self.keys.setdefault((row.__class__, key), row)
+        self.maybe_flush()
+
+    def find(self, cls, key):
+        return self.keys.get((cls, key))
+
+    def maybe_flush(self):
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        elif time.time() - self.last_flush >= self.flush_interval_seconds:
+            self.flush()
+
+    @staticmethod
+    def row_to_dict(row):
+        table = row.__table__
+        values = dict()
+        for attr in sqlalchemy.inspect(row.__class__).column_attrs:
+            col = attr.columns[0]
+            value = getattr(row, attr.key)
+            if value is None and col.default is not None:
+                if col.default.is_callable:
+                    value = col.default.arg(None)
+                elif col.default.is_scalar:
+                    value = col.default.arg
+            if value is None and col.primary_key:
+                continue
+            values[col.name] = value
+        return table, values
+
+    def _insert_statements(self, table, rows):
+        chunk_size = len(rows)
+        if self.sess.bind.dialect.name == 'sqlite':
+            # sqlite limits the number of bound parameters
+            chunk_size = max(1, 999 // len(rows[0]))
+        for start in range(0, len(rows), chunk_size):
+            yield table.insert().values(rows[start:start+chunk_size])
+
+    def flush(self):
+        start = time.perf_counter()
+        num_rows = len(self.rows)
+        # rows are inserted table by table, in the order each
+        # table's first row was added
+        tables = dict()
+        for row in self.rows:
+            table, values = self.row_to_dict(row)
+            tables.setdefault(table, list()).append(values)
+        # flush the session first: buffered rows may reference rows
+        # that were only added to the session
+        self.sess.flush()
+        for table, rows in tables.items():
+            for statement in self._insert_statements(table, rows):
+                self.sess.execute(statement)
+        self.sess.commit()
+        self.rows = list()
+        self.keys = dict()
+        self.last_flush = time.time()
+        if self.metrics is not None:
+            self.metrics.observe('db_flush_seconds', time.perf_counter() - start)
+            self.metrics.inc('db_rows_flushed', num_rows)
+
+
 class Base:
     created_at = datetime_col('created_at')
     modified_at = datetime_col('modified_at')
     Session = None
+    write_buffer = None
 
     def __init__(self, time=None):
         if time is None:
@@ -70,10 +221,25 @@ class Base:
         # has its id field populated so its id can be
         # referenced
         sess.add(row)
-        sess.commit()
+        cls.commit(sess)
 
         return row
 
+    @classmethod
+    def set_write_buffer(cls, write_buffer):
+        cls.write_buffer = write_buffer
+
+    @classmethod
+    def commit(cls, sess):
+        """Commit, or when a WriteBuffer is in use, only flush so that
+        ids get populated and leave the commit to the buffer
+        """
+        if cls.write_buffer is None:
+            sess.commit()
+        else:
+            sess.flush()
+            cls.write_buffer.maybe_flush()
+
     Session = None
     @classmethod
     def set_sess(cls, session_or_engine):
@@ -0,0 +1,166 @@
+"""Concurrent fetching for the newsletter archive downloader
+
+The sequential crawler spends nearly all of its time waiting on the
+network, so this module issues the requests from an asyncio event
+loop with at most `concurrency` of them in flight at once.
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from chromatic_news.download_newsletter_archives.download_limits import BodyReader, DownloadLimits
+from chromatic_news.download_newsletter_archives.fetcher import FetchedResponse
+from chromatic_news.download_newsletter_archives.metrics import Metrics
+
+
+class AsyncFetcher:
+    """Bounded pool of concurrent GET requests
+
+    `counter` is incremented the same way the sequential
+    requests.get wrapper does it, so --requests-limit counts requests
+    made through either path. `on_response(url, resp)` is called for
+    every response that was received.
+
+    When a politeness.DomainScheduler is given, every request first
+    waits for a slot on its domain, and 429/503 responses are retried
+    up to `max_retries` times once the domain's backoff has passed.
+
+    With an http_cache.HttpCache, requests are sent as conditional
+    requests when the url is cached, and 304s are answered from it.
+
+    Requests are recorded in `metrics`, and bodies read as far as
+    `limits` allow, like fetcher.Fetcher does.
+    """
+    def __init__(self, concurrency, timeout_seconds=10, counter=None,
+                 requests_limit=None, on_response=None,
+                 failed_response=None, scheduler=None, max_retries=3,
+                 http_cache=None, metrics=None, limits=None):
+        self.concurrency = concurrency
+        self.limits = limits if limits is not None else DownloadLimits()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.http_cache = http_cache
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.timeout_seconds = timeout_seconds
+        self.counter = counter
+        self.requests_limit = requests_limit
+        self.on_response = on_response
+        self.failed_response = failed_response
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    @property
+    def limit_reached(self):
+        if not self.requests_limit or self.counter is None:
+            return False
+        return self.counter.requests_total >= self.requests_limit
+
+    async def fetch(self, url, headers=None):
+        if self.scheduler is None:
+            return await self._fetch_in_pool(url, headers)
+
+        for attempt in range(self.max_retries + 1):
+            # the domain slot is acquired before the pool slot, so
+            # that requests waiting on a busy or backed off domain
+            # don't hold up requests to other domains
+            async with self.scheduler.slot(url):
+                resp = await self._fetch_in_pool(url, headers)
+            if resp is self.failed_response:
+                return resp
+            retry_delay = self.scheduler.record_response(
+                url, resp.status_code, resp.headers,
+            )
+            if retry_delay is None:
+                break
+            if attempt < self.max_retries:
+                logging.info("'{}' returned {}; retrying in {:.1f} seconds".format(
+                    url, resp.status_code, retry_delay,
+                ))
+        return resp
+
+    async def _fetch_in_pool(self, url, headers=None):
+        async with self.semaphore:
+            # checked again after waiting for a slot, because other
+            # requests may have used up the limit in the meantime
+            if self.limit_reached:
+                return self.failed_response
+            return await self._fetch(url, headers)
+
+    async def _fetch(self, url, headers=None):
+        logging.info('requesting {}'.format(url))
+        start = time.time()
+        if self.counter is not None:
+            self.counter.requests_total += 1
+        if self.http_cache is not None:
+            headers = self.http_cache.request_headers(url, headers)
+        try:
+            async with self.session.get(url, headers=headers) as aresp:
+                resp = await self._read(aresp)
+        except asyncio.TimeoutError:
+            self.metrics.record_fetch(url, time.time() - start, error='timeout')
+            logging.info("requesting '{}' took longer than the {} timeout seconds".format(url, self.timeout_seconds))
+            return self.failed_response
+        except (aiohttp.ClientError, ValueError) as e:
+            # ValueError covers urls that aiohttp refuses to request
+            self.metrics.record_fetch(url, time.time() - start, error='connection')
+            print(type(e), e)
+            return self.failed_response
+        if self.counter is not None:
+            self.counter.requests_successful += 1
+        self.metrics.record_fetch(url, time.time() - start, resp)
+        if self.http_cache is not None:
+            resp = self.http_cache.handle_response(url, resp)
+        else:
+            resp.not_modified = resp.status_code == 304
+
+        if self.on_response is not None:
+            self.on_response(url, resp)
+
+        logging.info("requesting '{}' took {:.2f} seconds".format(
+            url, time.time() - start
+        ))
+        return resp
+
+    async def _read(self, aresp):
+        """like fetcher.read_response; leaving the `async with` of
+        `aresp` drops the connection if the body wasn't read to the end
+        """
+        rejected = self.limits.check_headers(aresp.headers)
+        content = b''
+        if rejected is None:
+            reader = BodyReader(self.limits, aresp.headers.get('Content-Type'))
+            try:
+                async for chunk in aresp.content.iter_chunked(64 * 1024):
+                    if not reader.feed(chunk):
+                        break
+            except BaseException:
+                # e.g. the connection broke off, or the request timed out
+                reader.discard()
+                raise
+            rejected = reader.rejected
+            content = reader.finish()
+        if rejected is not None:
+            logging.info("not downloading '{}': {}".format(aresp.url, rejected))
+        return FetchedResponse(
+            str(aresp.url), aresp.status, aresp.headers, content, rejected=rejected,
+        )
+
+    async def fetch_all(self, urls):
+        """Fetch all urls concurrently and return {url: response}
+        """
+        urls = list(urls)
+        responses = await asyncio.gather(*[self.fetch(url) for url in urls])
+        return dict(zip(urls, responses))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Run the downloader end to end against a local fixture server
+
+Starts a benchmark_fixture.FixtureServer, points
+download_newsletter_archives.py at it with a fresh sqlite database (or
+a local postgres) and reports requests, articles and megabytes per
+second, from the --metrics-file of each run. Arguments after `--` are
+passed on to the downloader, so configurations can be compared:
+
+    python benchmark_crawl.py --json before.json
+    python benchmark_crawl.py --compare before.json -- --concurrency 16
+    python benchmark_crawl.py --db postgresql://localhost/scratch --reset-db
+
+Every run starts from an empty database. With postgres, that means the
+chromatic schema is dropped before each run, so only point --db at a
+scratch database, and pass --reset-db to confirm.
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+import json
+import statistics
+import subprocess
+import tempfile
+import time
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.download_newsletter_archives.benchmark_fixture import (
+    FixtureConfig, FixtureServer, compare_results, save_results,
+)
+
+
+def reset_postgres(url):
+    import sqlalchemy
+    engine = sqlalchemy.create_engine(url)
+    engine.execute('DROP SCHEMA IF EXISTS chromatic CASCADE')
+    engine.dispose()
+
+
+def counter_total(metrics, name):
+    return sum(series['value'] for series in metrics['counters'].get(name, []))
+
+
+def crawl_once(server, db_url, crawler_args, workdir):
+    archive_urls_file = os.path.join(workdir, 'newsletter_archive_urls.txt')
+    with open(archive_urls_file, 'w') as fw:
+        fw.write('\n'.join(server.archive_urls()) + '\n')
+    ignore_domains_file = os.path.join(workdir, 'ignore_domains.txt')
+    with open(ignore_domains_file, 'w') as fw:
+        fw.write('twitter.com\nfacebook.com\n')
+    metrics_file = os.path.join(workdir, 'metrics.json')
+
+    command = [
+        sys.executable, os.path.join(this_dir, 'download_newsletter_archives.py'),
+        '--db', db_url,
+        '--newsletter-archive-urls', archive_urls_file,
+        '--ignore-domains', ignore_domains_file,
+        '--articles-per-archive', '0',
+        '--progress-seconds', '0',
+        '--metrics-file', metrics_file,
+        '--no-url-index',
+    ] + crawler_args
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+
+    with open(metrics_file) as fr:
+        metrics = json.load(fr)
+    requests = counter_total(metrics, 'fetch_responses')
+    articles = counter_total(metrics, 'articles_stored')
+    megabytes = counter_total(metrics, 'fetch_bytes') / 1024 / 1024
+    return {
+        'seconds': seconds,
+        'requests': requests,
+        'articles': articles,
+        'requests_per_second': requests / seconds,
+        'articles_per_second': articles / seconds,
+        'megabytes_per_second': megabytes / seconds,
+    }
+
+
+def run_main():
+    args = parse_cl_args()
+    config = FixtureConfig.from_args(args)
+    if args.db and not args.db.startswith('sqlite') and not args.reset_db:
+        print('benchmarking postgres drops its chromatic schema before every run;\n'
+              'pass --reset-db if {} is a scratch database'.format(args.db))
+        exit(1)
+
+    runs = list()
+    with FixtureServer(config) as server:
+        for run in range(args.runs):
+            with tempfile.TemporaryDirectory() as workdir:
+                db_url = args.db or 'sqlite:///' + os.path.join(workdir, 'chromatic.db')
+                if args.reset_db:
+                    reset_postgres(db_url)
+                result = crawl_once(server, db_url, args.crawler_args, workdir)
+            runs.append(result)
+            print('run {}: {:.2f}s, {} requests, {} articles'.format(
+                run + 1, result['seconds'], result['requests'], result['articles'],
+            ))
+
+    name = 'crawl {}'.format(' '.join(args.crawler_args) or 'default').strip()
+    # the median run, so that one slow run doesn't skew the comparison
+    results = {name: {
+        measurement: statistics.median(run[measurement] for run in runs)
+        for measurement in runs[0]
+    }}
+    print('{}: {requests_per_second:.1f} requests/s, {articles_per_second:.1f} articles/s, '
+          '{megabytes_per_second:.2f} MB/s (median of {runs} runs of {num_articles} articles, '
+          '{latency_ms} ms latency)'.format(
+              name, runs=args.runs, num_articles=config.num_articles,
+              latency_ms=config.latency_ms, **results[name]))
+    if args.json:
+        save_results(results, args.json)
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='benchmark the downloader against a local fixture server',
+    )
+    argParser.add_argument(
+        '--db', default=None, metavar='URL',
+        help='default: a fresh sqlite file per run',
+    )
+    argParser.add_argument('--reset-db', default=False, action='store_true')
+    argParser.add_argument('--runs', default=3, type=int)
+    argParser.add_argument('--json', default=None, metavar='FILE', help='save the results')
+    argParser.add_argument(
+        '--compare', default=None, metavar='FILE',
+        help='compare with results saved with --json',
+    )
+    FixtureConfig.add_arguments(argParser)
+    argParser.add_argument('crawler_args', nargs='*', help='arguments after -- go to the downloader')
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Synthetic crawl for the benchmarks
+
+FixtureServer serves archives, newsletters, html articles and pdfs
+over http on localhost, with a configurable latency and page sizes,
+so that benchmark_crawl.py can run the whole downloader without the
+network. Pages are generated from a seed, so every run sees the same
+crawl. The page generators are used by benchmark_functions.py too.
+
+Results of both benchmarks are dicts of
+{benchmark name: {measurement: number}}; save_results() and
+compare_results() keep them in json files so that commits can be
+compared.
+
+usage:
+    python benchmark_fixture.py --port 8765 --latency-ms 50
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+words = (
+    'the of and to in is that for it as was with be by on not he this are or '
+    'his from at which but have an they you were her she there been one all '
+    'research study science climate energy policy market data model health '
+    'city water school court price report growth network system design'
+).split()
+
+
+class FixtureConfig:
+    """the shape of the synthetic crawl
+    """
+    def __init__(self, archives=2, newsletters_per_archive=10,
+                 articles_per_newsletter=20, article_paragraphs=30,
+                 pdf_every=10, pdf_pages=3, latency_ms=20, seed=0):
+        self.archives = archives
+        self.newsletters_per_archive = newsletters_per_archive
+        self.articles_per_newsletter = articles_per_newsletter
+        self.article_paragraphs = article_paragraphs
+        # every pdf_every-th article is a pdf; 0 for none
+        self.pdf_every = pdf_every
+        self.pdf_pages = pdf_pages
+        self.latency_ms = latency_ms
+        self.seed = seed
+
+    @classmethod
+    def add_arguments(cls, argParser):
+        defaults = cls()
+        for name in vars(defaults):
+            argParser.add_argument(
+                '--' + name.replace('_', '-'),
+                default=getattr(defaults, name), type=int,
+            )
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(**{name: getattr(args, name) for name in vars(cls())})
+
+    @property
+    def num_articles(self):
+        return self.archives * self.newsletters_per_archive * self.articles_per_newsletter
+
+
+def _random(config, *key):
+    seed = hashlib.md5(repr((config.seed,) + key).encode()).hexdigest()
+    return random.Random(seed)
+
+
+def sentence(rng, num_words=14):
+    text = ' '.join(rng.choice(words) for _ in range(num_words))
+    return text.capitalize() + '.'
+
+
+def paragraph(rng, num_sentences=5):
+    return ' '.join(sentence(rng) for _ in range(num_sentences))
+
+
+def archive_html(config, base_url, archive):
+    links = ''.join(
+        '<li><a href="{}/newsletter/{}/{}">Issue {}</a></li>'.format(base_url, archive, n, n)
+        for n in range(config.newsletters_per_archive)
+    )
+    return '<html><head><title>Archive {}</title></head><body><ul>{}</ul></body></html>'.format(
+        archive, links,
+    )
+
+
+def article_path(config, archive, newsletter, article):
+    if config.pdf_every and article % config.pdf_every == config.pdf_every - 1:
+        return '/pdf/{}/{}/{}.pdf'.format(archive, newsletter, article)
+    return '/article/{}/{}/{}'.format(archive, newsletter, article)
+
+
+def newsletter_html(config, base_url, archive, newsletter):
+    """an issue, with the links that a real one has besides the
+    articles: tracking parameters, images, mailto, social media
+    """
+    rng = _random(config, 'newsletter', archive, newsletter)
+    parts = ['<html><head><title>Issue {}</title></head><body><table>'.format(newsletter)]
+    for article in range(config.articles_per_newsletter):
+        url = base_url + article_path(config, archive, newsletter, article)
+        parts.append(
+            '<tr><td><p>{text}</p>'
+            '<a href="{url}?utm_source=newsletter&amp;utm_medium=email">{title}</a>'
+            ' <a href="{url}?mc_cid=abc#top">read more</a>'
+            '<img src="{base_url}/img/{article}.png"></td></tr>'.format(
+                text=sentence(rng), url=url, title=sentence(rng, 6),
+                base_url=base_url, article=article,
+            )
+        )
+    parts.append(
+        '<tr><td><a href="{0}/img/logo.png">logo</a>'
+        ' <a href="mailto:editor@example.com">contact</a>'
+        ' <a href="https://twitter.com/share?u=x">share</a>'
+        ' <a href="https://www.facebook.com/sharer">share</a>'
+        ' <a href="{0}/media/podcast.mp3">listen</a></td></tr>'.format(base_url)
+    )
+    parts.append('</table></body></html>')
+    return ''.join(parts)
+
+
+def article_html(config, archive, newsletter, article):
+    rng = _random(config, 'article', archive, newsletter, article)
+    title = sentence(rng, 8)
+    body = ''.join(
+        '<p>{}</p>'.format(paragraph(rng))
+        for _ in range(config.article_paragraphs)
+    )
+    return (
+        '<html><head><title>{title}</title><meta name="author" content="A. Writer"></head>'
+        '<body><nav><a href="/">home</a></nav><article><h1>{title}</h1>{body}</article>'
+        '<footer>copyright</footer></body></html>'
+    ).format(title=title, body=body)
+
+
+def _pdf_string(text):
+    return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+def make_pdf(pages):
+    """a minimal pdf with one Helvetica text stream per page;
+    `pages` is a list of lists of lines
+    """
+    objects = list()
+    num_pages = len(pages)
+    # 1 catalog, 2 pages, 3 font, then a page and a content object per page
+    objects.append('<< /Type /Catalog /Pages 2 0 R >>')
+    kids = ' '.join('{} 0 R'.format(4 + 2 * i) for i in range(num_pages))
+    objects.append('<< /Type /Pages /Kids [{}] /Count {} >>'.format(kids, num_pages))
+    objects.append('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    for i, lines in enumerate(pages):
+        objects.append(
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            '/Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>'.format(5 + 2 * i)
+        )
+        stream = 'BT /F1 10 Tf 12 TL 50 750 Td ' + ' '.join(
+            '{} Tj T*'.format(_pdf_string(line)) for line in lines
+        ) + ' ET'
+        objects.append('<< /Length {} >>\nstream\n{}\nendstream'.format(len(stream), stream))
+
+    out = b'%PDF-1.4\n'
+    offsets = list()
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += '{} 0 obj\n{}\nendobj\n'.format(number, obj).encode('latin-1')
+    xref = len(out)
+    out += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1).encode()
+    for offset in offsets:
+        out += '{:010d} 00000 n \n'.format(offset).encode()
+    out += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(
+        len(objects) + 1, xref,
+    ).encode()
+    return out
+
+
+def article_pdf(config, archive, newsletter, article):
+    rng = _random(config, 'pdf', archive, newsletter, article)
+    return make_pdf([
+        [sentence(rng, 12) for _ in range(50)]
+        for _ in range(config.pdf_pages)
+    ])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.config.latency_ms:
+            time.sleep(server.config.latency_ms / 1000)
+        with server.lock:
+            server.requests += 1
+        found = server.page(self.path.split('?')[0])
+        if found is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body, content_type = found
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """serves the crawl described by a FixtureConfig on localhost, in a
+    background thread
+
+    usage:
+        with FixtureServer(FixtureConfig(latency_ms=50)) as server:
+            urls = server.archive_urls()
+    """
+    daemon_threads = True
+
+    def __init__(self, config, port=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.config = config
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.pages = dict()
+        self.thread = None
+
+    def archive_urls(self):
+        return [
+            '{}/archive/{}'.format(self.base_url, archive)
+            for archive in range(self.config.archives)
+        ]
+
+    def page(self, path):
+        """(body, content type) of `path`, or None"""
+        with self.lock:
+            if path in self.pages:
+                return self.pages[path]
+        parts = path.strip('/').split('/')
+        try:
+            kind, numbers = parts[0], [int(part.split('.')[0]) for part in parts[1:]]
+            if kind == 'archive' and len(numbers) == 1:
+                found = archive_html(self.config, self.base_url, *numbers).encode(), 'text/html; charset=utf-8'
+            elif kind == 'newsletter' and len(numbers) == 2:
+                found = newsletter_html(self.config, self.base_url, *numbers).encode(), 'text/html; charset=utf-8'
+            elif kind == 'article' and len(numbers) == 3:
+                found = article_html(self.config, *numbers).encode(), 'text/html; charset=utf-8'
+            elif kind == 'pdf' and len(numbers) == 3:
+                found = article_pdf(self.config, *numbers), 'application/pdf'
+            else:
+                return None
+        except (ValueError, IndexError):
+            return None
+        with self.lock:
+            self.pages[path] = found
+        return found
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def save_results(results, filepath):
+    with open(filepath, 'w') as fw:
+        json.dump(results, fw, indent=2, sort_keys=True)
+
+
+def compare_results(results, filepath):
+    """print every measurement next to the one in `filepath`, from an
+    earlier commit
+    """
+    with open(filepath) as fr:
+        baseline = json.load(fr)
+    for name, measurements in sorted(results.items()):
+        for measurement, value in sorted(measurements.items()):
+            old = baseline.get(name, dict()).get(measurement)
+            if not old:
+                continue
+            print('{:<40} {:<16} {:>12.2f} -> {:>12.2f}  {:+6.1f}%'.format(
+                name, measurement, old, value, 100 * (value - old) / old,
+            ))
+
+
+def run_main():
+    args = parse_cl_args()
+    config = FixtureConfig.from_args(args)
+    with FixtureServer(config, port=args.port) as server:
+        for url in server.archive_urls():
+            print(url)
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(description='serve a synthetic crawl')
+    argParser.add_argument('--port', default=8765, type=int)
+    FixtureConfig.add_arguments(argParser)
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
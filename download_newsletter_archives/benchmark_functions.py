@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Microbenchmarks of the downloader's per-page functions
+
+Times clean_urls, filter_urls_by_ignore_domains, filter_out_image_urls,
+Newsletter.extract_article_urls and pdf_bytes_to_content_string on the
+synthetic pages of benchmark_fixture.py, and prints their throughput.
+
+usage:
+    python benchmark_functions.py --json before.json
+    # ... change something ...
+    python benchmark_functions.py --compare before.json
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+import time
+import types
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.download_newsletter_archives.benchmark_fixture import (
+    FixtureConfig, article_pdf, compare_results, newsletter_html, save_results,
+)
+from chromatic_news.download_newsletter_archives.domain_matcher import DomainMatcher
+from chromatic_news.download_newsletter_archives.fetcher import FetchedResponse
+from chromatic_news.download_newsletter_archives.links import iter_hrefs
+from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+    Newsletter, clean_urls, filter_out_image_urls, filter_urls_by_ignore_domains,
+    pdf_bytes_to_content_string,
+)
+
+
+def measure(func, min_seconds):
+    """calls of func() per second, the best of 3 rounds of at least
+    `min_seconds` each
+    """
+    best = 0
+    for _ in range(3):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            seconds = time.perf_counter() - start
+            if seconds >= min_seconds:
+                break
+        best = max(best, calls / seconds)
+    return best
+
+
+def ignore_rules(num_rules):
+    """a list the size of a grown ignore_domains.txt"""
+    rules = ['twitter.com', 'facebook.com', '=cdn.example.net']
+    rules += ['tracker{}.example.com'.format(i) for i in range(num_rules - len(rules))]
+    return rules
+
+
+def run_main():
+    args = parse_cl_args()
+    config = FixtureConfig(articles_per_newsletter=args.links_per_page // 2)
+    base_url = 'http://127.0.0.1:8765'
+    pages = [newsletter_html(config, base_url, 0, n) for n in range(args.pages)]
+    hrefs = [list(iter_hrefs(page)) for page in pages]
+    cleaned = [clean_urls(page_hrefs) for page_hrefs in hrefs]
+    ignore_domains = DomainMatcher(ignore_rules(args.ignore_rules))
+    # not stored anywhere, so the archive only needs an id
+    archive = types.SimpleNamespace(nlaid=None)
+    newsletters = [
+        Newsletter(
+            base_url + '/newsletter/0/{}'.format(n), archive,
+            resp=FetchedResponse(base_url, 200, dict(), page.encode()),
+        )
+        for n, page in enumerate(pages)
+    ]
+    pdfs = [article_pdf(FixtureConfig(pdf_pages=args.pdf_pages), 0, 0, n) for n in range(3)]
+
+    num_urls = sum(len(page_hrefs) for page_hrefs in hrefs)
+    megabytes = sum(len(page) for page in pages) / 1e6
+    pdf_megabytes = sum(len(pdf) for pdf in pdfs) / 1e6
+
+    def each(func, items):
+        return lambda: [func(item) for item in items]
+
+    # name -> (function, what one call processes: {unit: amount})
+    benchmarks = {
+        'clean_urls': (each(clean_urls, hrefs), {'urls': num_urls}),
+        'filter_urls_by_ignore_domains': (
+            each(lambda urls: filter_urls_by_ignore_domains(urls, ignore_domains), cleaned),
+            {'urls': num_urls},
+        ),
+        'filter_out_image_urls': (each(filter_out_image_urls, cleaned), {'urls': num_urls}),
+        'extract_article_urls': (
+            each(lambda newsletter: newsletter.extract_article_urls(ignore_domains), newsletters),
+            {'pages': len(pages), 'megabytes': megabytes},
+        ),
+        'pdf_bytes_to_content_string': (
+            each(pdf_bytes_to_content_string, pdfs),
+            {'pages': len(pdfs) * args.pdf_pages, 'megabytes': pdf_megabytes},
+        ),
+    }
+
+    results = dict()
+    for name, (func, units) in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        calls_per_second = measure(func, args.min_seconds)
+        results[name] = {
+            unit + '_per_second': amount * calls_per_second
+            for unit, amount in units.items()
+        }
+        print('{:<32} {}'.format(name, ', '.join(
+            '{:,.1f} {}/s'.format(value, measurement[:-len('_per_second')])
+            for measurement, value in sorted(results[name].items())
+        )))
+
+    if args.json:
+        save_results(results, args.json)
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description="microbenchmark the downloader's per-page functions",
+    )
+    argParser.add_argument('--pages', default=20, type=int, help='newsletter pages')
+    argParser.add_argument('--links-per-page', default=120, type=int)
+    argParser.add_argument('--ignore-rules', default=1000, type=int)
+    argParser.add_argument('--pdf-pages', default=3, type=int, help='pages per pdf')
+    argParser.add_argument('--min-seconds', default=0.5, type=float)
+    argParser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    argParser.add_argument('--json', default=None, metavar='FILE', help='save the results')
+    argParser.add_argument(
+        '--compare', default=None, metavar='FILE',
+        help='compare with results saved with --json',
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
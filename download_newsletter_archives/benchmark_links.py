@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Compare link extraction with BeautifulSoup and with links.py
+
+usage:
+    python benchmark_links.py                 # synthetic newsletter pages
+    python benchmark_links.py page1.html ...  # saved pages
+"""
+import os
+from os.path import dirname
+import sys
+import time
+import argparse
+
+from bs4 import BeautifulSoup
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.download_newsletter_archives.links import backends, iter_hrefs
+
+
+def synthetic_page(num_links=300, paragraph_repeat=5):
+    """roughly the shape of a newsletter issue: lots of text,
+    tables and tracking links
+    """
+    parts = ['<html><head><title>issue</title></head><body><table>']
+    for i in range(num_links):
+        parts.append(
+            '<tr><td class="item"><p>{text}</p>'
+            '<a href="https://example{i}.com/story/{i}?utm_source=news&amp;utm_medium=email"'
+            ' style="color: #333">story {i}</a></td></tr>'.format(
+                i=i, text='Some words about the linked story. ' * paragraph_repeat,
+            )
+        )
+    parts.append('</table></body></html>')
+    return ''.join(parts)
+
+
+def bs_hrefs(html):
+    return [
+        a.attrs['href']
+        for a in BeautifulSoup(html, 'html.parser').find_all('a')
+        if 'href' in a.attrs
+    ]
+
+
+def benchmark(name, func, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            func(page)
+    seconds = time.perf_counter() - start
+    num_pages = len(pages) * repeat
+    megabytes = sum(len(p) for p in pages) * repeat / 1e6
+    print('{:<24} {:8.2f} ms/page {:8.2f} MB/s'.format(
+        name, 1000 * seconds / num_pages, megabytes / seconds,
+    ))
+    return seconds
+
+
+def run_main():
+    args = parse_cl_args()
+    if args.files:
+        pages = list()
+        for filepath in args.files:
+            with open(filepath, 'r', errors='replace') as fr:
+                pages.append(fr.read())
+    else:
+        pages = [synthetic_page() for _ in range(10)]
+
+    expected = [bs_hrefs(page) for page in pages]
+    for backend in backends:
+        got = [list(iter_hrefs(page, backend=backend)) for page in pages]
+        if got != expected:
+            mismatches = sum(g != e for g, e in zip(got, expected))
+            print('{}: links differ from BeautifulSoup on {} of {} pages'.format(
+                backend, mismatches, len(pages),
+            ))
+
+    baseline = benchmark('BeautifulSoup', bs_hrefs, pages, args.repeat)
+    for backend in backends:
+        seconds = benchmark(
+            'iter_hrefs ({})'.format(backend),
+            lambda page: list(iter_hrefs(page, backend=backend)),
+            pages, args.repeat,
+        )
+        print('{:<24} {:8.1f}x faster'.format('', baseline / seconds))
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='benchmark link extraction',
+    )
+    argParser.add_argument('files', nargs='*', help='html files; default: synthetic pages')
+    argParser.add_argument('--repeat', default=5, type=int)
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Cold start times of the downloader
+
+Every measurement starts a fresh python process, the way a user or an
+extraction worker does, and reports the median of --runs:
+
+    cli_help             download_newsletter_archives.py --help
+    import_downloader    importing download_newsletter_archives.py,
+                         which spawned extraction workers do too
+    extraction_worker    importing extraction.py, what a worker needs
+                         before its first job
+    first_html           the worker's first html extraction, which
+                         imports newspaper
+    first_pdf            the worker's first pdf extraction, which
+                         imports the pdf libraries
+
+With --importtime, the slowest imports of `--help` are listed, from
+python's -X importtime.
+
+A measurement whose process fails (e.g. first_pdf when the pdf
+libraries aren't installed) is reported with its stderr and left out
+of the results; the others are still saved, and the exit status is 1.
+
+usage:
+    python benchmark_startup.py --json before.json
+    # ... change something ...
+    python benchmark_startup.py --compare before.json
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+import statistics
+import subprocess
+import time
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.download_newsletter_archives.benchmark_fixture import (
+    compare_results, save_results,
+)
+
+
+# run with the package's parent on sys.path, like the scripts set it up
+setup = 'import sys; sys.path.append({!r}); '.format(dirname(dirname(this_dir)))
+package = 'chromatic_news.download_newsletter_archives'
+downloader = os.path.join(this_dir, 'download_newsletter_archives.py')
+
+commands = {
+    'cli_help': [downloader, '--help'],
+    'import_downloader': ['-c', setup + 'import {}.download_newsletter_archives'.format(package)],
+    'extraction_worker': ['-c', setup + 'import {}.extraction'.format(package)],
+    'first_html': ['-c', setup + (
+        'from {}.extraction import extract_contents; '
+        'extract_contents("http://localhost/a", b"<html><title>a</title><p>text</p></html>", "text/html")'
+    ).format(package)],
+    'first_pdf': ['-c', setup + (
+        'from {0}.extraction import extract_contents; '
+        'from {0}.benchmark_fixture import make_pdf; '
+        'extract_contents("http://localhost/a.pdf", make_pdf([["text"]]), "application/pdf")'
+    ).format(package)],
+}
+
+
+def seconds_to_run(args):
+    """raises subprocess.CalledProcessError, with the stderr of the
+    process, if it fails
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + args, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    return time.perf_counter() - start
+
+
+def print_failure(name, error):
+    print('{:<20} failed with exit status {}:'.format(name, error.returncode))
+    for line in error.stderr.decode(errors='replace').splitlines():
+        print('    ' + line)
+
+
+def slowest_imports(args, num_imports):
+    """[(cumulative seconds, module)] of the top level imports of
+    running `args`
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+    )
+    imports = list()
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        # nested imports are indented; their time is in their parent's
+        if module.startswith('  '):
+            continue
+        imports.append((int(cumulative_us) / 1e6, module.strip()))
+    return sorted(imports, reverse=True)[:num_imports]
+
+
+def run_main():
+    args = parse_cl_args()
+    # so that .pyc files are written before the first measured run;
+    # if --help fails, so does its measurement
+    subprocess.run(
+        [sys.executable] + commands['cli_help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    results = dict()
+    failed = list()
+    for name, command in commands.items():
+        if args.only and name not in args.only:
+            continue
+        try:
+            seconds = statistics.median(seconds_to_run(command) for _ in range(args.runs))
+        except subprocess.CalledProcessError as e:
+            print_failure(name, e)
+            failed.append(name)
+            continue
+        results[name] = {'seconds': seconds}
+        print('{:<20} {:.3f}s'.format(name, seconds))
+
+    if args.importtime:
+        print('\nslowest imports of --help:')
+        try:
+            for seconds, module in slowest_imports(commands['cli_help'], args.importtime):
+                print('{:>8.3f}s  {}'.format(seconds, module))
+        except subprocess.CalledProcessError as e:
+            print_failure('cli_help', e)
+
+    if args.json:
+        save_results(results, args.json)
+    if args.compare:
+        compare_results(results, args.compare)
+    if failed:
+        print('\nfailed: {}'.format(', '.join(failed)))
+        exit(1)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='measure cold start times of the downloader',
+    )
+    argParser.add_argument('--runs', default=5, type=int)
+    argParser.add_argument('--only', nargs='*', help='names of the measurements to run')
+    argParser.add_argument(
+        '--importtime', default=0, type=int, metavar='N',
+        help='list the N slowest imports of --help',
+    )
+    argParser.add_argument('--json', default=None, metavar='FILE', help='save the results')
+    argParser.add_argument(
+        '--compare', default=None, metavar='FILE',
+        help='compare with results saved with --json',
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,404 @@
+"""Compressed, content-addressed storage for page bodies
+
+Most of the database used to be raw html, much of it repeated (the
+full_html of a pdf article is its full_text, many newsletters share
+their markup). Bodies are now compressed with zstd (zlib when
+zstandard isn't installed), optionally with a dictionary trained on
+our own pages, and stored once per sha256 of their content, either in
+a database table or in a local directory. Rows only keep the hash;
+see StoredText.
+
+Every compressed body starts with one byte that says how it was
+compressed, so bodies compressed differently can be read side by side.
+Bodies compressed with a dictionary also carry its id, and the
+dictionary itself is saved in the store (see dictionary_key()), so
+that readers find it without being given the file.
+"""
+import collections
+import hashlib
+import os
+import zlib
+
+from sqlalchemy import event
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+RAW = b'r'
+ZLIB = b'z'
+ZSTD = b's'
+# followed by the 4 byte id of the dictionary
+ZSTD_DICT = b'd'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class DictionaryNotLoaded(ValueError):
+    """a body was compressed with a dictionary that isn't loaded;
+    `dict_id` is its id
+    """
+    def __init__(self, dict_id):
+        super().__init__(
+            'body was compressed with zstd dictionary {}, which is neither '
+            'loaded nor in the blob store'.format(dict_id)
+        )
+        self.dict_id = dict_id
+
+
+def dictionary_key(dict_id):
+    """the key a dictionary is saved under in a blob store
+    """
+    return 'zstd-dictionary-{}'.format(dict_id)
+
+
+class Compressor:
+    """`dictionary` is the content of a file written by
+    train_dictionary(); it requires zstandard. bodies are compressed
+    with it, and can be read with it or any dictionary passed to
+    add_dictionary().
+    """
+    def __init__(self, level=None, dictionary=None):
+        self.level = level
+        self.dictionary = None
+        # dict id -> dictionary, for reading
+        self.dictionaries = dict()
+        if dictionary is not None:
+            self.dictionary = self.add_dictionary(dictionary)
+
+        if zstandard is None:
+            self.codec = ZLIB
+            return
+        kwargs = dict(level=level or 3)
+        self.codec = ZSTD
+        if self.dictionary is not None:
+            kwargs['dict_data'] = self.dictionary
+            self.codec = ZSTD_DICT
+        self.zstd_compressor = zstandard.ZstdCompressor(**kwargs)
+
+    @classmethod
+    def from_dictionary_file(cls, filepath, level=None):
+        with open(filepath, 'rb') as fr:
+            return cls(level=level, dictionary=fr.read())
+
+    def add_dictionary(self, data):
+        if zstandard is None:
+            raise RuntimeError('compression dictionaries require the zstandard package')
+        dictionary = zstandard.ZstdCompressionDict(data)
+        self.dictionaries[dictionary.dict_id()] = dictionary
+        return dictionary
+
+    def compress(self, data):
+        if self.codec == ZLIB:
+            level = self.level if self.level is not None else 6
+            return ZLIB + zlib.compress(data, level)
+        if self.codec == ZSTD_DICT:
+            dict_id = self.dictionary.dict_id().to_bytes(4, 'big')
+            return ZSTD_DICT + dict_id + self.zstd_compressor.compress(data)
+        return ZSTD + self.zstd_compressor.compress(data)
+
+    def decompress(self, blob):
+        codec, body = blob[:1], blob[1:]
+        if codec == RAW:
+            return body
+        if codec == ZLIB:
+            return zlib.decompress(body)
+        if zstandard is None:
+            raise RuntimeError('reading zstd compressed bodies requires the zstandard package')
+        if codec == ZSTD:
+            return zstandard.ZstdDecompressor().decompress(body)
+        if codec == ZSTD_DICT:
+            dict_id = int.from_bytes(body[:4], 'big')
+            if dict_id not in self.dictionaries:
+                raise DictionaryNotLoaded(dict_id)
+            return zstandard.ZstdDecompressor(dict_data=self.dictionaries[dict_id]).decompress(body[4:])
+        raise ValueError('unknown compression {}'.format(codec))
+
+
+class BlobNotFound(KeyError):
+    """a row references a blob that isn't in the store, e.g. because
+    the transaction that stored it was rolled back
+    """
+
+
+def train_dictionary(samples, size_bytes=112640):
+    """train a zstd dictionary on `samples` (bytes); returns what
+    Compressor(dictionary=...) takes
+    """
+    if zstandard is None:
+        raise RuntimeError('training a dictionary requires the zstandard package')
+    return zstandard.train_dictionary(size_bytes, list(samples)).as_bytes()
+
+
+class BlobStore:
+    """put() stores bytes and returns their hash, get() returns the
+    bytes stored under a hash, or raises BlobNotFound
+    """
+    # how many of the most recently stored hashes are remembered, so
+    # that repeated bodies aren't looked up and compressed again; older
+    # ones are looked up in the store
+    max_known = 100000
+
+    def __init__(self, compressor=None):
+        self.compressor = compressor or Compressor()
+        # hashes known to be stored, least recently used first
+        self.known = collections.OrderedDict()
+        self.dictionary_saved = False
+
+    def put(self, data):
+        key = content_hash(data)
+        if self._is_known(key):
+            return key
+        if not self._contains(key):
+            self._save_dictionary()
+            self._put(key, self.compressor.compress(data), len(data))
+        self._stored(key)
+        return key
+
+    def _save_dictionary(self):
+        """the dictionary bodies are compressed with, under
+        dictionary_key(), before the first body compressed with it
+        """
+        dictionary = self.compressor.dictionary
+        if dictionary is None or self.dictionary_saved:
+            return
+        key = dictionary_key(dictionary.dict_id())
+        if not self._contains(key):
+            data = dictionary.as_bytes()
+            self._put(key, RAW + data, len(data))
+        self.dictionary_saved = True
+
+    def _is_known(self, key):
+        if key not in self.known:
+            return False
+        self.known.move_to_end(key)
+        return True
+
+    def _remember(self, key):
+        self.known[key] = None
+        self.known.move_to_end(key)
+        if len(self.known) > self.max_known:
+            self.known.popitem(last=False)
+
+    def _stored(self, key):
+        self._remember(key)
+
+    def get(self, key):
+        blob = self._get(key)
+        if blob is None:
+            raise BlobNotFound(key)
+        try:
+            return self.compressor.decompress(blob)
+        except DictionaryNotLoaded as e:
+            self._load_dictionary(e)
+        return self.compressor.decompress(blob)
+
+    def _load_dictionary(self, error):
+        """load the dictionary of a DictionaryNotLoaded `error` from the
+        store, or raise the error
+        """
+        blob = self._get(dictionary_key(error.dict_id))
+        if blob is None:
+            raise error
+        self.compressor.add_dictionary(self.compressor.decompress(blob))
+
+    def put_text(self, text):
+        return self.put(text.encode())
+
+    def get_text(self, key):
+        return self.get(key).decode()
+
+    def get_texts(self, keys):
+        """{key: text} of `keys`, e.g. for a batch of rows; like get(),
+        raises BlobNotFound, with all the keys that are missing
+        """
+        keys = set(keys)
+        texts = dict()
+        for key, blob in self._get_many(keys):
+            try:
+                data = self.compressor.decompress(blob)
+            except DictionaryNotLoaded as e:
+                self._load_dictionary(e)
+                data = self.compressor.decompress(blob)
+            texts[key] = data.decode()
+        missing = keys - set(texts)
+        if missing:
+            raise BlobNotFound(', '.join(sorted(missing)))
+        return texts
+
+    def _get_many(self, keys):
+        for key in keys:
+            blob = self._get(key)
+            if blob is not None:
+                yield key, blob
+
+
+class DatabaseBlobStore(BlobStore):
+    """blobs in `table`, which needs hash, data and size columns.
+    they're written with `sess`, so they're committed with the rows
+    that reference them, and only known to be stored once they are
+    """
+    def __init__(self, sess, table, compressor=None):
+        super().__init__(compressor)
+        self.sess = sess
+        self.table = table
+        # stored in the current transaction, in order
+        self.pending = dict()
+        # whether the dictionary was saved in the current transaction
+        self.dictionary_pending = False
+        event.listen(sess, 'after_commit', self._after_commit)
+        event.listen(sess, 'after_rollback', self._after_rollback)
+
+    def _is_known(self, key):
+        return key in self.known or key in self.pending
+
+    def _stored(self, key):
+        self.pending[key] = None
+
+    def _save_dictionary(self):
+        if not self.dictionary_saved:
+            self.dictionary_pending = True
+        super()._save_dictionary()
+
+    def _after_commit(self, sess):
+        for key in self.pending:
+            self._remember(key)
+        self.pending = dict()
+        self.dictionary_pending = False
+
+    def _after_rollback(self, sess):
+        self.pending = dict()
+        if self.dictionary_pending:
+            self.dictionary_saved = False
+            self.dictionary_pending = False
+
+    def _contains(self, key):
+        query = self.table.select().with_only_columns(
+            [self.table.c.hash]
+        ).where(self.table.c.hash==key)
+        return self.sess.execute(query).first() is not None
+
+    def _put(self, key, blob, size):
+        statement = self.table.insert()
+        dialect = self.sess.bind.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(self.table).on_conflict_do_nothing()
+        elif dialect == 'sqlite':
+            statement = statement.prefix_with('OR IGNORE')
+        self.sess.execute(statement.values(hash=key, data=blob, size=size))
+
+    def _get(self, key):
+        query = self.table.select().with_only_columns(
+            [self.table.c.data]
+        ).where(self.table.c.hash==key)
+        row = self.sess.execute(query).first()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def _get_many(self, keys, chunk_size=500):
+        """one query per `chunk_size` of them; sqlite limits the
+        number of bound parameters
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), chunk_size):
+            query = self.table.select().with_only_columns(
+                [self.table.c.hash, self.table.c.data]
+            ).where(self.table.c.hash.in_(keys[start:start+chunk_size]))
+            for key, blob in self.sess.execute(query):
+                yield key, bytes(blob)
+
+
+class DirectoryBlobStore(BlobStore):
+    """blobs in files named by their hash under `directory`, git
+    style: ab/cdef...
+    """
+    def __init__(self, directory, compressor=None):
+        super().__init__(compressor)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def _put(self, key, blob, size):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fw:
+            fw.write(blob)
+        os.replace(tmp_path, path)
+
+    def _get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fr:
+                return fr.read()
+        except FileNotFoundError:
+            return None
+
+
+_missing = object()
+
+
+class StoredText:
+    """A text attribute of a model whose value is kept in a BlobStore
+
+    `column` names the attribute of the plain TEXT column that held
+    the value before there was a blob store (and still does when the
+    model's `blob_store` is None), `hash_column` the attribute that
+    holds the hash. The value is only loaded from the store when it's
+    accessed, and then kept on the instance.
+    """
+    def __init__(self, column, hash_column):
+        self.column = column
+        self.hash_column = hash_column
+        self.name = self.cache = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.cache = '_{}_value'.format(name)
+
+    def is_set(self, obj):
+        """whether there is a value, without loading it
+        """
+        return (
+            getattr(obj, self.hash_column) is not None
+            or getattr(obj, self.column) is not None
+        )
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.cache, _missing)
+        if value is not _missing:
+            return value
+        key = getattr(obj, self.hash_column)
+        if key is None:
+            value = getattr(obj, self.column)
+        elif obj.blob_store is None:
+            raise RuntimeError('{} is in a blob store, but none is configured'.format(self.name))
+        else:
+            value = obj.blob_store.get_text(key)
+        obj.__dict__[self.cache] = value
+        return value
+
+    def column_values(self, blob_store, value):
+        """the attributes that store `value`, e.g. for
+        sess.bulk_update_mappings()
+        """
+        if value is not None and blob_store is not None:
+            return {self.hash_column: blob_store.put_text(value), self.column: None}
+        return {self.hash_column: None, self.column: value}
+
+    def __set__(self, obj, value):
+        for attribute, column_value in self.column_values(obj.blob_store, value).items():
+            setattr(obj, attribute, column_value)
+        obj.__dict__[self.cache] = value
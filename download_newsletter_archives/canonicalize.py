@@ -0,0 +1,179 @@
+"""Canonical forms of urls
+
+Newsletter links usually carry tracking parameters, fragments and
+redirector wrappers, so the same article shows up under many urls.
+Canonicalizer reduces them to one form that they're deduplicated by.
+The canonical form is only a key: servers don't necessarily answer it
+with the same page, so links are fetched as they were found, only
+without their redirector wrappers (see unwrap()).
+
+The rules can be configured in a text file, one rule per line:
+
+    # remove query parameters; shell-style patterns, case-insensitive
+    strip_param utm_*
+    strip_param mc_cid
+    # unwrap links like https://www.google.com/url?q=<the real url>
+    redirector www.google.com /url q
+    # remove the trailing slash of paths other than /; off by default,
+    # since many servers answer /a and /a/ differently
+    strip_trailing_slash yes
+    # sort the remaining query parameters
+    sort_query yes
+"""
+import fnmatch
+import hashlib
+import urllib
+
+
+default_strip_params = [
+    'utm_*', 'mc_cid', 'mc_eid', 'fbclid', 'gclid', 'dclid', 'msclkid',
+    'yclid', '_hsenc', '_hsmi', 'hsctatracking', 'mkt_tok', 'oly_anon_id',
+    'oly_enc_id', 'vero_id', 'wt.mc_id', 'ck_subscriber_id', 'ref_src',
+]
+
+# (host, path, name of the query parameter that holds the real url)
+default_redirectors = [
+    ('www.google.com', '/url', 'q'),
+    ('google.com', '/url', 'q'),
+    ('l.facebook.com', '/l.php', 'u'),
+    ('lm.facebook.com', '/l.php', 'u'),
+    ('out.reddit.com', '*', 'url'),
+    ('*.safelinks.protection.outlook.com', '/', 'url'),
+    ('href.li', '/', None),
+]
+
+default_ports = {'http': '80', 'https': '443'}
+
+
+class Canonicalizer:
+    # how many nested redirector wrappers are unwrapped at most
+    max_unwrap = 5
+    # changed along with what canonicalize() does with the same rules,
+    # so that the fingerprint changes too
+    version = 2
+
+    def __init__(self, strip_params=None, redirectors=None,
+                 strip_trailing_slash=False, sort_query=True):
+        if strip_params is None:
+            strip_params = default_strip_params
+        if redirectors is None:
+            redirectors = default_redirectors
+        self.strip_params = [p.lower() for p in strip_params]
+        self.redirectors = list(redirectors)
+        self.strip_trailing_slash = strip_trailing_slash
+        self.sort_query = sort_query
+
+    @classmethod
+    def from_file(cls, filepath):
+        strip_params = list()
+        redirectors = list()
+        options = dict()
+        with open(filepath, 'r') as fr:
+            for line in fr:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                rule, *values = line.split()
+                if rule == 'strip_param':
+                    strip_params.extend(values)
+                elif rule == 'redirector':
+                    host, path, *param = values
+                    redirectors.append((host, path, param[0] if param else None))
+                elif rule in ('strip_trailing_slash', 'sort_query'):
+                    options[rule] = values[0].lower() in ('yes', 'true', '1')
+                else:
+                    raise ValueError("unknown canonicalization rule '{}' in {}".format(rule, filepath))
+        return cls(strip_params, redirectors, **options)
+
+    @property
+    def fingerprint(self):
+        """changes whenever the rules change, so that anything computed
+        with other rules can be recognized
+        """
+        rules = repr((
+            self.version, self.strip_params, self.redirectors,
+            self.strip_trailing_slash, self.sort_query,
+        ))
+        return hashlib.sha1(rules.encode()).hexdigest()[:16]
+
+    def _is_stripped_param(self, name):
+        name = name.lower()
+        return any(fnmatch.fnmatchcase(name, p) for p in self.strip_params)
+
+    def _unwrapped(self, parts):
+        """the url wrapped by a redirector, or None
+        """
+        host = parts.hostname or ''
+        for r_host, r_path, r_param in self.redirectors:
+            if not fnmatch.fnmatchcase(host, r_host):
+                continue
+            if not fnmatch.fnmatchcase(parts.path or '/', r_path):
+                continue
+            if r_param is None:
+                # the wrapped url is the whole query string
+                wrapped = urllib.parse.unquote(parts.query)
+            else:
+                values = urllib.parse.parse_qs(parts.query).get(r_param)
+                if not values:
+                    continue
+                wrapped = values[0]
+            if wrapped.startswith(('http://', 'https://')):
+                return wrapped
+        return None
+
+    def _split_unwrapped(self, url):
+        """(the url without its redirector wrappers, its urlsplit()),
+        or (url, None) if it can't be parsed
+        """
+        url = url.strip()
+        for _ in range(self.max_unwrap + 1):
+            try:
+                parts = urllib.parse.urlsplit(url)
+            except ValueError:
+                return url, None
+            wrapped = self._unwrapped(parts)
+            if wrapped is None:
+                break
+            url = wrapped
+        return url, parts
+
+    def unwrap(self, url):
+        """the url that a link leads to: the link itself, or the url a
+        redirector wraps. unlike the canonical form, it's safe to fetch.
+        """
+        return self._split_unwrapped(url)[0]
+
+    def _query(self, query):
+        """`query` without the stripped parameters. the rest keep their
+        text as it was written (e.g. "?12345" or "%20"); they're only
+        sorted.
+        """
+        params = [
+            param for param in query.split('&')
+            if param and not self._is_stripped_param(
+                urllib.parse.unquote_plus(param.split('=', 1)[0])
+            )
+        ]
+        if self.sort_query:
+            params.sort()
+        return '&'.join(params)
+
+    def canonicalize(self, url):
+        url, parts = self._split_unwrapped(url)
+        if parts is None:
+            return url
+
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        host, _, port = netloc.rpartition(':')
+        if host and default_ports.get(scheme) == port:
+            netloc = host
+
+        path = parts.path or '/'
+        if self.strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+
+        query = self._query(parts.query)
+        return urllib.parse.urlunsplit((scheme, netloc, path, query, ''))
+
+    __call__ = canonicalize
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Move stored page bodies into the blob store
+
+Rows written before there was a blob store keep full_html and
+full_text in the rows themselves. This moves them into the blob store,
+compressed and deduplicated, a batch at a time. It can also train a
+zstd dictionary on the stored pages, for --compression-dictionary.
+
+usage:
+    python compress_pages.py --train-dictionary pages.dict
+    python compress_pages.py --compression-dictionary pages.dict
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+
+from sqlalchemy import func, or_
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.dbutils import Base, create_tables
+from chromatic_news.download_newsletter_archives.blob_store import train_dictionary
+from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+    Article, Newsletter, NewsletterArchive, SABase, Webpage,
+    get_engine, make_blob_store, required_blob_store, schema_name,
+)
+
+
+# model -> its StoredText attributes
+stored_attributes = [
+    (NewsletterArchive, ['full_html']),
+    (Newsletter, ['full_html']),
+    (Article, ['full_text', 'full_html']),
+]
+
+
+def sample_pages(sess, num_samples):
+    samples = list()
+    for cls, _ in stored_attributes:
+        query = sess.query(cls).filter(or_(
+            cls._full_html != None,
+            cls.full_html_hash != None,
+        )).order_by(func.random()).limit(num_samples // len(stored_attributes))
+        for row in query:
+            if row.full_html:
+                samples.append(row.full_html.encode())
+    return samples
+
+
+def move_to_blob_store(sess, cls, attributes, batch_size=100):
+    """returns the number of rows that were moved
+    """
+    legacy_columns = [getattr(cls, '_' + attribute) for attribute in attributes]
+    moved = 0
+    while True:
+        # moved rows no longer match, so this always gets the next batch
+        rows = sess.query(cls).filter(or_(
+            *[col != None for col in legacy_columns]
+        )).limit(batch_size).all()
+        if not rows:
+            return moved
+        for row in rows:
+            for attribute in attributes:
+                # reads the plain column, writes the blob store
+                setattr(row, attribute, getattr(row, attribute))
+        sess.commit()
+        moved += len(rows)
+        print('{}: {} rows moved'.format(cls.__tablename__, moved))
+
+
+def run_main():
+    args = parse_cl_args()
+    engine = get_engine()
+    Base.set_sess(engine)
+    create_tables(engine, SABase, schema_name)
+
+    with Base.get_session() as sess:
+        Webpage.set_blob_store(make_blob_store(sess, args))
+
+        if args.train_dictionary:
+            samples = sample_pages(sess, args.samples)
+            dictionary = train_dictionary(samples, args.dictionary_size_kb * 1024)
+            with open(args.train_dictionary, 'wb') as fw:
+                fw.write(dictionary)
+            print('trained a {} byte dictionary on {} pages'.format(len(dictionary), len(samples)))
+            return
+
+        for cls, attributes in stored_attributes:
+            move_to_blob_store(sess, cls, attributes, batch_size=args.batch_size)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='move stored page bodies into the blob store',
+    )
+    argParser.add_argument(
+        '--blob-store', default='db', metavar='db|DIR', type=required_blob_store,
+        help="the blobs table (db) or a directory. default %(default)s",
+    )
+    argParser.add_argument('--compression-level', default=None, type=int)
+    argParser.add_argument(
+        '--compression-dictionary', default=None, metavar='FILE',
+        help="zstd dictionary to compress with",
+    )
+    argParser.add_argument(
+        '--train-dictionary', default=None, metavar='FILE',
+        help="instead of moving anything, train a zstd dictionary on\n"
+            "stored pages and write it to FILE",
+    )
+    argParser.add_argument('--dictionary-size-kb', default=110, type=int)
+    argParser.add_argument(
+        '--samples', default=1000, type=int,
+        help="how many pages to train the dictionary on",
+    )
+    argParser.add_argument('--batch-size', default=100, type=int)
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,111 @@
+"""Matching urls against ignore_domains.txt
+
+Each line of the file is one rule:
+
+    example.com     example.com and all of its subdomains
+    *.example.com   only the subdomains of example.com
+    =example.com    only example.com itself
+    example.com/ads legacy rule: any url containing this text
+
+Rules are kept in hash sets, so matching a url costs one lookup per
+label of its host, no matter how many rules there are.
+"""
+import os
+import urllib
+
+
+def url_host(url):
+    try:
+        host = urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        return None
+    if host is None:
+        return None
+    return host.rstrip('.')
+
+
+class DomainMatcher:
+    def __init__(self, rules=(), filepath=None):
+        self.domains = set()
+        self.exact_hosts = set()
+        self.subdomains_of = set()
+        self.substrings = list()
+        self.filepath = filepath
+        # how much of the file has been read, so that lines appended
+        # to it later can be read without re-reading the rest
+        self.file_offset = 0
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_file(cls, filepath):
+        self = cls(filepath=filepath)
+        self.refresh()
+        return self
+
+    def __len__(self):
+        return (
+            len(self.domains) + len(self.exact_hosts)
+            + len(self.subdomains_of) + len(self.substrings)
+        )
+
+    def __iter__(self):
+        yield from sorted(self.domains)
+        yield from ('=' + h for h in sorted(self.exact_hosts))
+        yield from ('*.' + d for d in sorted(self.subdomains_of))
+        yield from self.substrings
+
+    def add(self, rule):
+        rule = rule.strip().lower()
+        if not rule or rule.startswith('#'):
+            return
+        if '/' in rule:
+            self.substrings.append(rule)
+        elif rule.startswith('='):
+            self.exact_hosts.add(rule[1:].rstrip('.'))
+        elif rule.startswith('*.'):
+            self.subdomains_of.add(rule[2:].rstrip('.'))
+        else:
+            self.domains.add(rule.rstrip('.'))
+
+    # so that code that appended to the old list of domains still works
+    append = add
+
+    def refresh(self):
+        """read the lines that were appended to the file since it was
+        last read
+        """
+        if self.filepath is None or not os.path.exists(self.filepath):
+            return
+        if os.path.getsize(self.filepath) < self.file_offset:
+            # the file was rewritten rather than appended to
+            self.__init__(filepath=self.filepath)
+        with open(self.filepath, 'rb') as fr:
+            fr.seek(self.file_offset)
+            data = fr.read()
+        # an incomplete last line is read again next time
+        complete, newline, _ = data.rpartition(b'\n')
+        for line in complete.decode().split('\n'):
+            self.add(line)
+        self.file_offset += len(complete) + len(newline)
+
+    def matches_host(self, host):
+        if host in self.domains or host in self.exact_hosts:
+            return True
+        labels = host.split('.')
+        for i in range(1, len(labels)):
+            parent = '.'.join(labels[i:])
+            if parent in self.domains or parent in self.subdomains_of:
+                return True
+        return False
+
+    def matches(self, url):
+        host = url_host(url)
+        if host is not None and self.matches_host(host.lower()):
+            return True
+        if self.substrings:
+            lower_url = url.lower()
+            return any(s in lower_url for s in self.substrings)
+        return False
+
+    __contains__ = matches
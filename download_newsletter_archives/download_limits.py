@@ -0,0 +1,173 @@
+"""What the fetchers are willing to download
+
+Responses are streamed, so that a page can be turned down by its
+headers before its body is downloaded: DownloadLimits rejects content
+types the crawler can't use (video, audio, images, archives, ...) and
+bodies whose Content-Length is over the limit, and BodyReader stops
+reading a body that turns out to be over the limit without one.
+
+pdfs can be much bigger than html pages, so they have a limit of their
+own, and a pdf over `spool_bytes` is written to a temporary file as it
+arrives instead of being held in memory; see SpooledContent.
+
+usage:
+    limits = DownloadLimits(max_bytes=10*1024*1024)
+    rejected = limits.check_headers(headers)
+    if rejected is None:
+        reader = BodyReader(limits, headers.get('Content-Type'))
+        for chunk in chunks:
+            if not reader.feed(chunk):
+                break
+        rejected = reader.rejected
+        content = reader.finish()
+"""
+import os
+import tempfile
+import weakref
+
+
+MB = 1024 * 1024
+
+# prefixes of the content types that are downloaded; anything the
+# crawler can parse: html, text, xml and pdf
+default_content_types = (
+    'text/',
+    'application/xhtml',
+    'application/xml',
+    'application/rss',
+    'application/atom',
+    'application/pdf',
+)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def media_type(content_type):
+    """'text/html; charset=utf-8' -> 'text/html'
+    """
+    if not content_type:
+        return ''
+    return content_type.split(';')[0].strip().lower()
+
+
+class DownloadLimits:
+    """`max_bytes` for most responses, `max_pdf_bytes` for pdfs; None
+    for no limit. responses without a Content-Type are downloaded,
+    since most of them are html.
+    """
+    def __init__(self, max_bytes=10*MB, max_pdf_bytes=50*MB, spool_bytes=5*MB,
+                 content_types=default_content_types):
+        self.max_bytes = max_bytes
+        self.max_pdf_bytes = max_pdf_bytes
+        self.spool_bytes = spool_bytes
+        self.content_types = content_types
+
+    def max_bytes_for(self, content_type):
+        if media_type(content_type) == 'application/pdf':
+            return self.max_pdf_bytes
+        return self.max_bytes
+
+    def check_headers(self, headers):
+        """why a response with `headers` shouldn't be downloaded, or
+        None if it should
+        """
+        content_type = headers.get('Content-Type')
+        mtype = media_type(content_type)
+        if mtype and self.content_types and not mtype.startswith(self.content_types):
+            return 'content type {}'.format(mtype)
+        max_bytes = self.max_bytes_for(content_type)
+        content_length = headers.get('Content-Length', '')
+        if max_bytes and content_length.isdigit() and int(content_length) > max_bytes:
+            return 'content length {} over {}'.format(content_length, max_bytes)
+        return None
+
+
+class SpooledContent:
+    """The body of a response that was written to a temporary file
+
+    Stands in for the bytes of resp.content: it has a length and is
+    true when it isn't empty, and read() returns the bytes. It can be
+    passed to other processes, e.g. an extraction.ExtractionPool; only
+    the one that created it deletes the file, once it's garbage
+    collected or at exit.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._finalizer = weakref.finalize(self, _remove, path)
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        with open(self.path, 'rb') as fr:
+            return fr.read()
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def __getstate__(self):
+        return {'path': self.path, 'size': self.size}
+
+    def __setstate__(self, state):
+        # a copy in another process, which leaves the file alone
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return '{}({!r}, {})'.format(self.__class__.__name__, self.path, self.size)
+
+
+class BodyReader:
+    """Collects the chunks of a body until it's over the limit for its
+    content type. feed() returns False once the rest of the body
+    shouldn't be read anymore; `rejected` says why.
+    """
+    def __init__(self, limits, content_type=None):
+        self.max_bytes = limits.max_bytes_for(content_type)
+        self.spool_bytes = None
+        if media_type(content_type) == 'application/pdf':
+            self.spool_bytes = limits.spool_bytes
+        self.chunks = list()
+        self.file = None
+        self.size = 0
+        self.rejected = None
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.rejected = 'body over {} bytes'.format(self.max_bytes)
+            self.discard()
+            return False
+        if self.file is not None:
+            self.file.write(chunk)
+            return True
+        self.chunks.append(chunk)
+        if self.spool_bytes and self.size > self.spool_bytes:
+            self.file = tempfile.NamedTemporaryFile(prefix='chromatic_news_', suffix='.pdf', delete=False)
+            for spooled_chunk in self.chunks:
+                self.file.write(spooled_chunk)
+            self.chunks = list()
+        return True
+
+    def discard(self):
+        self.chunks = list()
+        if self.file is not None:
+            self.file.close()
+            _remove(self.file.name)
+            self.file = None
+
+    def finish(self):
+        """the body: bytes, or a SpooledContent if it was written to a
+        file. empty when it was rejected.
+        """
+        if self.rejected is not None:
+            return b''
+        if self.file is not None:
+            self.file.close()
+            return SpooledContent(self.file.name, self.size)
+        return b''.join(self.chunks)
@@ -11,7 +11,8 @@ import sys
 import urllib
 import argparse
 import time
-from io import BytesIO
+import collections
+import contextlib
 from contextlib import contextmanager
 
 import logging
@@ -23,30 +24,46 @@ import logging
 # 50 CRITICAL, FATAL
 
 from sqlalchemy import (
-    Text, Integer,
-    ForeignKey,
+    Text, Integer, Boolean, LargeBinary, Float,
+    ForeignKey, Index,
     Column, TEXT, create_engine, or_
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.schema import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 
-import requests
-from bs4 import BeautifulSoup
-import newspaper
-import pdfminer
-import slate
-
 
 this_dir = dirname(os.path.abspath(__file__))
 sys.path.append(dirname(dirname(this_dir)))
 
-from chromatic_news.dbutils import Base, create_tables, pkey
+from chromatic_news.dbutils import Base, WriteBuffer, create_tables, pkey, sqlite_engine
+from chromatic_news.queryutils import exists, stream
 # from chromatic_news.dbutils import drop_tables
 
 from chromatic_news.download_newsletter_archives.config import (
     connstr, engine, logger, default_logging_level
 )
+from chromatic_news.download_newsletter_archives.url_index import UrlIndex
+from chromatic_news.download_newsletter_archives.canonicalize import Canonicalizer
+from chromatic_news.download_newsletter_archives.domain_matcher import DomainMatcher
+from chromatic_news.download_newsletter_archives.links import iter_hrefs
+from chromatic_news.download_newsletter_archives.fetcher import Fetcher
+from chromatic_news.download_newsletter_archives.download_limits import DownloadLimits, SpooledContent
+from chromatic_news.download_newsletter_archives.metrics import Metrics, Progress
+from chromatic_news.download_newsletter_archives.frontier import (
+    ARCHIVE, ARTICLE, NEWSLETTER, Frontier,
+)
+from chromatic_news.download_newsletter_archives.blob_store import (
+    Compressor, DatabaseBlobStore, DirectoryBlobStore, StoredText,
+)
+from chromatic_news.download_newsletter_archives.http_cache import (
+    HttpCache, conditional_headers, validators,
+)
+from chromatic_news.download_newsletter_archives.extraction import (
+    ExtractionFailed, ExtractionPool, ExtractionServerError,
+    InlineExtractor, PoolExtractor, RemoteExtractor,
+    pdf_bytes_to_content_string,
+)
 
 log_levels = sorted([
     (a, getattr(logging, a)) for a in dir(logging) if a.upper()==a and isinstance(getattr(logging, a),int)
@@ -55,21 +72,50 @@ log_level_dict = {name: integer for name, integer in log_levels}
 if logger is None:
     logger = logging.getLogger(__name__)
 
-if engine is None:
-    engine = create_engine(connstr)
 schema_name = 'chromatic'
+# bound to the engine by get_engine(), so that importing this module
+# (e.g. in every extraction worker) doesn't create one
 SABase = declarative_base(
     metadata=MetaData(
-        bind=engine,
         schema=schema_name,
     ),
 )
 ignore_domains_file = os.path.join(this_dir, 'ignore_domains.txt')
+canonicalization_rules_file = os.path.join(this_dir, 'canonicalization_rules.txt')
+newsletter_archive_urls_file = os.path.join(this_dir, 'newsletter_archive_urls.txt')
+
+
+def use_database(url):
+    """use the database at `url` instead of the one in config.py;
+    sqlite:///path/to/file.db works too
+    """
+    global engine
+    if url.startswith('sqlite:///'):
+        engine = sqlite_engine(url[len('sqlite:///'):], schema_name)
+    else:
+        engine = create_engine(url)
+    SABase.metadata.bind = engine
+
+
+def get_engine():
+    """the engine of config.py (or the one given to use_database()),
+    created and bound to the models on first use
+    """
+    if engine is None:
+        use_database(connstr)
+    SABase.metadata.bind = engine
+    return engine
 
 
 class Counter:
     requests_successful = 0
     requests_total = 0
+    extractions_failed = 0
+    # articles left for a later run because the extraction server
+    # wasn't available
+    extraction_server_errors = 0
+    # netloc -> politeness.DomainStats, filled by the concurrent crawler
+    domain_stats = dict()
 
 
 @contextmanager
@@ -84,115 +130,45 @@ def timer():
 # check memory location equality using
 # "if somevar is empty_response"
 empty_response = object()
+# responses that may be different when the page is requested again,
+# like the ones politeness.DomainScheduler backs off on
+transient_statuses = (429, 503)
 
 
-def modify_get_request(func, interactive=False, timeout_seconds=10, update_ignore_domains_on_403=False, ignore_domains=[]):
-    def new_requests_get(*args, **kwargs):
-        url = args[0]
-        logging.info('requesting {}'.format(url))
-
-        if interactive:
-            input('ready to request \'{}\'? '.format(url))
+def fetch_failed(resp):
+    """whether a request timed out, failed to connect or got a
+    transient error. such pages are fetched again by a later run, so
+    they aren't stored and their newsletter isn't marked processed.
+    """
+    return resp is empty_response or resp.status_code in transient_statuses
 
-        with timer() as runtime:
-            try:
-                Counter.requests_total += 1
-                resp = func(*args, timeout=timeout_seconds, **kwargs)
-                Counter.requests_successful += 1
-            except requests.exceptions.ReadTimeout:
-                logging.info("requesting '{}' took longer than the {} timeout seconds".format(url, timeout_seconds))
-                return empty_response
-            except (
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.MissingSchema,
-                    requests.exceptions.SSLError,
-                    requests.exceptions.TooManyRedirects
-            ) as e:
-                print(type(e), e)
-                if interactive:
-                    logging.info(str(e))
-                    input("failed to request '{}'; using empty response ".format(url))
-                return empty_response
-            except Exception as e:
-                print('Unhandled Exception:', type(e), e)
-                raise
-
-        if update_ignore_domains_on_403 and resp.status_code == 403:
-            url_domain = netloc(url)
-            ignore_domains.append(url_domain)
-            with open(ignore_domains_file, 'a') as fa:
-                print(url_domain, file=fa)
-
-        total_seconds = runtime['seconds']
-        logging.info("requesting '{}' took {:.2f} seconds".format(
-            url, total_seconds
-        ))
-        return resp
 
-    # try to make the new requests.get as similar
-    # as possible to the original requests.get
-    for attr in dir(func):
-        try:
-            setattr(new_requests_get, attr, getattr(func, attr))
-        except:
-            pass
-    return new_requests_get
+def ignore_domain_on_403(url, resp, ignore_domains):
+    """`ignore_domains` is the DomainMatcher from load_ignore_domains()
+    """
+    if resp.status_code != 403:
+        return
+    # the exact host: a 403 from one subdomain doesn't mean that
+    # the rest of the domain forbids us too
+    url_domain = '=' + netloc(url).split(':')[0]
+    with open(ignore_domains_file, 'a') as fa:
+        print(url_domain, file=fa)
+    # also picks up what other processes appended in the meantime
+    ignore_domains.refresh()
 
 
 def load_ignore_domains():
-    ignore_domains = list()
-    with open(ignore_domains_file, 'r') as fr:
-        for line in fr:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith('#'):
-                continue
-            ignore_domains.append(line.lower())
-    return ignore_domains
+    """see domain_matcher.py for the format of ignore_domains.txt
+    """
+    return DomainMatcher.from_file(ignore_domains_file)
 
 
 def filter_urls_by_ignore_domains(urls, ignore_domains):
-    filtered_urls = list()
-    for url in urls:
-        keep = True
-        for ignore_domain in ignore_domains:
-            if ignore_domain in url.lower():
-                keep = False
-                break
-        if keep:
-            filtered_urls.append(url)
-    return filtered_urls
-
-
-def pdf_bytes_to_content_string(bytes_content):
-    bio = BytesIO()
-
-    # can't do
-    # bytes_content = bytes_content.replace(b'\x00', b'')
-    # to fix the \x00 error because:
-    # pdfminer.pdfparser.PDFSyntaxError: stream with no endstream
-
-    bio.write(bytes_content)
-    bio.seek(0)
-    # note that this is a very cpu-intensive
-    # line: parsing a pdf.
-    try:
-        pdf = slate.PDF(bio)
-    except pdfminer.psparser.PSEOF:
-        return None
-    return pdf.text()
-
-
-@contextmanager
-def temporary_log_level(level_during, level_after):
-    """
-    the main purpose of this is to silence the thousands of
-    logging messages created by slate and PDFMiner
+    """`ignore_domains` is a DomainMatcher or a list of rules
     """
-    logging.disable(level_during-10)
-    yield
-    logging.basicConfig(level=level_after)
+    if not isinstance(ignore_domains, DomainMatcher):
+        ignore_domains = DomainMatcher(ignore_domains)
+    return [url for url in urls if not ignore_domains.matches(url)]
 
 
 extract_url_re = re.compile(r'https?://[^ ]+')
@@ -237,27 +213,227 @@ def filter_out_image_urls(urls):
 class Webpage:
     """Core functionality for all webpages
     """
-    def ensure_full_html_and_bs(self, sess):
-        url = self.url
+    # UrlIndex of the urls of this class' rows; see load_url_indexes
+    url_index = None
+    # links are deduplicated by their canonical form; see fetch_url()
+    # for the url that is requested
+    canonicalizer = Canonicalizer()
+    # all pages are requested through one pooled session; run_main
+    # replaces this with one configured from the command line
+    fetcher = Fetcher(counter=Counter, failed_response=empty_response)
+    # where full_html and full_text are kept when it's set; see
+    # blob_store.py
+    blob_store = None
+    # turns downloaded articles into text; see extraction.py
+    extractor = InlineExtractor()
+    # timings and counts of the crawl; see metrics.py
+    metrics = Metrics()
+
+    @classmethod
+    def set_fetcher(cls, fetcher):
+        cls.fetcher = fetcher
+
+    @classmethod
+    def set_blob_store(cls, blob_store):
+        cls.blob_store = blob_store
+
+    @classmethod
+    def set_extractor(cls, extractor):
+        cls.extractor = extractor
+
+    @classmethod
+    def set_metrics(cls, metrics):
+        cls.metrics = metrics
+
+    @classmethod
+    def set_url_index(cls, url_index):
+        cls.url_index = url_index
+
+    @classmethod
+    def set_canonicalizer(cls, canonicalizer):
+        cls.canonicalizer = canonicalizer
+
+    @classmethod
+    def canonical(cls, url):
+        """the form `url` is deduplicated by; never fetched
+        """
+        return cls.canonicalizer.canonicalize(url)
+
+    @classmethod
+    def fetch_url(cls, url):
+        """the url to request for a link: the link without its
+        redirector wrappers
+        """
+        return cls.canonicalizer.unwrap(url)
+
+    @classmethod
+    def is_known(cls, url):
+        """True if the url is in the url index, i.e. it's in the
+        database without having to ask the database
+        """
+        return cls.url_index is not None and url in cls.url_index
+
+    @classmethod
+    def url_filter(cls, url):
+        """criterion for the rows that `url` was found as, led to or
+        is the canonical form of
+        """
+        return or_(
+            cls.url==url,
+            cls.discovery_url==url,
+            cls.canonical_url==cls.canonical(url),
+        )
+
+    @classmethod
+    def add_to_url_index(cls, row):
+        if cls.url_index is not None:
+            cls.url_index.add(row.url, row.discovery_url, row.canonical_url)
+
+    # set by refresh() when the page hasn't changed since it was stored
+    not_modified = False
+    # set by set_response() when the page couldn't be fetched
+    page_failed = False
+
+    @property
+    def bs(self):
+        """the parsed full_html, built the first time it's used.
+        only needed for more than the links; see hrefs()
+        """
+        if getattr(self, '_bs', None) is None:
+            # imported here: most runs never build a parse tree
+            from bs4 import BeautifulSoup
+            full_html = self.full_html
+            with self.metrics.time('parse_seconds', page=self.__tablename__, parser='bs4'):
+                self._bs = BeautifulSoup(full_html, 'html.parser')
+        return self._bs
+
+    def hrefs(self):
+        """the href of every <a> tag of full_html, without building
+        a parse tree
+        """
+        full_html = self.full_html
+        with self.metrics.time('parse_seconds', page=self.__tablename__, parser='links'):
+            return list(iter_hrefs(full_html))
+
+    def has_full_html(self):
+        """like `full_html is not None`, without loading it
+        """
+        return type(self).full_html.is_set(self)
+
+    def set_response(self, resp):
+        """store the page of `resp`. a response that failed (see
+        fetch_failed()) isn't stored and sets page_failed, so that the
+        page is requested again. one whose body wasn't downloaded (see
+        download_limits.py) or was spooled to a file, which only pdfs
+        are, is stored without its body.
+        """
+        self.page_failed = fetch_failed(resp)
+        if self.page_failed:
+            return
+        self.status = resp.status_code
         if self.url is None:
-            url = self.discovery_url
-        if self.full_html is None:
-            resp = requests.get(url)
-            self.status = resp.status_code
-            self.full_html = resp.content.decode()
-            if self.url is None:
-                self.url = resp.url
+            self.url = resp.url
+        if getattr(resp, 'rejected', None) is not None or isinstance(resp.content, SpooledContent):
+            logging.info("not storing the page of '{}': not an html page or too large".format(self.url))
+            return
+        self.full_html = resp.content.decode()
+        self.etag, self.last_modified = validators(resp.headers)
+        self._bs = None
+
+    def conditional_headers(self):
+        """headers that make the server answer 304 if the page hasn't
+        changed since it was stored
+        """
+        if not self.has_full_html():
+            return dict()
+        return conditional_headers(self.etag, self.last_modified)
+
+    def ensure_full_html_and_bs(self, sess, resp=None):
+        """`resp` may be passed in when the page was already
+        fetched, e.g. by the concurrent crawler
+        """
+        url = self.url
+        if self.url is None and self.discovery_url is not None:
+            url = self.fetch_url(self.discovery_url)
+        if not self.has_full_html():
+            if resp is None:
+                resp = self.fetcher.get(url)
+            self.set_response(resp)
+            self.commit(sess)
+
+    def refresh(self, sess, resp=None):
+        """like ensure_full_html_and_bs, but a page that is already
+        stored is requested again, conditionally, and replaced if it
+        changed. sets not_modified.
+        """
+        if not self.has_full_html():
+            self.not_modified = False
+            self.ensure_full_html_and_bs(sess, resp=resp)
+            return
+        if resp is None:
+            resp = self.fetcher.get(self.url, headers=self.conditional_headers())
+        if fetch_failed(resp) or resp.not_modified:
+            # keep using what's stored
+            self.not_modified = True
+            return
+        self.not_modified = False
+        self.set_response(resp)
+        self.commit(sess)
+
 
-        self.bs = BeautifulSoup(self.full_html, 'html.parser')
-        sess.commit()
+class Blob(SABase, Base):
+    """compressed page bodies by the sha256 of their content; see
+    blob_store.py
+    """
+    __tablename__ = 'blobs'
+    hash = Column('hash', TEXT, primary_key=True)
+    data = deferred(Column('data', LargeBinary))
+    # uncompressed
+    size = Column('size', Integer)
+
+
+class FrontierUrl(SABase, Base):
+    """the urls a crawl has left to do and what became of the ones it
+    did; see frontier.py
+    """
+    __tablename__ = 'frontier'
+    __table_args__ = (
+        Index('ix_frontier_kind_key', 'kind', 'key', unique=True),
+        Index('ix_frontier_state_priority_fid', 'state', 'priority', 'fid'),
+    )
+    fid = pkey('fid')
+    # archive, newsletter or article
+    kind = Column('kind', TEXT, nullable=False)
+    # sha1 of the canonical url
+    key = Column('key', TEXT, nullable=False)
+    url = Column('url', TEXT, nullable=False)
+    # the archive a newsletter was found in, the newsletter an
+    # article was found in
+    parent_url = Column('parent_url', TEXT)
+    priority = Column('priority', Integer, nullable=False)
+    # pending, in_progress, done or failed
+    state = Column('state', TEXT, nullable=False)
+    attempts = Column('attempts', Integer, nullable=False, default=0)
+    worker = Column('worker', TEXT)
+    # unix time
+    lease_expires = Column('lease_expires', Float)
+    error = Column('error', TEXT)
 
 
 class NewsletterArchive(SABase, Base, Webpage):
     __tablename__ = 'newsletter_archives'
     nlaid = pkey('nlaid')
     url = Column('url', TEXT)
-    full_html = Column('full_html', TEXT)
+    # the big columns are deferred: they're only loaded when used
+    _full_html = deferred(Column('full_html', TEXT))
+    full_html_hash = Column('full_html_hash', TEXT)
+    full_html = StoredText('_full_html', 'full_html_hash')
     status = Column('status', Integer)
+    etag = Column('etag', TEXT)
+    last_modified = Column('last_modified', TEXT)
+    # newline separated newsletter urls extracted from full_html, so
+    # that an archive page that wasn't modified needn't be parsed again
+    newsletter_urls = Column('newsletter_urls', TEXT)
 
     def __str__(self):
         return '{}({})'.format(self.__class__.__name__, repr(self.url))
@@ -265,30 +441,60 @@ class NewsletterArchive(SABase, Base, Webpage):
     __repr__ = __str__
 
     def extract_newsletter_urls(self):
+        if self.not_modified and self.newsletter_urls is not None:
+            return self.newsletter_urls.split('\n') if self.newsletter_urls else []
+        newsletter_urls = list(self._extract_newsletter_urls())
+        self.newsletter_urls = '\n'.join(newsletter_urls)
+        return newsletter_urls
+
+    def _extract_newsletter_urls(self):
         base_url = urllib.parse.urlparse(self.url)
         base_url = '{}://{}'.format(base_url.scheme, base_url.netloc)
-        for a in self.bs.find_all('a'):
-            url = a.attrs['href']
-
+        seen_canonical_urls = set()
+        for url in self.hrefs():
             if url.startswith('/'):
                 url = urllib.parse.urljoin(base_url, url)
 
             urls = extract_url_re.findall(url)
             if not urls:
                 continue
+            canonical_url = self.canonical(urls[0])
+            if canonical_url in seen_canonical_urls:
+                continue
+            seen_canonical_urls.add(canonical_url)
             yield urls[0]
 
 class Newsletter(SABase, Base, Webpage):
     __tablename__ = 'newsletters'
+    # hash indexes, because urls can be longer than a btree index row
+    # allows and they're only ever compared for equality
+    __table_args__ = (
+        Index('ix_newsletters_url', 'url', postgresql_using='hash'),
+        Index('ix_newsletters_discovery_url', 'discovery_url', postgresql_using='hash'),
+        Index('ix_newsletters_canonical_url', 'canonical_url', postgresql_using='hash'),
+    )
     nlid = pkey('nlid')
     url = Column('url', TEXT)
     discovery_url = Column('discovery_url', TEXT)
-    full_html = Column('full_html', TEXT)
+    # discovery_url without tracking parameters etc.; see canonicalize.py
+    canonical_url = Column('canonical_url', TEXT)
+    _full_html = deferred(Column('full_html', TEXT))
+    full_html_hash = Column('full_html_hash', TEXT)
+    full_html = StoredText('_full_html', 'full_html_hash')
+    etag = Column('etag', TEXT)
+    last_modified = Column('last_modified', TEXT)
+    # set once every article link of the newsletter was handled, so
+    # that --incremental runs can skip it
+    articles_processed = Column('articles_processed', Boolean, default=False)
 
     nlaid = Column('nlaid', Integer, ForeignKey('newsletter_archives.nlaid'))
     newsletter_archive = relationship('NewsletterArchive', backref='newsletters')
 
-    def __init__(self, discovery_url, newsletter_archive):
+    # canonical urls of the newsletters whose articles were all
+    # processed; only loaded for --incremental runs
+    processed_urls = None
+
+    def __init__(self, discovery_url, newsletter_archive, resp=None):
         """Create a new Newsletter instance
 
         It is expected that this is being created because the
@@ -296,53 +502,94 @@ class Newsletter(SABase, Base, Webpage):
         """
         # remember that a new Newsletter object/record is only created
         # if one doesn't already exist for the given url, which is
-        # why we immediately make a requests.get
-        resp = requests.get(discovery_url)
+        # why we immediately make a request
+        self.discovery_url = discovery_url
+        self.canonical_url = self.canonical(discovery_url)
+        if resp is None:
+            resp = self.fetcher.get(self.fetch_url(discovery_url))
 
-        self.full_html = resp.content.decode()
-        self.status = resp.status_code
-        self.url = resp.url
+        self.url = None
+        self.set_response(resp)
 
-        self.discovery_url = discovery_url
         self.nlaid = newsletter_archive.nlaid
 
-        self.bs = BeautifulSoup(self.full_html, 'html.parser')
+    @classmethod
+    def get_existing(cls, sess, newsletter_url):
+        if cls.url_index is not None and not cls.is_known(newsletter_url):
+            return None
+        return sess.query(cls).filter(cls.url_filter(newsletter_url)).first()
+
+    @classmethod
+    def exists(cls, sess, newsletter_url):
+        """like `get_existing() is not None`, without loading the row
+        """
+        if cls.url_index is not None and not cls.is_known(newsletter_url):
+            return False
+        return exists(sess.query(cls.nlid).filter(cls.url_filter(newsletter_url)))
 
     @classmethod
-    def ensure_and_get_newsletter(cls, sess, newsletter_url, newsletter_archive):
-        newsletter = sess.query(cls).filter(or_(
-            cls.discovery_url==newsletter_url,
-            cls.url==newsletter_url
-        )).one_or_none()
+    def ensure_and_get_newsletter(cls, sess, newsletter_url, newsletter_archive, resp=None):
+        newsletter = cls.get_existing(sess, newsletter_url)
 
         if newsletter is None:
-            newsletter = cls(newsletter_url, newsletter_archive)
-            # need to set html and text for new records, but we
-            # also need to call ensure_full_html_and_bs again
-            # below for existing records that don't have their
-            # bs set yet..
-            newsletter.ensure_full_html_and_bs(sess)
+            # fetches the page; see __init__
+            newsletter = cls(newsletter_url, newsletter_archive, resp=resp)
             sess.add(newsletter)
-            sess.commit()
-        newsletter.ensure_full_html_and_bs(sess)
+            cls.commit(sess)
+            cls.add_to_url_index(newsletter)
+        else:
+            # existing rows whose page wasn't stored
+            newsletter.ensure_full_html_and_bs(sess)
         return newsletter
 
-    def extract_article_urls(self, ignore_domains=list()):
-        all_urls = [
-            a.attrs['href']
-            for a in self.bs.find_all('a')
-            if 'href' in a.attrs
-        ]
+    @classmethod
+    def load_processed_urls(cls, sess, batch_size=10000):
+        cls.processed_urls = set()
+        query = sess.query(
+            cls.discovery_url, cls.url, cls.canonical_url,
+        ).filter(cls.articles_processed==True)
+        for row in stream(query, batch_size):
+            for url in row:
+                if url:
+                    cls.processed_urls.add(cls.canonical(url))
+
+    @classmethod
+    def is_processed(cls, newsletter_url):
+        """whether the newsletter is known to have been processed
+        completely. always False unless load_processed_urls was called.
+        """
+        if cls.processed_urls is None:
+            return False
+        return cls.canonical(newsletter_url) in cls.processed_urls
+
+    def mark_articles_processed(self, sess):
+        self.articles_processed = True
+        self.commit(sess)
+        if self.processed_urls is not None:
+            for url in (self.discovery_url, self.url, self.canonical_url):
+                if url:
+                    self.processed_urls.add(self.canonical(url))
+
+    def extract_article_urls(self, ignore_domains=DomainMatcher()):
+        all_urls = list(self.hrefs())
         all_urls = clean_urls(all_urls)
 
+        # links that only differ in tracking parameters etc. are
+        # the same article
+        unique_urls = dict()
         # only consider valid domains. e.g. ignore "mailto:..." links.
-        filtered_urls = sorted(set([
-            u for u in filter_urls_by_ignore_domains(all_urls, ignore_domains)
+        for url in sorted(set(u for u in all_urls if netloc(u))):
+            unique_urls.setdefault(Article.canonical(url), url)
+
+        # filtered by the canonical url, since that's the one that is
+        # fetched: a redirector link to an ignored domain is ignored too
+        canonical_urls = [
+            u for u in filter_urls_by_ignore_domains(unique_urls, ignore_domains)
             # confirm that it's a url with a real domain
             if netloc(u)
-        ]))
-        filtered_urls = filter_out_image_urls(filtered_urls)
-        return filtered_urls
+        ]
+        canonical_urls = filter_out_image_urls(canonical_urls)
+        return [unique_urls[u] for u in canonical_urls]
 
     def __str__(self):
         return '{}({})'.format(self.__class__.__name__, repr(self.url))
@@ -351,58 +598,71 @@ class Newsletter(SABase, Base, Webpage):
 
 class Article(SABase, Base, Webpage):
     __tablename__ = 'articles'
+    __table_args__ = (
+        Index('ix_articles_url', 'url', postgresql_using='hash'),
+        Index('ix_articles_discovery_url', 'discovery_url', postgresql_using='hash'),
+        Index('ix_articles_canonical_url', 'canonical_url', postgresql_using='hash'),
+    )
     aid = pkey('aid')
     discovery_url = Column('discovery_url', TEXT)
+    # discovery_url without tracking parameters etc.; see canonicalize.py
+    canonical_url = Column('canonical_url', TEXT)
 
     url = Column('url', Text)
-    full_text = Column('full_text', Text)
-    full_html = Column('full_html', TEXT)
+    _full_text = deferred(Column('full_text', Text))
+    full_text_hash = Column('full_text_hash', TEXT)
+    full_text = StoredText('_full_text', 'full_text_hash')
+    _full_html = deferred(Column('full_html', TEXT))
+    full_html_hash = Column('full_html_hash', TEXT)
+    full_html = StoredText('_full_html', 'full_html_hash')
     title = Column('title', TEXT)
     status = Column('status', Integer)
+    # set when extraction timed out, ran out of memory or crashed;
+    # full_text, full_html and title are null then
+    extraction_error = Column('extraction_error', TEXT)
 
     nlid = Column('nlid', Integer, ForeignKey('newsletters.nlid'))
     newsletter = relationship('Newsletter', backref='articles')
 
     @staticmethod
-    def __get_url_fulltext_fullhtml_title_statuscode(url):
-        resp = requests.get(url)
-        if resp is empty_response or not resp.content:
+    def get_url_fulltext_fullhtml_title_statuscode(url, resp=None):
+        if resp is None:
+            resp = Article.fetcher.get(url)
+        if fetch_failed(resp) or not resp.content:
             return None
+        extracted = Article.extractor.extract(*Article.extraction_args(url, resp))
+        return Article.contents_from_extraction(resp, extracted)
 
-        is_pdf = (
-            'Content-Type' in resp.headers
-            and 'application/pdf' in resp.headers['Content-Type']
+    @staticmethod
+    def extraction_args(url, resp):
+        """arguments for Article.extractor.submit()
+        """
+        return (
+            url,
+            resp.content,
+            resp.headers.get('Content-Type'),
+            default_logging_level,
         )
 
-        if is_pdf:
-            level_during = logging.WARNING
-            with timer() as runtime, temporary_log_level(level_during, default_logging_level):
-                full_html = full_text = pdf_bytes_to_content_string(resp.content)
-            # pdfminer.psparser.PSEOF
-            if full_html is None:
-                return None
-            full_text = full_text.replace(b'\x00'.decode(), '')
-            full_html = full_html.replace(b'\x00'.decode(), '')
-
-            total_seconds = runtime['seconds']
-            if total_seconds > 10:
-                logger.info("pdf conversion for url '{}' took {:.2f} seconds".format(url, total_seconds))
-
-            title = os.path.basename(url)
-        else:
-            article = newspaper.Article(url, fetch_images=False)
-            # apparently, newspaper3k is smart when it comes
-            # to encodings..
-            article.download(input_html=resp.content)
-            article.parse()
-            full_text = article.text.replace('\x00', '')
-            full_html = article.html.replace('\x00', '')
-            title = article.title.replace('\x00', '')
+    @staticmethod
+    def contents_from_extraction(resp, extracted):
+        """combine the output of extraction.extract_contents()
+        with the response it was extracted from
+        """
+        if extracted is None:
+            return None
+        full_text, full_html, title = extracted
         return resp.url, full_text, full_html, title, resp.status_code
 
     @classmethod
-    def create_new_article(cls, sess, discovery_url, newsletter, manual=False):
-        contents = cls.__get_url_fulltext_fullhtml_title_statuscode(discovery_url)
+    def create_new_article(cls, sess, discovery_url, newsletter, manual=False, contents=None, extraction_error=None, resp=None):
+        """`contents` may be passed in when the article was already
+        fetched and extracted, e.g. by the concurrent crawler, `resp`
+        when it was only fetched
+        """
+        canonical_url = cls.canonical(discovery_url)
+        if contents is None:
+            contents = cls.get_url_fulltext_fullhtml_title_statuscode(cls.fetch_url(discovery_url), resp=resp)
         if contents is None:
             return
         url, full_text, full_html, title, status_code = contents
@@ -410,31 +670,59 @@ class Article(SABase, Base, Webpage):
         self = cls()
         self.nlid = newsletter.nlid
         self.discovery_url = discovery_url
+        self.canonical_url = canonical_url
         self.status = status_code
+        self.extraction_error = extraction_error
 
         self.full_text = full_text
         self.url = url
         self.full_html = full_html
         self.title = title
 
-        sess.add(self)
-        sess.commit()
+        if cls.write_buffer is not None:
+            cls.write_buffer.add(self, keys=(self.url, self.discovery_url, self.canonical_url))
+        else:
+            sess.add(self)
+            sess.commit()
+        cls.add_to_url_index(self)
+        cls.metrics.inc('articles_stored')
         return self
 
+    @classmethod
+    def find_buffered(cls, discovery_url):
+        """the article if it's waiting in the write buffer
+        """
+        if cls.write_buffer is None:
+            return None
+        return (
+            cls.write_buffer.find(cls, discovery_url)
+            or cls.write_buffer.find(cls, cls.canonical(discovery_url))
+        )
+
+    @classmethod
+    def get_existing(cls, sess, discovery_url):
+        article = cls.find_buffered(discovery_url)
+        if article is not None:
+            return article
+        if cls.url_index is not None and not cls.is_known(discovery_url):
+            return None
+        return sess.query(cls).filter(cls.url_filter(discovery_url)).first()
+
+    @classmethod
+    def exists(cls, sess, discovery_url):
+        """like `get_existing() is not None`, without loading the row
+        """
+        if cls.find_buffered(discovery_url) is not None:
+            return True
+        if cls.url_index is not None and not cls.is_known(discovery_url):
+            return False
+        return exists(sess.query(cls.aid).filter(cls.url_filter(discovery_url)))
+
     @classmethod
     def ensure_and_get_article(cls, sess, discovery_url, newsletter):
-        articles = sess.query(cls).filter(or_(
-            cls.url==discovery_url,
-            cls.discovery_url==discovery_url,
-        )).all()
-        if articles:
-            article = articles[0]
-        else:
+        article = cls.get_existing(sess, discovery_url)
+        if article is None:
             article = cls.create_new_article(sess, discovery_url, newsletter)
-            if article is None:
-                return None
-            sess.add(article)
-            sess.commit()
         return article
 
     def __str__(self):
@@ -445,6 +733,122 @@ class Article(SABase, Base, Webpage):
     __repr__ = __str__
 
 
+def store_extracted_article(sess, discovery_url, newsletter, resp, future, verbose=False):
+    """store an article whose extraction was submitted to
+    Article.extractor
+
+    pathological pages that the pool gave up on are stored too, with
+    their extraction_error set, so that they aren't fetched again.
+    """
+    extraction_error = None
+    try:
+        contents = Article.contents_from_extraction(resp, future.result())
+    except ExtractionFailed as e:
+        Counter.extractions_failed += 1
+        logging.warning("extracting '{}' failed: {}".format(discovery_url, e))
+        extraction_error = str(e)
+        contents = resp.url, None, None, None, resp.status_code
+    if contents is None:
+        return None
+
+    # the same article may have been stored while this one was
+    # being extracted
+    article = Article.get_existing(sess, discovery_url)
+    if article is None:
+        article = Article.create_new_article(
+            sess, discovery_url, newsletter,
+            contents=contents, extraction_error=extraction_error,
+        )
+    if article and verbose:
+        print('\n', article.title, article.url)
+    return article
+
+
+def extraction_server_failed(discovery_url, error):
+    """the ExtractionServerError of an article, which isn't stored,
+    so that a later run fetches it again
+    """
+    Counter.extraction_server_errors += 1
+    logging.warning("not storing '{}', the extraction server failed: {}".format(discovery_url, error))
+
+
+class PendingArticles:
+    """Articles of the sequential crawl that are being extracted
+    by an extractor that works in the background
+
+    The crawl keeps downloading while the pool works, and stores the
+    finished articles itself because the session isn't thread safe.
+    At most `max_pending` downloaded articles are held in memory.
+
+    A newsletter is only marked processed once the last of its articles
+    is stored, so that a run that is killed in between crawls it again.
+    """
+    def __init__(self, extractor, max_pending):
+        self.extractor = extractor
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        # newsletter -> number of its articles in self.pending
+        self.num_pending = collections.Counter()
+        # newsletters to mark processed once none of their articles
+        # is pending
+        self.completed = set()
+        # newsletters an article of which couldn't be extracted because
+        # of the extraction server; they're never marked
+        self.failed = set()
+
+    def __contains__(self, discovery_url):
+        return discovery_url in self.pending
+
+    def submit(self, discovery_url, newsletter, resp):
+        future = self.extractor.submit(
+            *Article.extraction_args(Article.fetch_url(discovery_url), resp)
+        )
+        self.pending[discovery_url] = (newsletter, resp, future)
+        self.num_pending[newsletter] += 1
+
+    def mark_articles_processed(self, sess, newsletter):
+        """like newsletter.mark_articles_processed(), once its
+        pending articles are stored
+        """
+        if self.num_pending[newsletter]:
+            self.completed.add(newsletter)
+        elif newsletter not in self.failed:
+            newsletter.mark_articles_processed(sess)
+
+    def _stored(self, sess, newsletter):
+        self.num_pending[newsletter] -= 1
+        if self.num_pending[newsletter]:
+            return
+        del self.num_pending[newsletter]
+        if newsletter in self.completed:
+            self.completed.remove(newsletter)
+            if newsletter not in self.failed:
+                newsletter.mark_articles_processed(sess)
+
+    def store_finished(self, sess, wait=False, verbose=False):
+        while self.pending:
+            must_wait = wait or len(self.pending) > self.max_pending
+            finished = [
+                url for url, (newsletter, resp, future) in self.pending.items()
+                if future.done()
+            ]
+            if not finished:
+                if not must_wait:
+                    return
+                # the oldest one
+                finished = [next(iter(self.pending))]
+            for discovery_url in finished:
+                newsletter, resp, future = self.pending.pop(discovery_url)
+                try:
+                    store_extracted_article(
+                        sess, discovery_url, newsletter, resp, future, verbose=verbose,
+                    )
+                except ExtractionServerError as e:
+                    extraction_server_failed(discovery_url, e)
+                    self.failed.add(newsletter)
+                self._stored(sess, newsletter)
+
+
 def ensure_base_sources_in_db(sess, urls):
     do_query = lambda url: sess.query(NewsletterArchive).filter(NewsletterArchive.url == url).one_or_none()
     for url in urls:
@@ -455,19 +859,56 @@ def ensure_base_sources_in_db(sess, urls):
             nla = NewsletterArchive()
             nla.url = url
             sess.add(nla)
-            sess.commit()
+            NewsletterArchive.commit(sess)
     return sess.query(NewsletterArchive).filter(
         NewsletterArchive.url.in_(urls)
     )
 
 
+def url_index_filepath(url_index_dir, cls):
+    return os.path.join(url_index_dir, '{}.urlindex'.format(cls.__tablename__))
+
+
+def load_url_indexes(sess, url_index_dir=None):
+    """load the urls of all newsletters and articles into memory, so
+    that checking whether a link is known takes no query.
+    with `url_index_dir`, start from the indexes saved there and only
+    load the rows that were added since.
+    """
+    canonicalizer = Webpage.canonicalizer
+    for cls, id_col in ((Newsletter, Newsletter.nlid), (Article, Article.aid)):
+        url_index = None
+        if url_index_dir is not None:
+            filepath = url_index_filepath(url_index_dir, cls)
+            if os.path.exists(filepath):
+                # None if it was saved with other canonicalization rules
+                url_index = UrlIndex.load(
+                    filepath, canonicalizer.canonicalize, canonicalizer.fingerprint,
+                )
+        if url_index is None:
+            url_index = UrlIndex(canonicalizer.canonicalize, canonicalizer.fingerprint)
+        with timer() as runtime:
+            url_index.load_from_db(sess, id_col, [cls.url, cls.discovery_url, cls.canonical_url])
+        logging.info('loaded url index of {} urls for {} in {:.2f} seconds'.format(
+            len(url_index), cls.__tablename__, runtime['seconds'],
+        ))
+        cls.set_url_index(url_index)
+
+
+def save_url_indexes(url_index_dir):
+    os.makedirs(url_index_dir, exist_ok=True)
+    for cls in (Newsletter, Article):
+        if cls.url_index is not None:
+            cls.url_index.save(url_index_filepath(url_index_dir, cls))
+
+
 def netloc(url):
     return urllib.parse.urlparse(url).netloc
 
 
 def read_newsletter_archive_urls(filepath=None):
     if filepath is None:
-        filepath = os.path.join(this_dir, 'newsletter_archive_urls.txt')
+        filepath = newsletter_archive_urls_file
     with open(filepath, 'r') as fr:
         for line in fr:
             line = line.strip()
@@ -492,11 +933,446 @@ def convert_log_level_to_int(level):
     return None
 
 
-def run_main():
-    args = parse_cl_args()
+async def crawl_article_concurrently(sess, fetcher, discovered_article_url, newsletter, failed_newsletters, verbose=False):
+    """`newsletter` is added to `failed_newsletters` when the article
+    couldn't be fetched (see fetch_failed()) or extracted because of
+    the extraction server
+    """
+    # asyncio is only imported for --concurrency, like the fetcher
+    import asyncio
+    fetch_url = Article.fetch_url(discovered_article_url)
+    resp = await fetcher.fetch(fetch_url)
+    if fetch_failed(resp):
+        failed_newsletters.add(newsletter)
+        return None
+    if not resp.content:
+        return None
+
+    # newspaper/pdf parsing is cpu-bound, so it happens off of the
+    # event loop. the session is only ever used from the event loop.
+    future = Article.extractor.submit(
+        *Article.extraction_args(fetch_url, resp)
+    )
+    try:
+        await asyncio.wrap_future(future)
+    except ExtractionFailed:
+        # handled by store_extracted_article
+        pass
+    except ExtractionServerError as e:
+        extraction_server_failed(discovered_article_url, e)
+        failed_newsletters.add(newsletter)
+        return None
+    return store_extracted_article(
+        sess, discovered_article_url, newsletter, resp, future, verbose=verbose,
+    )
+
+
+async def crawl_archive_concurrently(sess, fetcher, newsletter_archive, ignore_domains, args):
+    import asyncio
+    resp = await fetcher.fetch(
+        newsletter_archive.url,
+        headers=newsletter_archive.conditional_headers(),
+    )
+    if resp is empty_response and not newsletter_archive.has_full_html():
+        return
+    newsletter_archive.refresh(sess, resp=resp)
+
+    # unique, but in the order they appear on the archive page
+    newsletter_urls = list(dict.fromkeys(newsletter_archive.extract_newsletter_urls()))
+    articles_per_archive = args.articles_per_archive
+    num_articles_this_archive = 0
+    seen_article_urls = set()
+
+    # newsletters are fetched one batch at a time so that
+    # --articles-per-archive and --requests-limit stop the crawl
+    # without downloading every newsletter page up front
+    batch_size = fetcher.concurrency
+    for batch_start in range(0, len(newsletter_urls), batch_size):
+        if fetcher.limit_reached:
+            return
+        if articles_per_archive and num_articles_this_archive >= articles_per_archive:
+            return
+        batch = [
+            url for url in newsletter_urls[batch_start:batch_start+batch_size]
+            if not Newsletter.is_processed(url)
+        ]
+
+        new_newsletter_urls = [
+            url for url in batch
+            if not Newsletter.exists(sess, url)
+        ]
+        responses = await fetcher.fetch_all(
+            Newsletter.fetch_url(url) for url in new_newsletter_urls
+        )
+        responses = {
+            url: responses[Newsletter.fetch_url(url)]
+            for url in new_newsletter_urls
+        }
+
+        article_jobs = list()
+        # newsletters all of whose article links got a job
+        completed_newsletters = list()
+        # and those of them some of whose articles couldn't be fetched
+        failed_newsletters = set()
+        for newsletter_url in batch:
+            resp = responses.get(newsletter_url)
+            if resp is empty_response:
+                continue
+            newsletter = Newsletter.ensure_and_get_newsletter(
+                sess, newsletter_url, newsletter_archive, resp=resp,
+            )
+            if newsletter.page_failed:
+                failed_newsletters.add(newsletter)
+            for discovered_article_url in newsletter.extract_article_urls(ignore_domains):
+                if discovered_article_url in seen_article_urls:
+                    continue
+                seen_article_urls.add(discovered_article_url)
+                # articles that are already in the database count
+                # towards the limit, same as in the sequential crawl
+                if articles_per_archive and num_articles_this_archive >= articles_per_archive:
+                    break
+                num_articles_this_archive += 1
+                if Article.is_known(discovered_article_url):
+                    continue
+                if Article.exists(sess, discovered_article_url):
+                    continue
+                article_jobs.append(crawl_article_concurrently(
+                    sess, fetcher, discovered_article_url,
+                    newsletter, failed_newsletters, verbose=args.verbose,
+                ))
+            else:
+                completed_newsletters.append(newsletter)
+
+        await asyncio.gather(*article_jobs)
+        # the requests limit may have cut some of the jobs short
+        if not fetcher.limit_reached:
+            for newsletter in completed_newsletters:
+                if newsletter not in failed_newsletters:
+                    newsletter.mark_articles_processed(sess)
+
+
+async def crawl_concurrently(sess, ignore_domains, args, http_cache=None, limits=None):
+    from chromatic_news.download_newsletter_archives.async_fetcher import AsyncFetcher
+    from chromatic_news.download_newsletter_archives.politeness import DomainScheduler
+
+    on_response = None
+    if args.update_ignore_domains_on_403:
+        on_response = lambda url, resp: ignore_domain_on_403(url, resp, ignore_domains)
+
+    fetcher = AsyncFetcher(
+        args.concurrency,
+        timeout_seconds=args.timeout_seconds,
+        counter=Counter,
+        requests_limit=args.requests_limit,
+        on_response=on_response,
+        failed_response=empty_response,
+        scheduler=DomainScheduler(
+            rate=args.per_domain_rate,
+            burst=args.per_domain_burst,
+            max_in_flight=args.per_domain_concurrency,
+            stats=Counter.domain_stats,
+        ),
+        max_retries=args.max_retries,
+        http_cache=http_cache,
+        metrics=Webpage.metrics,
+        limits=limits,
+    )
+    async with fetcher:
+        for newsletter_archive_url in read_newsletter_archive_urls():
+            if fetcher.limit_reached:
+                break
+            newsletter_archives = ensure_base_sources_in_db(sess, [newsletter_archive_url])
+            for newsletter_archive in newsletter_archives:
+                if fetcher.limit_reached:
+                    break
+                await crawl_archive_concurrently(
+                    sess, fetcher, newsletter_archive,
+                    ignore_domains, args,
+                )
+                Webpage.metrics.inc('archives_done')
+
+
+def crawl_sequentially(sess, ignore_domains, args):
     verbose = args.verbose
     requests_limit = args.requests_limit
     articles_per_archive = args.articles_per_archive
+    stop = False
+
+    pending_articles = None
+    if Article.extractor.capacity:
+        # keep downloading while the extractor works
+        pending_articles = PendingArticles(
+            Article.extractor, max_pending=2*Article.extractor.capacity,
+        )
+
+    for newsletter_archive_url in read_newsletter_archive_urls():
+        if stop:
+            break
+        # newsletter_archives get sess.add()ed here.
+        newsletter_archives = ensure_base_sources_in_db(sess, [newsletter_archive_url])
+        for newsletter_archive in newsletter_archives:
+            if stop:
+                break
+
+            num_articles_downloaded_this_archive = 0
+            finished_this_archive = False
+            newsletter_archive.refresh(sess)
+            newsletter_urls = newsletter_archive.extract_newsletter_urls()
+
+            for newsletter_url in newsletter_urls:
+                if stop:
+                    break
+                # enforce the articles-per-archive limit
+                if finished_this_archive:
+                    break
+                if Newsletter.is_processed(newsletter_url):
+                    continue
+
+                # first filter by site-specific thingies..
+                newsletter = Newsletter.ensure_and_get_newsletter(sess, newsletter_url, newsletter_archive)
+                filtered_article_urls = newsletter.extract_article_urls(ignore_domains)
+                # its page or some of its articles couldn't be fetched;
+                # see fetch_failed()
+                newsletter_failed = newsletter.page_failed
+
+                for i, discovered_article_url in enumerate(filtered_article_urls):
+
+                    try:
+                        if Article.is_known(discovered_article_url):
+                            # already in the database; no need to load it
+                            article = None
+                        elif pending_articles is None:
+                            article = Article.get_existing(sess, discovered_article_url)
+                            if article is None:
+                                resp = Article.fetcher.get(Article.fetch_url(discovered_article_url))
+                                newsletter_failed = newsletter_failed or fetch_failed(resp)
+                                article = Article.create_new_article(
+                                    sess, discovered_article_url, newsletter, resp=resp,
+                                )
+                        else:
+                            article = None
+                            if discovered_article_url not in pending_articles and not Article.exists(sess, discovered_article_url):
+                                resp = Article.fetcher.get(Article.fetch_url(discovered_article_url))
+                                if fetch_failed(resp):
+                                    newsletter_failed = True
+                                elif resp.content:
+                                    pending_articles.submit(discovered_article_url, newsletter, resp)
+                            pending_articles.store_finished(sess, verbose=verbose)
+                    except Exception as e:
+                        if args.debug:
+                            print('Caught Exception:', e)
+                            try:
+                                import ipdb as pdb
+                            except ImportError:
+                                import pdb
+                            pdb.set_trace()
+                            article = Article.ensure_and_get_article(sess, discovered_article_url, newsletter)
+                        else:
+                            raise
+
+                    # enforce articles-per-archive limit
+                    if articles_per_archive:
+                        num_articles_downloaded_this_archive += 1
+                        finished_this_archive = num_articles_downloaded_this_archive > articles_per_archive
+                        if finished_this_archive:
+                            break
+
+                    if article and verbose and pending_articles is None:
+                        print('\n', article.title, article.url)
+                    if requests_limit and Counter.requests_total >= requests_limit:
+                        stop = True
+                        break
+                else:
+                    if newsletter_failed:
+                        logging.info('not marking {} processed: its page or some of its articles could not be fetched'.format(newsletter))
+                    elif pending_articles is None:
+                        newsletter.mark_articles_processed(sess)
+                    else:
+                        pending_articles.mark_articles_processed(sess, newsletter)
+            if not stop:
+                Webpage.metrics.inc('archives_done')
+
+    if pending_articles is not None:
+        pending_articles.store_finished(sess, wait=True, verbose=verbose)
+
+
+def crawl_frontier_entry(sess, frontier, entry, ignore_domains, verbose=False):
+    """crawl one claimed entry and add the urls it leads to. returns
+    the error if it failed, otherwise None
+    """
+    if entry.kind == ARCHIVE:
+        newsletter_archive = ensure_base_sources_in_db(sess, [entry.url]).first()
+        newsletter_archive.refresh(sess)
+        if not newsletter_archive.has_full_html():
+            return 'archive page could not be fetched'
+        frontier.add(newsletter_archive.extract_newsletter_urls(), NEWSLETTER, parent_url=entry.url)
+        Webpage.metrics.inc('archives_done')
+
+    elif entry.kind == NEWSLETTER:
+        newsletter_archive = sess.query(NewsletterArchive).filter(
+            NewsletterArchive.url == entry.parent_url
+        ).first()
+        newsletter = Newsletter.ensure_and_get_newsletter(sess, entry.url, newsletter_archive)
+        if newsletter.page_failed:
+            return 'newsletter page could not be fetched'
+        frontier.add(newsletter.extract_article_urls(ignore_domains), ARTICLE, parent_url=entry.url)
+
+    elif entry.kind == ARTICLE:
+        if Article.is_known(entry.url) or Article.exists(sess, entry.url):
+            return None
+        newsletter = Newsletter.get_existing(sess, entry.parent_url)
+        fetch_url = Article.fetch_url(entry.url)
+        resp = Article.fetcher.get(fetch_url)
+        if fetch_failed(resp) or not resp.content:
+            return 'article could not be fetched'
+        # like in the other crawl modes, an article whose extraction
+        # failed is stored with its extraction_error
+        future = Article.extractor.submit(*Article.extraction_args(fetch_url, resp))
+        article = store_extracted_article(sess, entry.url, newsletter, resp, future, verbose=verbose)
+        if article is None:
+            return 'article has no content'
+    return None
+
+
+def crawl_from_frontier(sess, ignore_domains, args):
+    """crawl the urls of the frontier table until it's empty; see
+    frontier.py. any number of these may run at once, on any host
+    that reaches the database.
+    """
+    frontier = Frontier(
+        sess, FrontierUrl.__table__,
+        canonicalize=Webpage.canonical,
+        worker_id=args.worker_id,
+        lease_seconds=args.frontier_lease_seconds,
+        max_attempts=args.frontier_max_attempts,
+    )
+    frontier.add(read_newsletter_archive_urls(), ARCHIVE)
+    sess.commit()
+    if args.frontier_refresh_archives:
+        frontier.reset(kind=ARCHIVE)
+    # entries of an earlier run with the same --worker-id, which was
+    # killed, needn't wait for their lease to expire
+    frontier.release()
+
+    requests_limit = args.requests_limit
+    while not (requests_limit and Counter.requests_total >= requests_limit):
+        entries = frontier.claim(args.frontier_batch_size)
+        if not entries:
+            if frontier.is_finished():
+                break
+            # other workers are still on entries that may lead to more
+            time.sleep(args.frontier_poll_seconds)
+            continue
+
+        for entry in entries:
+            try:
+                error = crawl_frontier_entry(sess, frontier, entry, ignore_domains, verbose=args.verbose)
+                retry = True
+            except ExtractionServerError as e:
+                # says nothing about the page, so it's tried again
+                extraction_server_failed(entry.url, e)
+                sess.rollback()
+                error, retry = str(e), True
+            except Exception as e:
+                logging.exception("crawling '{}' failed".format(entry.url))
+                sess.rollback()
+                error, retry = repr(e), True
+            # the pages the entry stored are committed as they're
+            # created, and only the urls it added are committed with
+            # its mark. a worker killed in between leaves the entry in
+            # progress; crawled again, it finds its archive, newsletter
+            # or article in the database instead of storing it twice,
+            # and the urls are added again
+            if error is None:
+                frontier.done(entry)
+            else:
+                frontier.fail(entry, error, retry=retry)
+            sess.commit()
+            Webpage.metrics.inc(
+                'frontier_entries', kind=entry.kind,
+                result='done' if error is None else 'failed',
+            )
+    return frontier
+
+
+def print_frontier_counts(frontier):
+    counts = frontier.counts()
+    for kind in (ARCHIVE, NEWSLETTER, ARTICLE):
+        states = {state: count for (k, state), count in counts.items() if k == kind}
+        if states:
+            print('frontier {}s: {}'.format(kind, ', '.join(
+                '{} {}'.format(count, state) for state, count in sorted(states.items())
+            )))
+
+
+def required_blob_store(value):
+    """argparse type of --blob-store for the scripts that read or move
+    bodies in the blob store, where "none" makes no sense
+    """
+    if value == 'none':
+        raise argparse.ArgumentTypeError('needs a blob store: db or a directory')
+    return value
+
+
+def make_blob_store(sess, args):
+    compressor = Compressor(level=args.compression_level)
+    if args.compression_dictionary:
+        compressor = Compressor.from_dictionary_file(
+            args.compression_dictionary, level=args.compression_level,
+        )
+    if args.blob_store == 'db':
+        return DatabaseBlobStore(sess, Blob.__table__, compressor)
+    return DirectoryBlobStore(args.blob_store, compressor)
+
+
+def make_download_limits(args):
+    megabytes = lambda mb: int(mb * 1024 * 1024) or None
+    content_types = None
+    if not args.download_all_content_types:
+        content_types = DownloadLimits().content_types
+    return DownloadLimits(
+        max_bytes=megabytes(args.max_download_mb),
+        max_pdf_bytes=megabytes(args.max_pdf_mb),
+        spool_bytes=megabytes(args.spool_pdf_mb),
+        content_types=content_types,
+    )
+
+
+def make_extractor(args):
+    extractor = args.extractor
+    if extractor is None:
+        if args.extraction_server:
+            extractor = 'remote'
+        elif args.extraction_processes:
+            extractor = 'pool'
+        else:
+            extractor = 'inline'
+
+    if extractor == 'remote':
+        if not args.extraction_server:
+            print("--extractor remote needs --extraction-server; exiting")
+            exit(1)
+        return RemoteExtractor(
+            args.extraction_server,
+            concurrency=args.extraction_server_concurrency,
+            batch_size=args.extraction_server_batch_size,
+            timeout_seconds=args.extraction_timeout_seconds,
+            metrics=Webpage.metrics,
+        )
+    if extractor == 'pool':
+        return PoolExtractor(ExtractionPool(
+            processes=args.extraction_processes or None,
+            timeout_seconds=args.extraction_timeout_seconds,
+            memory_limit_mb=args.extraction_memory_limit_mb,
+        ), metrics=Webpage.metrics)
+    # the concurrent crawl mustn't parse on its event loop
+    threads = args.concurrency if args.concurrency > 1 else 0
+    return InlineExtractor(threads=threads, metrics=Webpage.metrics)
+
+
+def run_main():
+    global ignore_domains_file, newsletter_archive_urls_file
+    args = parse_cl_args()
 
     log_level = convert_log_level_to_int(args.log_level)
     if log_level is None:
@@ -505,79 +1381,134 @@ def run_main():
     logging.disable(log_level)
     logging.basicConfig(level=log_level)
 
+    if args.concurrency < 1:
+        print("--concurrency must be at least 1; exiting")
+        exit(1)
+    if args.concurrency > 1 and (args.interactive or args.debug):
+        print("--interactive and --debug can't be used with --concurrency; exiting")
+        exit(1)
+    if args.concurrency > 1 and args.frontier:
+        print("--frontier scales by running more workers, not with --concurrency; exiting")
+        exit(1)
+    if args.articles_per_archive and args.frontier:
+        print("--frontier crawls every archive completely, it has no --articles-per-archive; exiting")
+        exit(1)
+    if args.articles_per_archive is None:
+        args.articles_per_archive = 25
+
+    if args.db:
+        use_database(args.db)
+    if args.newsletter_archive_urls:
+        newsletter_archive_urls_file = args.newsletter_archive_urls
+    if args.ignore_domains:
+        ignore_domains_file = args.ignore_domains
+
+    metrics = Metrics()
+    Webpage.set_metrics(metrics)
+
     ignore_domains = load_ignore_domains()
+    if os.path.exists(canonicalization_rules_file):
+        Webpage.set_canonicalizer(Canonicalizer.from_file(canonicalization_rules_file))
+
+    http_cache = None
+    if args.http_cache:
+        http_cache = HttpCache(
+            args.http_cache,
+            max_bytes=args.http_cache_size_mb * 1024 * 1024,
+        )
 
-    # modify behavior of requests.get
-    requests.get = modify_get_request(
-        requests.get,
-        interactive=args.interactive,
+    on_response = None
+    if args.update_ignore_domains_on_403:
+        on_response = lambda url, resp: ignore_domain_on_403(url, resp, ignore_domains)
+
+    limits = make_download_limits(args)
+    fetcher = Fetcher(
         timeout_seconds=args.timeout_seconds,
-        update_ignore_domains_on_403=args.update_ignore_domains_on_403,
-        ignore_domains=ignore_domains,
+        counter=Counter,
+        on_response=on_response,
+        failed_response=empty_response,
+        http_cache=http_cache,
+        interactive=args.interactive,
+        connections_per_host=args.connections_per_host,
+        http2=args.http2,
+        metrics=metrics,
+        limits=limits,
     )
+    Webpage.set_fetcher(fetcher)
 
+    engine = get_engine()
     Base.set_sess(engine)
     # drop_tables(SABase)
     create_tables(engine, SABase, schema_name)
-    stop = False
+    extractor = make_extractor(args)
+    Webpage.set_extractor(extractor)
 
-    with Base.get_session() as sess:
-        for newsletter_archive_url in read_newsletter_archive_urls():
-            if stop:
-                break
-            # newsletter_archives get sess.add()ed here.
-            newsletter_archives = ensure_base_sources_in_db(sess, [newsletter_archive_url])
-            for newsletter_archive in newsletter_archives:
-                if stop:
-                    break
-
-                num_articles_downloaded_this_archive = 0
-                finished_this_archive = False
-                newsletter_archive.ensure_full_html_and_bs(sess)
-                newsletter_urls = newsletter_archive.extract_newsletter_urls()
-
-                for newsletter_url in newsletter_urls:
-                    if stop:
-                        break
-                    # enforce the articles-per-archive limit
-                    if finished_this_archive:
-                        break
-
-                    # first filter by site-specific thingies..
-                    newsletter = Newsletter.ensure_and_get_newsletter(sess, newsletter_url, newsletter_archive)
-                    filtered_article_urls = newsletter.extract_article_urls(ignore_domains)
-
-                    for i, discovered_article_url in enumerate(filtered_article_urls):
-
-                        try:
-                            article = Article.ensure_and_get_article(sess, discovered_article_url, newsletter)
-                        except Exception as e:
-                            if args.debug:
-                                print('Caught Exception:', e)
-                                try:
-                                    import ipdb as pdb
-                                except ImportError:
-                                    import pdb
-                                pdb.set_trace()
-                                article = Article.ensure_and_get_article(sess, discovered_article_url, newsletter)
-                            else:
-                                raise
-
-                        # enforce articles-per-archive limit
-                        if articles_per_archive:
-                            num_articles_downloaded_this_archive += 1
-                            finished_this_archive = num_articles_downloaded_this_archive > articles_per_archive
-                            if finished_this_archive:
-                                break
-
-                        if article and verbose:
-                            print('\n', article.title, article.url)
-                        if requests_limit and Counter.requests_total >= requests_limit:
-                            stop = True
-                            break
+    try:
+        with Base.get_session() as sess:
+            write_buffer = None
+            # the frontier commits every entry with the rows it produced
+            if args.db_batch_size > 1 and not args.frontier:
+                write_buffer = WriteBuffer(
+                    sess,
+                    batch_size=args.db_batch_size,
+                    flush_interval_seconds=args.db_flush_seconds,
+                    metrics=metrics,
+                )
+                Base.set_write_buffer(write_buffer)
+            if args.url_index:
+                load_url_indexes(sess, args.url_index_dir)
+            if args.incremental:
+                Newsletter.load_processed_urls(sess)
+            if args.blob_store is not None:
+                Webpage.set_blob_store(make_blob_store(sess, args))
+            progress = contextlib.nullcontext()
+            if args.progress_seconds:
+                progress = Progress(
+                    metrics, Counter,
+                    interval_seconds=args.progress_seconds,
+                    requests_limit=args.requests_limit,
+                    archives_total=len(list(read_newsletter_archive_urls())),
+                )
+            frontier = None
+            try:
+                with progress:
+                    if args.frontier:
+                        frontier = crawl_from_frontier(sess, ignore_domains, args)
+                    elif args.concurrency > 1:
+                        import asyncio
+                        asyncio.run(crawl_concurrently(sess, ignore_domains, args, http_cache, limits))
+                    else:
+                        crawl_sequentially(sess, ignore_domains, args)
+            finally:
+                if write_buffer is not None:
+                    write_buffer.flush()
+                    Base.set_write_buffer(None)
+                if args.url_index and args.url_index_dir:
+                    save_url_indexes(args.url_index_dir)
+            if frontier is not None:
+                print_frontier_counts(frontier)
+    finally:
+        fetcher.close()
+        extractor.close()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
 
     print('{} requests attempted'.format(Counter.requests_total))
     print('{} requests successful'.format(Counter.requests_successful))
+    if Counter.extractions_failed:
+        print('{} extractions failed'.format(Counter.extractions_failed))
+    if Counter.extraction_server_errors:
+        print('{} articles not stored because the extraction server failed'.format(
+            Counter.extraction_server_errors,
+        ))
+    if http_cache is not None:
+        print('{} responses served from the http cache'.format(http_cache.hits))
+        http_cache.close()
+    for domain, domain_stats in sorted(Counter.domain_stats.items()):
+        print('{}: {}'.format(domain, domain_stats))
+    print('{:.1f} MB downloaded'.format(metrics.value('fetch_bytes') / 1024 / 1024))
+    for line in metrics.summary():
+        print(line)
 
     success = True
     return success
@@ -620,13 +1551,227 @@ def parse_cl_args():
         '--timeout-seconds', default=10, type=int,
         help="timeout seconds, default %(default)s",
     )
+    argParser.add_argument(
+        '--db', default=None, metavar='URL',
+        help="database url to use instead of the one in config.py,\n"
+            "e.g. sqlite:///chromatic.db",
+    )
+    argParser.add_argument(
+        '--newsletter-archive-urls', default=None, metavar='FILE',
+        help="read the archive urls from FILE instead of\n"
+            "newsletter_archive_urls.txt",
+    )
+    argParser.add_argument(
+        '--ignore-domains', default=None, metavar='FILE',
+        help="use FILE instead of ignore_domains.txt",
+    )
     argParser.add_argument(
         '--update-ignore-domains-on-403', default=False, action='store_true',
         help="when a url returns a 403 (forbidden), add the domain to the ignore_domains.txt file",
     )
     argParser.add_argument(
-        '--articles-per-archive', default=25, type=int,
-        help="download a different number of articles per archive; default %(default)s; use 0 for no limit",
+        '--articles-per-archive', default=None, type=int,
+        help="download a different number of articles per archive; default 25; use 0 for no limit.\n"
+            "--frontier crawls every archive completely",
+    )
+    argParser.add_argument(
+        '--concurrency', default=1, type=int,
+        help="number of requests to have in flight at once. values\n"
+            "above 1 use the asyncio crawler (requires aiohttp).\n"
+            "default %(default)s",
+    )
+    argParser.add_argument(
+        '--db-batch-size', default=1, type=int,
+        help="insert new articles this many at a time, committing after\n"
+            "each batch; a killed run loses at most one batch.\n"
+            "default %(default)s, which commits every row as it's created",
+    )
+    argParser.add_argument(
+        '--db-flush-seconds', default=30, type=int,
+        help="with --db-batch-size, also insert and commit whatever\n"
+            "is buffered after this many seconds. default %(default)s",
+    )
+    argParser.add_argument(
+        '--connections-per-host', default=10, type=int,
+        help="keep-alive connections kept open per host. default %(default)s",
+    )
+    argParser.add_argument(
+        '--http2', action='store_true',
+        help="use http/2 where the server supports it (requires\n"
+            "httpx with http2 support)",
+    )
+    argParser.add_argument(
+        '--max-download-mb', default=10, type=float,
+        help="don't download pages bigger than this, judged by their\n"
+            "Content-Length or, without one, while they download.\n"
+            "0 for no limit. default %(default)s",
+    )
+    argParser.add_argument(
+        '--max-pdf-mb', default=50, type=float,
+        help="like --max-download-mb, for pdfs. default %(default)s",
+    )
+    argParser.add_argument(
+        '--spool-pdf-mb', default=5, type=float,
+        help="write pdfs bigger than this to a temporary file while\n"
+            "they download and are parsed, instead of keeping them in\n"
+            "memory. 0 never does. default %(default)s",
+    )
+    argParser.add_argument(
+        '--download-all-content-types', action='store_true',
+        help="download responses of any Content-Type; by default only\n"
+            "html, text, xml and pdf are, so that e.g. videos and images\n"
+            "behind urls without an extension aren't downloaded",
+    )
+    argParser.add_argument(
+        '--blob-store', default='none', metavar='db|none|DIR',
+        type=lambda s: None if s == 'none' else s,
+        help="where new page bodies are stored: uncompressed in the rows\n"
+            "themselves (none), or compressed and deduplicated in the\n"
+            "blobs table (db) or a directory, where only readers that go\n"
+            "through the models (or the blob store) find them. default none",
+    )
+    argParser.add_argument(
+        '--compression-level', default=None, type=int,
+        help="zstd (or zlib) compression level for the blob store",
+    )
+    argParser.add_argument(
+        '--compression-dictionary', default=None, metavar='FILE',
+        help="zstd dictionary to compress with; see compress_pages.py",
+    )
+    argParser.add_argument(
+        '--incremental', action='store_true',
+        help="skip newsletters whose articles were all processed by an\n"
+            "earlier run, without loading or parsing them",
+    )
+    argParser.add_argument(
+        '--http-cache', default=None, metavar='FILE',
+        help="keep responses that have an ETag or Last-Modified header\n"
+            "in this sqlite file, and request them conditionally after",
+    )
+    argParser.add_argument(
+        '--http-cache-size-mb', default=512, type=int,
+        help="with --http-cache, evict the least recently used responses\n"
+            "above this size. default %(default)s",
+    )
+    argParser.add_argument(
+        '--no-url-index', dest='url_index', default=True, action='store_false',
+        help="don't load the urls of all newsletters and articles into\n"
+            "memory at startup; look every link up in the database instead",
+    )
+    argParser.add_argument(
+        '--url-index-dir', default=None,
+        help="save the url index in this directory at the end of the run\n"
+            "and load it from there at the next startup",
+    )
+    argParser.add_argument(
+        '--progress-seconds', default=30, type=float,
+        help="print the progress of the crawl this often; 0 turns it\n"
+            "off. default %(default)s",
+    )
+    argParser.add_argument(
+        '--metrics-file', default=None, metavar='FILE',
+        help="at the end of the run, write timings and counts of every\n"
+            "stage to FILE: json if it ends in .json, otherwise in\n"
+            "Prometheus' text format (e.g. for node_exporter's textfile\n"
+            "collector, which wants a .prom file)",
+    )
+    argParser.add_argument(
+        '--extractor', default=None, choices=['inline', 'pool', 'remote'],
+        help="how articles are parsed: inline, in a pool of worker\n"
+            "processes (--extraction-processes) or by an html_to_fulltext\n"
+            "server (--extraction-server). by default, remote if a server\n"
+            "is given, pool with --extraction-processes, otherwise inline",
+    )
+    argParser.add_argument(
+        '--extraction-server', default=None, metavar='URL',
+        help="html_to_fulltext server to parse articles with,\n"
+            "e.g. http://localhost:7295",
+    )
+    argParser.add_argument(
+        '--extraction-server-concurrency', default=8, type=int,
+        help="with --extraction-server, send up to this many requests\n"
+            "at once. default %(default)s",
+    )
+    argParser.add_argument(
+        '--extraction-server-batch-size', default=16, type=int,
+        help="with --extraction-server, send up to this many articles\n"
+            "per request. default %(default)s",
+    )
+    argParser.add_argument(
+        '--extraction-processes', default=0, type=int,
+        help="parse articles and pdfs in this many worker processes\n"
+            "while downloading continues. default %(default)s parses\n"
+            "them inline",
+    )
+    argParser.add_argument(
+        '--extraction-timeout-seconds', default=60, type=int,
+        help="with the pool or remote extractor, give up on an article\n"
+            "whose extraction takes longer than this. default %(default)s",
+    )
+    argParser.add_argument(
+        '--extraction-memory-limit-mb', default=None, type=int,
+        help="with --extraction-processes, give up on an article whose\n"
+            "extraction needs more memory than this. default: no limit",
+    )
+    argParser.add_argument(
+        '--frontier', action='store_true',
+        help="crawl from the frontier table instead of walking the\n"
+            "archives in this process: urls are claimed in batches and\n"
+            "marked done as their rows are stored, so a killed run\n"
+            "resumes where it stopped, and any number of workers can\n"
+            "crawl the same database at once. see frontier.py",
+    )
+    argParser.add_argument(
+        '--worker-id', default=None,
+        help="with --frontier, the name this worker leases urls under.\n"
+            "a restarted worker with the same id takes its urls back at\n"
+            "once instead of after their lease expires. default host:pid",
+    )
+    argParser.add_argument(
+        '--frontier-batch-size', default=10, type=int,
+        help="with --frontier, urls claimed at a time. default %(default)s",
+    )
+    argParser.add_argument(
+        '--frontier-lease-seconds', default=600, type=int,
+        help="with --frontier, other workers take over urls claimed by a\n"
+            "worker that hasn't finished them after this long.\n"
+            "default %(default)s",
+    )
+    argParser.add_argument(
+        '--frontier-max-attempts', default=3, type=int,
+        help="with --frontier, a url that failed or whose lease expired\n"
+            "this many times is marked failed. default %(default)s",
+    )
+    argParser.add_argument(
+        '--frontier-poll-seconds', default=5, type=float,
+        help="with --frontier, how often a worker without urls checks\n"
+            "whether other workers added any. default %(default)s",
+    )
+    argParser.add_argument(
+        '--frontier-refresh-archives', action='store_true',
+        help="with --frontier, crawl the archives again for new\n"
+            "newsletters; otherwise archives that were done stay done",
+    )
+    argParser.add_argument(
+        '--per-domain-rate', default=2.0, type=float,
+        help="with --concurrency, maximum requests per second to any one\n"
+            "domain. default %(default)s",
+    )
+    argParser.add_argument(
+        '--per-domain-burst', default=1, type=int,
+        help="with --concurrency, number of requests to one domain that\n"
+            "may be sent back to back before --per-domain-rate applies.\n"
+            "default %(default)s",
+    )
+    argParser.add_argument(
+        '--per-domain-concurrency', default=2, type=int,
+        help="with --concurrency, maximum requests in flight to any one\n"
+            "domain. default %(default)s",
+    )
+    argParser.add_argument(
+        '--max-retries', default=3, type=int,
+        help="with --concurrency, number of times a request that got a 429\n"
+            "or 503 is retried after backing off. default %(default)s",
     )
 
     args = argParser.parse_args()
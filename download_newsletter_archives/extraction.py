@@ -0,0 +1,602 @@
+"""Turning downloaded article bytes into text
+
+extract_contents() is what Article uses to get the full text, html and
+title out of a response. It can be run inline, or in an
+ExtractionPool so that slow pdf and newspaper parsing happens on all
+cores while the crawler keeps downloading.
+
+The crawler doesn't call it directly but goes through an extractor:
+InlineExtractor, PoolExtractor or RemoteExtractor, which sends pages to
+an html_to_fulltext server (see html_to_fulltext_server/) so that
+parsing can run on other machines. They all have the same interface:
+
+    future = extractor.submit(url, content, content_type)
+    full_text, full_html, title = future.result()
+
+newspaper and the pdf libraries take long to import, so they're only
+imported once the first page of their kind is extracted, in the process
+that extracts it.
+"""
+import collections
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+from chromatic_news.download_newsletter_archives.metrics import Metrics
+
+try:
+    import resource
+except ImportError:
+    # not available on windows; memory limits are skipped there
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def temporary_log_level(level_during, level_after):
+    """
+    the main purpose of this is to silence the thousands of
+    logging messages created by slate and PDFMiner
+    """
+    logging.disable(level_during-10)
+    yield
+    logging.basicConfig(level=level_after)
+
+
+def pdf_bytes_to_content_string(bytes_content):
+    """`bytes_content` is the pdf's bytes, or a
+    download_limits.SpooledContent when a big one was written to a file
+    """
+    import pdfminer.psparser
+    import slate
+
+    # can't do
+    # bytes_content = bytes_content.replace(b'\x00', b'')
+    # to fix the \x00 error because:
+    # pdfminer.pdfparser.PDFSyntaxError: stream with no endstream
+
+    if isinstance(bytes_content, bytes):
+        # shares the bytes instead of copying them
+        pdf_file = BytesIO(bytes_content)
+    else:
+        pdf_file = bytes_content.open()
+    # note that this is a very cpu-intensive
+    # line: parsing a pdf.
+    with pdf_file:
+        try:
+            pdf = slate.PDF(pdf_file)
+        except pdfminer.psparser.PSEOF:
+            return None
+    return pdf.text()
+
+
+def is_pdf_content_type(content_type):
+    return content_type is not None and 'application/pdf' in content_type
+
+
+def extract_contents(url, content, content_type=None, log_level_after=logging.DEBUG):
+    """Return (full_text, full_html, title), or None if the
+    content couldn't be parsed
+    """
+    if is_pdf_content_type(content_type):
+        level_during = logging.WARNING
+        start = time.time()
+        with temporary_log_level(level_during, log_level_after):
+            full_html = full_text = pdf_bytes_to_content_string(content)
+        total_seconds = time.time() - start
+        # pdfminer.psparser.PSEOF
+        if full_html is None:
+            return None
+        full_text = full_text.replace(b'\x00'.decode(), '')
+        full_html = full_html.replace(b'\x00'.decode(), '')
+
+        if total_seconds > 10:
+            logger.info("pdf conversion for url '{}' took {:.2f} seconds".format(url, total_seconds))
+
+        title = os.path.basename(url)
+    else:
+        import newspaper
+        article = newspaper.Article(url, fetch_images=False)
+        # apparently, newspaper3k is smart when it comes
+        # to encodings..
+        article.download(input_html=content)
+        article.parse()
+        full_text = article.text.replace('\x00', '')
+        full_html = article.html.replace('\x00', '')
+        title = article.title.replace('\x00', '')
+    return full_text, full_html, title
+
+
+class ExtractionFailed(Exception):
+    """An extraction job timed out, ran out of memory or crashed
+    """
+
+
+def _limit_memory(memory_limit_bytes):
+    if memory_limit_bytes and resource is not None:
+        resource.setrlimit(
+            resource.RLIMIT_AS,
+            (memory_limit_bytes, memory_limit_bytes),
+        )
+
+
+def _worker_main(conn, memory_limit_bytes):
+    _limit_memory(memory_limit_bytes)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        job_id, func, args = job
+        try:
+            result = (job_id, True, func(*args))
+        except MemoryError:
+            # the address space may be too fragmented to keep
+            # going, so let the pool start a fresh worker
+            conn.send((job_id, False, 'ran out of memory'))
+            return
+        except Exception as e:
+            result = (job_id, False, '{}: {}'.format(type(e).__name__, e))
+        conn.send(result)
+
+
+class _Worker:
+    def __init__(self, ctx, memory_limit_bytes):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.deadline = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ExtractionPool:
+    """Process pool with a timeout and a memory ceiling per job
+
+    Unlike multiprocessing.Pool, a job that runs past its timeout
+    has its worker process killed and replaced, so a pathological pdf
+    can't hold up the pool. Failed jobs resolve their future with
+    ExtractionFailed.
+
+    usage:
+        with ExtractionPool(processes=4, timeout_seconds=60) as pool:
+            future = pool.submit(extract_contents, url, content, content_type)
+            contents = future.result()
+    """
+    def __init__(self, processes=None, timeout_seconds=60, memory_limit_mb=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.timeout_seconds = timeout_seconds
+        self.memory_limit_bytes = None
+        if memory_limit_mb:
+            self.memory_limit_bytes = memory_limit_mb * 1024 * 1024
+        # spawn rather than fork: the crawler has threads and an open
+        # database connection that shouldn't be copied into workers
+        self.ctx = multiprocessing.get_context('spawn')
+
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.next_job_id = 0
+        self.closed = False
+        self.wakeup_r, self.wakeup_w = self.ctx.Pipe(duplex=False)
+        self.workers = [
+            _Worker(self.ctx, self.memory_limit_bytes)
+            for _ in range(self.processes)
+        ]
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, func, *args):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot submit to a pool that was shut down')
+            self.pending.append((self.next_job_id, func, args, future))
+            self.next_job_id += 1
+        self.wakeup_w.send(None)
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs; with wait=True, finish the ones
+        already submitted first
+        """
+        with self.lock:
+            self.closed = True
+            if not wait:
+                while self.pending:
+                    self.pending.popleft()[3].cancel()
+        self.wakeup_w.send(None)
+        self.dispatcher.join()
+
+    def _replace(self, worker, error):
+        if worker.job is not None:
+            job_id, func, args, future = worker.job
+            future.set_exception(ExtractionFailed(error))
+        worker.kill()
+        index = self.workers.index(worker)
+        self.workers[index] = _Worker(self.ctx, self.memory_limit_bytes)
+
+    def _assign_pending(self):
+        for worker in self.workers:
+            if worker.job is not None:
+                continue
+            with self.lock:
+                if not self.pending:
+                    return
+                job = self.pending.popleft()
+            job_id, func, args, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            worker.job = job
+            worker.deadline = time.monotonic() + self.timeout_seconds
+            try:
+                worker.conn.send((job_id, func, args))
+            except (OSError, EOFError):
+                self._replace(worker, 'worker process died')
+
+    def _dispatch(self):
+        while True:
+            self._assign_pending()
+            busy = [w for w in self.workers if w.job is not None]
+            with self.lock:
+                if self.closed and not busy and not self.pending:
+                    break
+
+            timeout = None
+            if busy:
+                timeout = max(0, min(w.deadline for w in busy) - time.monotonic())
+            ready = multiprocessing.connection.wait(
+                [self.wakeup_r] + [w.conn for w in busy],
+                timeout=timeout,
+            )
+
+            if self.wakeup_r in ready:
+                while self.wakeup_r.poll():
+                    self.wakeup_r.recv()
+
+            for worker in busy:
+                if worker.conn not in ready:
+                    continue
+                try:
+                    job_id, ok, result = worker.conn.recv()
+                except (EOFError, OSError):
+                    # most likely killed by the kernel for using
+                    # too much memory
+                    self._replace(worker, 'worker process died')
+                    continue
+                future = worker.job[3]
+                worker.job = worker.deadline = None
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ExtractionFailed(result))
+                if not worker.process.is_alive() or result == 'ran out of memory':
+                    self._replace(worker, 'worker process died')
+
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.job is not None and worker.deadline <= now:
+                    self._replace(worker, 'timed out after {} seconds'.format(self.timeout_seconds))
+
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, EOFError):
+                pass
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.kill()
+
+
+class ExtractionServerError(Exception):
+    """The html_to_fulltext server couldn't be reached or kept turning
+    requests away. Unlike ExtractionFailed, this says nothing about
+    the page, so it isn't stored with the article.
+    """
+
+
+def timed_call(func, *args):
+    """returns (func(*args), the seconds it took)
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class Extractor:
+    """Interface of the extraction backends
+
+    `capacity` is how many extractions can run at once; 0 means
+    submit() does the work before it returns. The time each extraction
+    took is recorded in `metrics`, a metrics.Metrics, as pdf_seconds or
+    extract_seconds.
+
+    Backends implement _submit(func, *args), which returns a Future of
+    func(*args).
+    """
+    capacity = 0
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def submit(self, url, content, content_type=None, log_level_after=logging.DEBUG):
+        """returns a Future of extract_contents()' result
+        """
+        stage = 'pdf' if is_pdf_content_type(content_type) else 'extract'
+        timed = self._submit(
+            timed_call, self.extract_function(content_type),
+            url, content, content_type, log_level_after,
+        )
+        future = Future()
+
+        def record(timed):
+            try:
+                result, seconds = timed.result()
+            except Exception as e:
+                self.metrics.inc('extraction_failures', stage=stage)
+                future.set_exception(e)
+            else:
+                self.metrics.observe(stage + '_seconds', seconds)
+                future.set_result(result)
+        timed.add_done_callback(record)
+        return future
+
+    def extract_function(self, content_type):
+        return extract_contents
+
+    def _submit(self, func, *args):
+        raise NotImplementedError
+
+    def extract(self, url, content, content_type=None, log_level_after=logging.DEBUG):
+        return self.submit(url, content, content_type, log_level_after).result()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InlineExtractor(Extractor):
+    """extract_contents() in the calling thread, or with `threads`, in
+    a thread pool so that the concurrent crawler's event loop isn't
+    blocked
+    """
+    def __init__(self, threads=0, metrics=None):
+        super().__init__(metrics)
+        self.capacity = threads
+        self.executor = None
+        if threads:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _submit(self, func, *args):
+        if self.executor is not None:
+            return self.executor.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class PoolExtractor(Extractor):
+    """extract_contents() in an ExtractionPool
+    """
+    def __init__(self, pool, metrics=None):
+        super().__init__(metrics)
+        self.pool = pool
+        self.capacity = pool.processes
+
+    def _submit(self, func, *args):
+        return self.pool.submit(func, *args)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class RemoteExtractor(Extractor):
+    """Pages are parsed by an html_to_fulltext server, in batches over
+    a pool of `concurrency` keep-alive connections
+
+    The pages submitted within `batch_wait_seconds` of the first one, up
+    to `batch_size`, are sent in one request to the batch endpoint,
+    whose results stream back in order as the server finishes them.
+
+    Pages are decoded here the way newspaper would, so that full_html is
+    the same as with the other extractors; only the text and title come
+    from the server. pdfs are parsed locally, since the server only
+    handles html.
+
+    502, 503 and 504 are retried after the server's Retry-After or with
+    a backoff, and connection errors with a backoff, up to
+    `max_retries` times before ExtractionServerError is raised for the
+    pages of the batch that weren't answered. A page the server couldn't
+    parse, or didn't answer within `timeout_seconds`, fails with
+    ExtractionFailed; the pages after one that timed out are sent again.
+    """
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, server_url, concurrency=8, batch_size=16, batch_wait_seconds=0.05,
+                 timeout_seconds=60, max_retries=5, metrics=None):
+        super().__init__(metrics)
+        # the batch endpoint, because it answers with the title as well
+        self.url = server_url.rstrip('/') + '/html_to_fulltext/batch'
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        # enough pages to fill every connection's batch
+        self.capacity = concurrency * batch_size
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # decode pages and wait for their results
+        self.executor = ThreadPoolExecutor(max_workers=self.capacity)
+        # post the batches
+        self.sender = ThreadPoolExecutor(max_workers=concurrency)
+        self.queue = queue.Queue()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def extract_function(self, content_type):
+        if is_pdf_content_type(content_type):
+            return extract_contents
+        return self.extract_remotely
+
+    def _submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def extract_remotely(self, url, content, content_type=None, log_level_after=None):
+        html = content
+        if isinstance(content, bytes):
+            from bs4 import UnicodeDammit
+            html = UnicodeDammit(content, is_html=True).unicode_markup
+        if not html:
+            return None
+        future = Future()
+        self.queue.put(({'url': url, 'html': html}, future))
+        result = future.result()
+        if 'error' in result:
+            raise ExtractionFailed(result['error'])
+        return result['text'], html.replace('\x00', ''), result['title']
+
+    def _dispatch(self):
+        """collect the pages of every submit window into a batch
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = collections.deque([item])
+            deadline = time.monotonic() + self.batch_wait_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.sender.submit(self.send, batch)
+                    return
+                batch.append(item)
+            self.sender.submit(self.send, batch)
+
+    def send(self, batch):
+        """post the pages of `batch`, a deque of (document, future), and
+        resolve every future
+        """
+        try:
+            self._send(batch)
+        except Exception as e:
+            # nothing else would resolve them
+            self.fail(batch, e)
+
+    def _send(self, batch):
+        attempt = 0
+        while batch:
+            delay = min(60, 2 ** attempt)
+            body = ''.join(
+                json.dumps(dict(document, id=i)) + '\n'
+                for i, (document, future) in enumerate(batch)
+            ).encode()
+            try:
+                with self.session.post(
+                    self.url, data=body, timeout=self.timeout_seconds, stream=True,
+                    headers={'Content-Type': 'application/x-ndjson'},
+                ) as resp:
+                    if resp.status_code == 200:
+                        # answered in request order
+                        for line in resp.iter_lines():
+                            if line:
+                                document, future = batch.popleft()
+                                future.set_result(json.loads(line.decode()))
+                        error = 'server answered part of the batch'
+                    else:
+                        error = 'server answered {}'.format(resp.status_code)
+                        if 400 <= resp.status_code < 500:
+                            # e.g. 413, the pages are too large for the server
+                            return self.fail(batch, ExtractionFailed(error))
+                        if resp.status_code not in self.retry_statuses:
+                            return self.fail(batch, ExtractionServerError(error))
+                        retry_after = resp.headers.get('Retry-After', '')
+                        if retry_after.isdigit():
+                            delay = int(retry_after)
+            except requests.exceptions.RequestException as e:
+                if is_read_timeout(e):
+                    # like a timeout in an ExtractionPool; the server
+                    # hasn't got to the pages after it yet
+                    document, future = batch.popleft()
+                    future.set_exception(ExtractionFailed(
+                        'timed out after {} seconds'.format(self.timeout_seconds)
+                    ))
+                    continue
+                error = '{}: {}'.format(type(e).__name__, e)
+            if not batch:
+                return
+            if attempt == self.max_retries:
+                return self.fail(batch, ExtractionServerError(
+                    '{} after {} retries'.format(error, self.max_retries),
+                ))
+            logger.info("extraction server: {}; retrying in {} seconds".format(error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def fail(batch, error):
+        for document, future in batch:
+            future.set_exception(error)
+
+    def close(self):
+        # the pages still waiting need the dispatcher and the sender
+        self.executor.shutdown()
+        self.queue.put(None)
+        self.dispatcher.join()
+        self.sender.shutdown()
+        self.session.close()
+
+
+def is_read_timeout(e):
+    """requests raises a ConnectionError when the server stops sending
+    a response it has started
+    """
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return isinstance(e, requests.exceptions.ConnectionError) and bool(e.args) and isinstance(e.args[0], ReadTimeoutError)
@@ -0,0 +1,236 @@
+"""Sequential fetching for the newsletter archive downloader
+
+Fetcher keeps one pooled keep-alive session for the whole run, so
+repeated requests to the same host (e.g. the issues of one archive)
+reuse their connection instead of paying for a new TCP and TLS
+handshake each time. It also owns what used to be patched into
+requests.get: the timeout, the request counters, the http cache and
+the callback that handles 403s.
+
+Bodies are streamed and checked against DownloadLimits as they arrive;
+see download_limits.py.
+"""
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+from chromatic_news.download_newsletter_archives.download_limits import BodyReader, DownloadLimits
+from chromatic_news.download_newsletter_archives.metrics import Metrics
+
+
+class FetchedResponse:
+    """The subset of requests.Response that the crawler relies on
+
+    `rejected` says why the body wasn't downloaded, when it was over
+    the DownloadLimits; `content` is empty then.
+    """
+    def __init__(self, url, status_code, headers, content, not_modified=False, rejected=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.not_modified = not_modified
+        self.rejected = rejected
+
+    def __repr__(self):
+        return '{}({}, {})'.format(
+            self.__class__.__name__, repr(self.url), self.status_code,
+        )
+
+
+def accept_encoding():
+    """the encodings urllib3 can decode here: gzip and deflate, plus
+    br when brotli is installed
+    """
+    return urllib3.util.make_headers(accept_encoding=True)['accept-encoding']
+
+
+def read_response(url, status_code, headers, chunks, limits):
+    """a FetchedResponse of the body in the iterable `chunks`, read as
+    far as `limits`, a DownloadLimits, allow
+    """
+    rejected = limits.check_headers(headers)
+    content = b''
+    if rejected is None:
+        reader = BodyReader(limits, headers.get('Content-Type'))
+        try:
+            for chunk in chunks:
+                if not reader.feed(chunk):
+                    break
+        except Exception:
+            # e.g. the connection broke off
+            reader.discard()
+            raise
+        rejected = reader.rejected
+        content = reader.finish()
+    return FetchedResponse(url, status_code, headers, content, rejected=rejected)
+
+
+def http2_available():
+    # httpx is only imported for --http2, since it's slow to import
+    try:
+        import httpx
+        import h2
+    except ImportError:
+        return False
+    return True
+
+
+class Fetcher:
+    """GET requests over a pooled session
+
+    `counter` has `requests_total` and `requests_successful`
+    attributes that are incremented, `on_response(url, resp)` is
+    called for every response that was received, and
+    `failed_response` is returned for requests that failed. This is
+    the same interface as async_fetcher.AsyncFetcher.
+
+    `connections_per_host` connections are kept alive per host, for
+    up to `max_hosts` hosts. With `http2=True`, requests go through
+    httpx when it's installed with http2 support.
+
+    The duration, size and outcome of every request are recorded in
+    `metrics`, a metrics.Metrics.
+
+    Bodies are only read as far as `limits`, a
+    download_limits.DownloadLimits, allow; pass DownloadLimits(None,
+    None, content_types=None) to download everything.
+    """
+    def __init__(self, timeout_seconds=10, counter=None, on_response=None,
+                 failed_response=None, http_cache=None, interactive=False,
+                 connections_per_host=10, max_hosts=100, http2=False,
+                 metrics=None, limits=None):
+        self.timeout_seconds = timeout_seconds
+        self.limits = limits if limits is not None else DownloadLimits()
+        self.counter = counter
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.on_response = on_response
+        self.failed_response = failed_response
+        self.http_cache = http_cache
+        self.interactive = interactive
+        self.http2 = http2 and http2_available()
+        if http2 and not self.http2:
+            logging.info('httpx with http2 support is not installed; using http/1.1')
+
+        self.timeout_errors, self.connection_errors = request_errors(self.http2)
+        if self.http2:
+            import httpx
+            self.session = httpx.Client(
+                http2=True,
+                follow_redirects=True,
+                timeout=timeout_seconds,
+                limits=httpx.Limits(
+                    max_connections=connections_per_host * max_hosts,
+                    max_keepalive_connections=connections_per_host * max_hosts,
+                ),
+                headers={'Accept-Encoding': accept_encoding()},
+            )
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=max_hosts,
+                pool_maxsize=connections_per_host,
+            )
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.session.headers['Accept-Encoding'] = accept_encoding()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, url, headers):
+        # streamed, so that the headers can be checked before the body
+        # is downloaded. leaving the block closes the connection if
+        # the body wasn't read to the end.
+        chunk_size = 64 * 1024
+        if not self.http2:
+            resp = self.session.get(url, headers=headers, timeout=self.timeout_seconds, stream=True)
+            with resp:
+                return read_response(
+                    resp.url, resp.status_code, resp.headers,
+                    resp.iter_content(chunk_size), self.limits,
+                )
+        with self.session.stream('GET', url, headers=headers) as resp:
+            return read_response(
+                str(resp.url), resp.status_code, resp.headers,
+                resp.iter_bytes(chunk_size), self.limits,
+            )
+
+    def get(self, url, headers=None):
+        logging.info('requesting {}'.format(url))
+
+        if self.interactive:
+            input('ready to request \'{}\'? '.format(url))
+
+        if self.http_cache is not None:
+            headers = self.http_cache.request_headers(url, headers)
+
+        start = time.time()
+        try:
+            if self.counter is not None:
+                self.counter.requests_total += 1
+            resp = self._request(url, headers)
+            if self.counter is not None:
+                self.counter.requests_successful += 1
+        except self.timeout_errors:
+            self.metrics.record_fetch(url, time.time() - start, error='timeout')
+            logging.info("requesting '{}' took longer than the {} timeout seconds".format(url, self.timeout_seconds))
+            return self.failed_response
+        except self.connection_errors as e:
+            self.metrics.record_fetch(url, time.time() - start, error='connection')
+            print(type(e), e)
+            if self.interactive:
+                logging.info(str(e))
+                input("failed to request '{}'; using empty response ".format(url))
+            return self.failed_response
+        except Exception as e:
+            print('Unhandled Exception:', type(e), e)
+            raise
+        self.metrics.record_fetch(url, time.time() - start, resp)
+        if resp.rejected is not None:
+            logging.info("not downloading '{}': {}".format(url, resp.rejected))
+
+        if self.http_cache is not None:
+            resp = self.http_cache.handle_response(url, resp)
+        else:
+            resp.not_modified = resp.status_code == 304
+
+        if self.on_response is not None:
+            self.on_response(url, resp)
+
+        logging.info("requesting '{}' took {:.2f} seconds".format(
+            url, time.time() - start
+        ))
+        return resp
+
+    __call__ = get
+
+
+def request_errors(http2=False):
+    """(the exceptions of requests that timed out, the exceptions of
+    requests that failed otherwise)
+    """
+    timeout_errors = (requests.exceptions.ReadTimeout,)
+    connection_errors = (
+        requests.exceptions.ConnectionError,
+        # the body broke off while it was streamed
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ContentDecodingError,
+        requests.exceptions.MissingSchema,
+        requests.exceptions.SSLError,
+        requests.exceptions.TooManyRedirects,
+    )
+    if http2:
+        import httpx
+        timeout_errors += (httpx.TimeoutException,)
+        connection_errors += (httpx.TransportError, httpx.DecodingError, httpx.TooManyRedirects, httpx.InvalidURL)
+    return timeout_errors, connection_errors
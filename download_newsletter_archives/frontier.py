@@ -0,0 +1,235 @@
+"""Durable crawl frontier shared by any number of workers
+
+The urls left to crawl are rows of the frontier table instead of
+loops in one process, so a crawl survives the process and can be split
+across processes and machines that use the same database. Each entry
+is an archive, newsletter or article url with a state:
+
+    pending -> in_progress -> done
+                           -> failed, after max_attempts tries
+
+Workers claim a batch of pending entries with
+SELECT ... FOR UPDATE SKIP LOCKED, so that two workers never claim the
+same entry and don't wait on each other. A claim is a lease: entries
+whose worker died are claimed again once `lease_seconds` have passed.
+Entries discovered on a page are added as pending, and are ignored if
+an entry of that kind with the same canonical url is in the frontier
+already. The key column holds the sha1 of the canonical url, because
+urls can be longer than a unique btree index allows.
+
+Lease times are the workers' clocks, so hosts need roughly synchronized
+clocks (within much less than `lease_seconds`).
+"""
+import hashlib
+import os
+import socket
+import time
+
+from sqlalchemy import and_, func, or_, select
+
+
+ARCHIVE = 'archive'
+NEWSLETTER = 'newsletter'
+ARTICLE = 'article'
+# articles are claimed first, so that the work a newsletter led to is
+# finished before more newsletters add to the frontier
+priorities = {ARTICLE: 0, NEWSLETTER: 1, ARCHIVE: 2}
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+states = (PENDING, IN_PROGRESS, DONE, FAILED)
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class FrontierEntry:
+    """a claimed entry
+    """
+    def __init__(self, fid, url, kind, parent_url, attempts):
+        self.fid = fid
+        self.url = url
+        self.kind = kind
+        self.parent_url = parent_url
+        self.attempts = attempts
+
+    def __repr__(self):
+        return 'FrontierEntry({!r}, {!r})'.format(self.kind, self.url)
+
+
+class Frontier:
+    """The frontier in `table`, which needs the columns fid, kind, key,
+    url, parent_url, priority, state, attempts, worker, lease_expires
+    and error, and a unique index on (kind, key). `canonicalize` maps
+    the urls that are added to the form they're deduplicated by.
+
+    Everything is written with `sess` and committed with it. claim()
+    commits, because the claim has to be visible to other workers
+    before the work starts; add(), done() and fail() are left to the
+    caller to commit, so the urls an entry led to are added in the
+    same transaction that marks it. The pages an entry stores may be
+    committed before that, so crawling an entry has to be idempotent:
+    an entry whose worker was killed is crawled again.
+    """
+    def __init__(self, sess, table, canonicalize=None, worker_id=None, lease_seconds=600, max_attempts=3):
+        self.sess = sess
+        self.table = table
+        self.canonicalize = canonicalize or (lambda url: url)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def _insert_ignore(self):
+        dialect = self.sess.bind.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            return insert(self.table).on_conflict_do_nothing()
+        statement = self.table.insert()
+        if dialect == 'sqlite':
+            statement = statement.prefix_with('OR IGNORE')
+        return statement
+
+    def key(self, url):
+        return hashlib.sha1(self.canonicalize(url).encode()).hexdigest()
+
+    def add(self, urls, kind, parent_url=None):
+        """add the `urls` that `parent_url` led to as pending, unless
+        they're in the frontier already
+        """
+        keys = dict()
+        for url in urls:
+            keys.setdefault(self.key(url), url)
+        rows = [
+            {
+                'kind': kind, 'key': key, 'url': url,
+                'parent_url': parent_url, 'priority': priorities[kind],
+                'state': PENDING, 'attempts': 0,
+            }
+            for key, url in keys.items()
+        ]
+        if rows:
+            self.sess.execute(self._insert_ignore(), rows)
+
+    def _claimable(self, now):
+        t = self.table
+        return or_(
+            t.c.state == PENDING,
+            and_(
+                t.c.state == IN_PROGRESS,
+                t.c.lease_expires < now,
+                t.c.attempts < self.max_attempts,
+            ),
+        )
+
+    def claim(self, batch_size=10):
+        """lease up to `batch_size` entries to this worker and commit
+        """
+        t = self.table
+        now = time.time()
+        lease_expires = now + self.lease_seconds
+        self._fail_expired(now)
+        query = select([t.c.fid]).where(
+            self._claimable(now)
+        ).order_by(
+            t.c.priority, t.c.fid,
+        ).limit(batch_size).with_for_update(skip_locked=True)
+        fids = [fid for fid, in self.sess.execute(query)]
+        entries = list()
+        if fids:
+            # checked again, for databases without row locks (sqlite),
+            # where another worker may have claimed them since
+            self.sess.execute(t.update().where(and_(
+                t.c.fid.in_(fids), self._claimable(now),
+            )).values(
+                state=IN_PROGRESS,
+                worker=self.worker_id,
+                lease_expires=lease_expires,
+                attempts=t.c.attempts + 1,
+            ))
+            query = select([
+                t.c.fid, t.c.url, t.c.kind, t.c.parent_url, t.c.attempts,
+            ]).where(and_(
+                t.c.fid.in_(fids),
+                t.c.worker == self.worker_id,
+                t.c.lease_expires == lease_expires,
+            )).order_by(t.c.priority, t.c.fid)
+            entries = [FrontierEntry(*row) for row in self.sess.execute(query)]
+        self.sess.commit()
+        return entries
+
+    def _fail_expired(self, now):
+        """entries whose lease ran out too often probably kill their
+        worker, so they aren't tried again
+        """
+        t = self.table
+        self.sess.execute(t.update().where(and_(
+            t.c.state == IN_PROGRESS,
+            t.c.lease_expires < now,
+            t.c.attempts >= self.max_attempts,
+        )).values(state=FAILED, error='lease expired {} times'.format(self.max_attempts)))
+
+    def done(self, entry):
+        self._finish(entry, DONE)
+
+    def fail(self, entry, error, retry=True):
+        """with `retry`, the entry is pending again unless it has
+        failed max_attempts times
+        """
+        state = FAILED
+        if retry and entry.attempts < self.max_attempts:
+            state = PENDING
+        self._finish(entry, state, error=error)
+
+    def _finish(self, entry, state, error=None):
+        t = self.table
+        # only if the lease is still ours; another worker may have
+        # taken over after it expired
+        self.sess.execute(t.update().where(and_(
+            t.c.fid == entry.fid,
+            t.c.worker == self.worker_id,
+            t.c.state == IN_PROGRESS,
+        )).values(state=state, error=error, lease_expires=None))
+
+    def release(self):
+        """make the entries leased to this worker pending again, e.g.
+        when a worker with the same id was killed
+        """
+        t = self.table
+        self.sess.execute(t.update().where(and_(
+            t.c.state == IN_PROGRESS,
+            t.c.worker == self.worker_id,
+        )).values(state=PENDING, lease_expires=None))
+        self.sess.commit()
+
+    def reset(self, kind=None, state=None):
+        """make entries pending again, e.g. archives for a new crawl
+        or failed entries to retry them
+        """
+        t = self.table
+        criteria = []
+        if kind is not None:
+            criteria.append(t.c.kind == kind)
+        if state is not None:
+            criteria.append(t.c.state == state)
+        self.sess.execute(t.update().where(and_(*criteria)).values(
+            state=PENDING, attempts=0, error=None, lease_expires=None,
+        ))
+        self.sess.commit()
+
+    def is_finished(self):
+        """True when nothing is pending or leased anymore; other workers
+        may still add entries until then
+        """
+        t = self.table
+        query = select([t.c.fid]).where(t.c.state.in_([PENDING, IN_PROGRESS])).limit(1)
+        return self.sess.execute(query).first() is None
+
+    def counts(self):
+        """{(kind, state): number of entries}
+        """
+        t = self.table
+        query = select([t.c.kind, t.c.state, func.count()]).group_by(t.c.kind, t.c.state)
+        return {(kind, state): count for kind, state, count in self.sess.execute(query)}
@@ -0,0 +1,184 @@
+"""On-disk HTTP response cache
+
+Responses that carry an ETag or Last-Modified header are kept in a
+sqlite file. The next request for the same url is sent as a
+conditional request, and a 304 is answered from the cache. The file is
+kept under `max_bytes` by evicting the least recently used responses.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+
+class CachedResponse:
+    """The subset of requests.Response that the crawler relies on
+
+    `not_modified` is True when the server answered a conditional
+    request with 304 and the content came from the cache.
+    """
+    def __init__(self, url, status_code, headers, content, not_modified=False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.not_modified = not_modified
+
+    def __repr__(self):
+        return '{}({}, {}, not_modified={})'.format(
+            self.__class__.__name__, repr(self.url), self.status_code,
+            self.not_modified,
+        )
+
+
+def validators(headers):
+    return headers.get('ETag'), headers.get('Last-Modified')
+
+
+def conditional_headers(etag, last_modified):
+    headers = dict()
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+class HttpCache:
+    def __init__(self, filepath, max_bytes=512*1024*1024, max_entry_bytes=None):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        # single responses bigger than this aren't cached
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 100
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # used from the event loop of the concurrent crawler as well
+        # as from the main thread, hence the lock
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                final_url TEXT,
+                status INTEGER,
+                headers TEXT,
+                content BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_responses_last_access
+            ON responses (last_access)
+        ''')
+        self.conn.commit()
+        self.total_bytes, = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT final_url, status, headers, content, etag, last_modified '
+                'FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    'UPDATE responses SET last_access = ? WHERE url = ?',
+                    (time.time(), url),
+                )
+                self.conn.commit()
+        return row
+
+    def request_headers(self, url, headers=None):
+        """`headers` plus the conditional headers for the cached
+        response of `url`, if there is one. Headers that the caller
+        set take precedence.
+        """
+        headers = dict(headers or {})
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, last_modified FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+        if row is not None:
+            for name, value in conditional_headers(*row).items():
+                headers.setdefault(name, value)
+        return headers
+
+    def handle_response(self, url, resp):
+        """Returns the response to use instead of `resp`
+
+        A 304 is replaced with the cached response, other responses
+        with validators are cached.
+        """
+        if resp.status_code == 304:
+            row = self.get(url)
+            if row is None:
+                self.misses += 1
+                resp.not_modified = True
+                return resp
+            self.hits += 1
+            final_url, status, headers, content, etag, last_modified = row
+            return CachedResponse(
+                final_url, status, json.loads(headers), content,
+                not_modified=True,
+            )
+
+        self.misses += 1
+        resp.not_modified = False
+        if resp.status_code == 200:
+            self.put(url, resp)
+        return resp
+
+    def put(self, url, resp):
+        etag, last_modified = validators(resp.headers)
+        if not (etag or last_modified):
+            return
+        # bodies over the fetcher's limits, and ones it spooled to a
+        # file because they're big
+        if getattr(resp, 'rejected', None) is not None or not isinstance(resp.content, bytes):
+            return
+        size = len(resp.content)
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.conn.execute(
+                'SELECT size FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.total_bytes += size
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    url, resp.url, resp.status_code,
+                    json.dumps(dict(resp.headers)), resp.content,
+                    etag, last_modified, size, time.time(),
+                ),
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # drop least recently used responses until 90% of the limit
+        # is reached, so that eviction doesn't happen on every put
+        target = self.max_bytes * 0.9
+        evict = list()
+        for url, size in self.conn.execute(
+                'SELECT url, size FROM responses ORDER BY last_access'):
+            if self.total_bytes <= target:
+                break
+            evict.append((url,))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM responses WHERE url = ?', evict)
@@ -0,0 +1,80 @@
+"""Extracting the links of an html page
+
+The crawler only needs the href of every <a> tag of archive and
+newsletter pages, so instead of building a BeautifulSoup tree the html
+is streamed through a parser that only looks at start tags and builds
+no tree at all. lxml's parser is used when it's installed, otherwise
+the tokenizer of the standard library.
+"""
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+backends = ['html.parser']
+if etree is not None:
+    backends.insert(0, 'lxml')
+default_backend = backends[0]
+
+
+class _HrefCollector(HTMLParser):
+    """the standard library tokenizer, keeping only <a href>s
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.hrefs = list()
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        for name, value in attrs:
+            if name == 'href' and value is not None:
+                self.hrefs.append(value)
+                return
+
+
+class _LxmlHrefTarget:
+    """parser target for lxml: called back for every tag, so lxml
+    doesn't build a tree
+    """
+    def __init__(self):
+        self.hrefs = list()
+
+    def start(self, tag, attrib):
+        if tag == 'a':
+            href = attrib.get('href')
+            if href is not None:
+                self.hrefs.append(href)
+
+    def close(self):
+        pass
+
+
+def _new_parser(backend):
+    if backend == 'lxml':
+        target = _LxmlHrefTarget()
+        return etree.HTMLParser(target=target), target
+    if backend == 'html.parser':
+        parser = _HrefCollector()
+        return parser, parser
+    raise ValueError("unknown link extraction backend '{}'; one of {}".format(backend, backends))
+
+
+def iter_hrefs(html, backend=None, chunk_size=64*1024):
+    """yield the href of every <a> tag of `html`, in document order
+
+    `html` is fed to the parser `chunk_size` characters at a time, and
+    the hrefs found so far are yielded after every chunk.
+    """
+    parser, collector = _new_parser(backend or default_backend)
+    if not html:
+        return
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start:start+chunk_size])
+        yield from collector.hrefs
+        collector.hrefs = list()
+    parser.close()
+    yield from collector.hrefs
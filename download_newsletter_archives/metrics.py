@@ -0,0 +1,303 @@
+"""Timings and counts of the crawl
+
+Every stage of the crawl records into a Metrics: latency histograms
+(fetch per domain, link parsing, newspaper extraction, pdf parsing, db
+flushes) and counters (bytes downloaded, responses, failures).
+At the end of the run they're summarized, and can be written to a
+Prometheus textfile (for node_exporter's textfile collector) or a json
+file. Progress prints the crawl's progress periodically while it runs.
+
+usage:
+    metrics = Metrics()
+    with metrics.time('parse_seconds', kind='archive'):
+        ...
+    metrics.inc('fetch_bytes', len(content), domain=domain)
+    metrics.write('crawl.prom')
+"""
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# seconds
+default_buckets = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120,
+)
+
+
+class Histogram:
+    """counts of observations in `buckets`, by upper bound, like a
+    Prometheus histogram
+    """
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # the last one counts observations above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """the upper bound of the bucket that the q-quantile falls in
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative_counts(self):
+        cumulative = 0
+        for count in self.counts:
+            cumulative += count
+            yield cumulative
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in labels
+    ) + '}'
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'inf'
+    if seconds < 1:
+        return '{:.0f}ms'.format(seconds * 1000)
+    return '{:.1f}s'.format(seconds)
+
+
+class Metrics:
+    """Histograms and counters by name and labels
+
+    Thread safe, so that extraction callbacks from pool threads can
+    record too. Metric names get `prefix` when they're exported. To
+    bound the size of the export, a metric keeps at most
+    `max_series` label combinations; more are counted under
+    `other` labels.
+    """
+    def __init__(self, prefix='chromatic_news_', max_series=1000):
+        self.prefix = prefix
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        # name -> {labels: Histogram}
+        self.histograms = dict()
+        # name -> {labels: number}
+        self.counters = dict()
+        self.started = time.time()
+
+    def _labels(self, series, labels):
+        key = tuple(sorted(labels.items()))
+        if key in series or len(series) < self.max_series:
+            return key
+        return tuple((name, 'other') for name, value in key)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, dict())
+            key = self._labels(series, labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            key = self._labels(series, labels)
+            series[key] = series.get(key, 0) + amount
+
+    def value(self, name, **labels):
+        """a counter's value; without labels, summed over all of them
+        """
+        with self.lock:
+            series = self.counters.get(name, dict())
+            if labels:
+                return series.get(tuple(sorted(labels.items())), 0)
+            return sum(series.values())
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def record_fetch(self, url, seconds, resp=None, error=None):
+        """one request of a fetcher; `resp` is None when it failed
+        with `error` ('timeout' or 'connection')
+        """
+        domain = urlparse(url).netloc
+        self.observe('fetch_seconds', seconds, domain=domain)
+        if resp is None:
+            self.inc('fetch_failures', domain=domain, error=error)
+            return
+        self.inc('fetch_responses', domain=domain, status='{}xx'.format(resp.status_code // 100))
+        self.inc('fetch_bytes', len(resp.content or b''), domain=domain)
+        if getattr(resp, 'rejected', None) is not None:
+            # over the fetcher's DownloadLimits
+            self.inc('fetch_rejected', domain=domain)
+
+    def to_prometheus(self):
+        lines = list()
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                name = self.prefix + name
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, histogram in sorted(series.items()):
+                    bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append('{}_bucket{} {}'.format(
+                            name, _format_labels(labels + (('le', bound),)), count,
+                        ))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+            for name, series in sorted(self.counters.items()):
+                name = self.prefix + name + '_total'
+                lines.append('# TYPE {} counter'.format(name))
+                for labels, value in sorted(series.items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        with self.lock:
+            histograms = {
+                name: [
+                    {
+                        'labels': dict(labels),
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'buckets': dict(zip(
+                            [str(bound) for bound in histogram.buckets] + ['+Inf'],
+                            histogram.cumulative_counts(),
+                        )),
+                    }
+                    for labels, histogram in sorted(series.items())
+                ]
+                for name, series in self.histograms.items()
+            }
+            counters = {
+                name: [
+                    {'labels': dict(labels), 'value': value}
+                    for labels, value in sorted(series.items())
+                ]
+                for name, series in self.counters.items()
+            }
+        return {
+            'seconds': time.time() - self.started,
+            'histograms': histograms,
+            'counters': counters,
+        }
+
+    def write(self, filepath):
+        """json if `filepath` ends in .json, otherwise the Prometheus
+        text format. the file is replaced at once, so a collector never
+        reads half of it.
+        """
+        if filepath.endswith('.json'):
+            data = json.dumps(self.to_dict(), indent=2)
+        else:
+            data = self.to_prometheus()
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as fw:
+            fw.write(data)
+        os.replace(tmp_filepath, filepath)
+
+    def summary(self):
+        """lines with the totals of every histogram, over all labels
+        """
+        lines = list()
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                total = Histogram()
+                for histogram in series.values():
+                    total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                    total.count += histogram.count
+                    total.sum += histogram.sum
+                lines.append('{}: {} times, {:.1f}s in total, p50 {}, p90 {}, p99 {}'.format(
+                    name, total.count, total.sum,
+                    _format_seconds(total.quantile(0.5)),
+                    _format_seconds(total.quantile(0.9)),
+                    _format_seconds(total.quantile(0.99)),
+                ))
+        return lines
+
+
+class Progress:
+    """Prints the progress of the crawl every `interval_seconds` from a
+    background thread: requests and their rate, articles, megabytes and
+    archives done. The ETA is estimated from --requests-limit when there
+    is one, otherwise from the share of archives that are done.
+    """
+    def __init__(self, metrics, counter, interval_seconds=30, requests_limit=None, archives_total=None, file=sys.stderr):
+        self.metrics = metrics
+        self.counter = counter
+        self.interval_seconds = interval_seconds
+        self.requests_limit = requests_limit
+        self.archives_total = archives_total
+        self.file = file
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            print(self.line(), file=self.file, flush=True)
+
+    def eta_seconds(self, elapsed):
+        requests = self.counter.requests_total
+        if self.requests_limit and requests:
+            return elapsed / requests * max(0, self.requests_limit - requests)
+        archives_done = self.metrics.value('archives_done')
+        if self.archives_total and archives_done:
+            return elapsed / archives_done * max(0, self.archives_total - archives_done)
+        return None
+
+    def line(self):
+        elapsed = time.time() - self.start
+        requests = self.counter.requests_total
+        line = '{} requests ({:.1f}/s), {} articles, {:.1f} MB, {} archives'.format(
+            requests, requests / max(elapsed, 1e-6),
+            self.metrics.value('articles_stored'),
+            self.metrics.value('fetch_bytes') / 1024 / 1024,
+            self.metrics.value('archives_done'),
+        )
+        if self.archives_total:
+            line += ' of {}'.format(self.archives_total)
+        eta = self.eta_seconds(elapsed)
+        if eta is not None:
+            line += ', ETA {:.0f}m{:02.0f}s'.format(*divmod(eta, 60))
+        return line
@@ -0,0 +1,192 @@
+"""Per-domain politeness for the concurrent crawler
+
+Each domain (the netloc of the url) gets its own token bucket and its
+own cap on requests in flight, so that a high overall --concurrency
+doesn't turn into a burst against a single publisher. 429 and 503
+responses back the domain off exponentially, honoring Retry-After.
+"""
+import asyncio
+import datetime
+import email.utils
+import time
+import urllib
+
+
+def netloc(url):
+    return urllib.parse.urlparse(url).netloc
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait according to a Retry-After header value
+
+    The header is either a number of seconds or an HTTP date.
+    Returns None when it can't be parsed.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `burst`
+    """
+    def __init__(self, rate, burst=1, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class DomainStats:
+    def __init__(self):
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.backoffs = 0
+
+    def __repr__(self):
+        return (
+            '{}(requests={}, queue_depth={}, max_queue_depth={}, '
+            'wait_seconds={:.2f}, max_wait_seconds={:.2f}, backoffs={})'
+        ).format(
+            self.__class__.__name__, self.requests, self.queue_depth,
+            self.max_queue_depth, self.wait_seconds, self.max_wait_seconds,
+            self.backoffs,
+        )
+
+
+class _DomainState:
+    def __init__(self, rate, burst, max_in_flight, stats):
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.blocked_until = 0.0
+        self.consecutive_backoffs = 0
+        self.stats = stats
+
+
+class DomainScheduler:
+    """Hands out per-domain request slots to asyncio tasks
+
+    usage:
+        async with scheduler.slot(url):
+            resp = await session.get(url)
+        retry_delay = scheduler.record_response(url, resp.status, resp.headers)
+
+    `stats` maps netloc to DomainStats; pass in a dict to share it
+    with the caller, e.g. so it can be printed next to Counter.
+    """
+    backoff_statuses = (429, 503)
+
+    def __init__(self, rate=1.0, burst=1, max_in_flight=2,
+                 base_backoff_seconds=1.0, max_backoff_seconds=300.0,
+                 stats=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.stats = dict() if stats is None else stats
+        self.domains = dict()
+
+    def _state(self, url):
+        domain = netloc(url).lower()
+        state = self.domains.get(domain)
+        if state is None:
+            stats = self.stats.setdefault(domain, DomainStats())
+            state = self.domains[domain] = _DomainState(
+                self.rate, self.burst, self.max_in_flight, stats,
+            )
+        return state
+
+    def slot(self, url):
+        return _Slot(self, self._state(url))
+
+    async def _acquire(self, state):
+        stats = state.stats
+        stats.queue_depth += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+        start = time.monotonic()
+        try:
+            await state.in_flight.acquire()
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    state.blocked_until - now,
+                    state.bucket.delay(now),
+                )
+                if wait <= 0:
+                    state.bucket.take(now)
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            stats.queue_depth -= 1
+        waited = time.monotonic() - start
+        stats.requests += 1
+        stats.wait_seconds += waited
+        stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+
+    def record_response(self, url, status_code, headers=None):
+        """Update the domain's backoff state after a response
+
+        Returns the number of seconds the request should be retried
+        after, or None if it shouldn't be retried.
+        """
+        state = self._state(url)
+        if status_code not in self.backoff_statuses:
+            state.consecutive_backoffs = 0
+            return None
+
+        state.consecutive_backoffs += 1
+        state.stats.backoffs += 1
+        delay = None
+        if headers is not None:
+            delay = parse_retry_after(headers.get('Retry-After'))
+        if delay is None:
+            delay = self.base_backoff_seconds * 2 ** (state.consecutive_backoffs - 1)
+        delay = min(delay, self.max_backoff_seconds)
+        state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+        return delay
+
+
+class _Slot:
+    def __init__(self, scheduler, state):
+        self.scheduler = scheduler
+        self.state = state
+
+    async def __aenter__(self):
+        await self.scheduler._acquire(self.state)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.state.in_flight.release()
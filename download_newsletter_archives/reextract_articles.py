@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Re-run extraction over the stored html of the articles
+
+After upgrading newspaper or changing how text is cleaned up, this
+refreshes full_text and title of every article from its stored
+full_html, without downloading anything. Articles are read a batch at
+a time in order of aid, parsed in a pool of worker processes while the
+next batch is read, and written back with one bulk update per batch.
+
+With --checkpoint, the last aid that was written is kept in a file, so
+an interrupted run continues where it stopped.
+
+pdfs (whose stored html is their text already) and articles whose
+extraction failed are skipped.
+
+usage:
+    python reextract_articles.py --checkpoint reextract.checkpoint
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+import logging
+import time
+
+from sqlalchemy import and_, func, not_, or_
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.dbutils import Base, create_tables
+from chromatic_news.queryutils import in_batches
+from chromatic_news.download_newsletter_archives.blob_store import BlobNotFound, content_hash
+from chromatic_news.download_newsletter_archives.extraction import (
+    ExtractionFailed, ExtractionPool, PoolExtractor,
+)
+from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+    Article, SABase, Webpage,
+    get_engine, make_blob_store, required_blob_store, schema_name,
+)
+
+
+def articles_to_reextract(sess, start_after=None):
+    # the html of a pdf is the same as its text; compared hash to hash
+    # or text to text here, and by html_is_text() when one is in the
+    # blob store and the other in the row
+    html_is_text = or_(
+        and_(
+            Article.full_html_hash != None,
+            Article.full_text_hash != None,
+            Article.full_html_hash == Article.full_text_hash,
+        ),
+        and_(
+            Article.full_html_hash == None,
+            Article.full_text_hash == None,
+            Article._full_html != None,
+            Article._full_text != None,
+            Article._full_html == Article._full_text,
+        ),
+    )
+    query = sess.query(
+        Article.aid, Article.url,
+        Article._full_html, Article.full_html_hash,
+        Article._full_text, Article.full_text_hash,
+    ).filter(
+        func.coalesce(Article.full_html_hash, Article._full_html) != None,
+        not_(html_is_text),
+    )
+    if start_after is not None:
+        query = query.filter(Article.aid > start_after)
+    return query
+
+
+def html_is_text(row):
+    """whether the html of `row` is its text, when one of them is in
+    the blob store and the other in the row
+    """
+    if row.full_html_hash is not None and row._full_text is not None:
+        return row.full_html_hash == content_hash(row._full_text.encode())
+    if row.full_text_hash is not None and row._full_html is not None:
+        return row.full_text_hash == content_hash(row._full_html.encode())
+    return False
+
+
+def stored_html(row, blob_store):
+    if row.full_html_hash is None:
+        return row._full_html
+    return blob_store.get_text(row.full_html_hash)
+
+
+class Checkpoint:
+    """the aid of the last article that was written, in `filepath`
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def load(self):
+        if self.filepath is None or not os.path.exists(self.filepath):
+            return None
+        with open(self.filepath) as fr:
+            return int(fr.read().strip())
+
+    def save(self, aid):
+        if self.filepath is None:
+            return
+        # replace rather than overwrite, so that a crash can't leave a
+        # half written file behind
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'w') as fw:
+            fw.write(str(aid))
+        os.replace(tmp_filepath, self.filepath)
+
+
+class Reextraction:
+    def __init__(self, sess, extractor, blob_store):
+        self.sess = sess
+        self.extractor = extractor
+        self.blob_store = blob_store
+        self.read = 0
+        self.changed = 0
+        self.failed = 0
+
+    def submit(self, rows):
+        """returns [(row, future of its extraction)]
+        """
+        jobs = list()
+        for row in rows:
+            if html_is_text(row):
+                continue
+            try:
+                html = stored_html(row, self.blob_store)
+            except BlobNotFound as e:
+                logging.warning("the html of article {} isn't in the blob store: {}".format(row.aid, e))
+                self.failed += 1
+                continue
+            if not html:
+                continue
+            jobs.append((row, self.extractor.submit(row.url, html, 'text/html')))
+        return jobs
+
+    def write(self, jobs):
+        updates = list()
+        for row, future in jobs:
+            try:
+                extracted = future.result()
+            except ExtractionFailed as e:
+                # keep the text it has
+                logging.warning("extracting article {} failed: {}".format(row.aid, e))
+                self.failed += 1
+                continue
+            if extracted is None:
+                continue
+            full_text, full_html, title = extracted
+            if row.full_text_hash is not None and row.full_text_hash == content_hash(full_text.encode()):
+                # unchanged; the title comes from the same parse
+                continue
+            if row.full_text_hash is None and row._full_text == full_text:
+                continue
+            update = {'aid': row.aid, 'title': title}
+            # where the article's bodies are, so that articles crawled
+            # without a blob store stay readable from their columns
+            blob_store = None
+            if row.full_text_hash is not None or row.full_html_hash is not None:
+                blob_store = self.blob_store
+            update.update(Article.full_text.column_values(blob_store, full_text))
+            updates.append(update)
+        if updates:
+            self.sess.bulk_update_mappings(Article, updates)
+        self.sess.commit()
+        self.changed += len(updates)
+
+    def run(self, batches, checkpoint):
+        """the extraction of one batch overlaps with reading the next
+        """
+        start = time.time()
+        previous = None
+        for rows in batches:
+            jobs = self.submit(rows)
+            if previous is not None:
+                self.finish(previous, checkpoint, start)
+            previous = rows, jobs
+        if previous is not None:
+            self.finish(previous, checkpoint, start)
+        print('done: {} articles re-extracted, {} changed, {} failed'.format(
+            self.read, self.changed, self.failed,
+        ))
+
+    def finish(self, batch, checkpoint, start):
+        rows, jobs = batch
+        self.write(jobs)
+        self.read += len(rows)
+        checkpoint.save(rows[-1].aid)
+        print('{} articles read, {} changed, {} failed, up to aid {} ({:.0f} articles/sec)'.format(
+            self.read, self.changed, self.failed, rows[-1].aid,
+            self.read / max(time.time() - start, 1e-6),
+        ))
+
+
+def run_main():
+    args = parse_cl_args()
+    engine = get_engine()
+    Base.set_sess(engine)
+    create_tables(engine, SABase, schema_name)
+    checkpoint = Checkpoint(args.checkpoint)
+    start_after = args.start_after
+    if start_after is None:
+        start_after = checkpoint.load()
+
+    extractor = PoolExtractor(ExtractionPool(
+        processes=args.processes,
+        timeout_seconds=args.timeout_seconds,
+        memory_limit_mb=args.memory_limit_mb,
+    ))
+    with extractor, Base.get_session() as sess:
+        blob_store = make_blob_store(sess, args)
+        Webpage.set_blob_store(blob_store)
+        batches = in_batches(
+            articles_to_reextract(sess, start_after),
+            Article.aid, batch_size=args.batch_size,
+        )
+        Reextraction(sess, extractor, blob_store).run(batches, checkpoint)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='re-run extraction over the stored html of the articles',
+    )
+    argParser.add_argument(
+        '--checkpoint', default=None, metavar='FILE',
+        help="continue after the aid in FILE, and keep it up to date",
+    )
+    argParser.add_argument(
+        '--start-after', default=None, type=int, metavar='AID',
+        help="only articles with a larger aid; overrides --checkpoint",
+    )
+    argParser.add_argument(
+        '--processes', default=None, type=int,
+        help="worker processes. default: one per cpu",
+    )
+    argParser.add_argument('--batch-size', default=500, type=int)
+    argParser.add_argument('--timeout-seconds', default=60, type=int)
+    argParser.add_argument('--memory-limit-mb', default=None, type=int)
+    argParser.add_argument(
+        '--blob-store', default='db', metavar='db|DIR', type=required_blob_store,
+        help="the blobs table (db) or a directory. default %(default)s",
+    )
+    argParser.add_argument('--compression-level', default=None, type=int)
+    argParser.add_argument(
+        '--compression-dictionary', default=None, metavar='FILE',
+        help="zstd dictionary to compress with",
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,115 @@
+"""In-memory index of the urls that are already in the database
+
+Checking whether a link is new used to cost one query per link. The
+index keeps a 64 bit hash of the normalized form of every known url
+(the crawler normalizes with canonicalize.Canonicalizer): urls that
+were loaded from the database sit in a sorted array (8 bytes each),
+urls added during the run in a set. It can be saved to disk, so that
+the next run only has to load the rows that were added since.
+"""
+import bisect
+import hashlib
+import json
+import os
+import urllib
+from array import array
+
+from chromatic_news.queryutils import stream
+
+
+def normalize_url(url):
+    """lowercase the scheme and host, drop the fragment and
+    surrounding whitespace
+    """
+    url = url.strip()
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return url
+    return urllib.parse.urlunsplit((
+        parts.scheme.lower(), parts.netloc.lower(),
+        parts.path, parts.query, '',
+    ))
+
+
+def url_hash(url, normalize=normalize_url):
+    digest = hashlib.blake2b(normalize(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class UrlIndex:
+    """`fingerprint` identifies the `normalize` function, so that an
+    index saved with another one isn't loaded
+    """
+    def __init__(self, normalize=normalize_url, fingerprint=''):
+        self.normalize = normalize
+        self.fingerprint = fingerprint
+        self.loaded = array('Q')
+        self.added = set()
+        # the largest primary key that has been loaded, per table
+        self.high_water = dict()
+
+    def __len__(self):
+        return len(self.loaded) + len(self.added)
+
+    def __contains__(self, url):
+        h = url_hash(url, self.normalize)
+        if h in self.added:
+            return True
+        i = bisect.bisect_left(self.loaded, h)
+        return i < len(self.loaded) and self.loaded[i] == h
+
+    def add(self, *urls):
+        for url in urls:
+            if url:
+                self.added.add(url_hash(url, self.normalize))
+
+    def _merge(self, hashes):
+        self.loaded = array('Q', sorted(set(self.loaded).union(hashes, self.added)))
+        self.added = set()
+
+    def load_from_db(self, sess, id_col, url_cols, batch_size=10000):
+        """load the urls of all rows whose `id_col` is larger than
+        what was loaded before
+        """
+        table_name = id_col.class_.__tablename__
+        high_water = self.high_water.get(table_name, 0)
+        query = sess.query(id_col, *url_cols).filter(id_col > high_water)
+
+        hashes = list()
+        for row in stream(query, batch_size):
+            high_water = max(high_water, row[0])
+            for url in row[1:]:
+                if url:
+                    hashes.append(url_hash(url, self.normalize))
+        self._merge(hashes)
+        self.high_water[table_name] = high_water
+        return self
+
+    def save(self, filepath):
+        self._merge(())
+        header = json.dumps({
+            'count': len(self.loaded),
+            'fingerprint': self.fingerprint,
+            'high_water': self.high_water,
+        })
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as fw:
+            fw.write(header.encode() + b'\n')
+            self.loaded.tofile(fw)
+        # so that a crash while saving doesn't leave a broken index
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath, normalize=normalize_url, fingerprint=''):
+        """returns None if the index was saved with a different
+        `fingerprint`
+        """
+        self = cls(normalize, fingerprint)
+        with open(filepath, 'rb') as fr:
+            header = json.loads(fr.readline().decode())
+            if header.get('fingerprint', '') != fingerprint:
+                return None
+            self.loaded.fromfile(fr, header['count'])
+        self.high_water = header['high_water']
+        return self
@@ -0,0 +1,18 @@
+"""The extraction itself, without the server around it, so that the
+batch endpoint's worker processes only import newspaper
+"""
+import newspaper
+
+
+def html_to_article(url, html):
+    """Return (full_text, title, cleaned article html)
+    """
+    # newspaper can't handle a url of None
+    article = newspaper.Article(url or '', fetch_images=False, keep_article_html=True)
+    article.download(input_html=html)
+    article.parse()
+    return (
+        article.text.replace('\x00', ''),
+        article.title.replace('\x00', ''),
+        article.article_html.replace('\x00', ''),
+    )
@@ -0,0 +1,40 @@
+"""gunicorn settings for serving html_to_fulltext in production
+
+    gunicorn -c gunicorn_config.py html_to_fulltext:api
+
+Every setting can be overridden with the environment variable named
+in its line.
+"""
+import multiprocessing
+import os
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, 0)) or default
+
+
+bind = os.environ.get('HTML_TO_FULLTEXT_BIND', 'localhost:7295')
+
+# parsing is cpu bound, so one pre-forked worker process per core
+workers = env_int('HTML_TO_FULLTEXT_WORKERS', multiprocessing.cpu_count())
+
+# a few threads per worker: while one parses, the others can answer
+# requests beyond HTML_TO_FULLTEXT_MAX_IN_FLIGHT with 503 right away,
+# instead of leaving them waiting in the listen backlog
+worker_class = 'gthread'
+threads = env_int('HTML_TO_FULLTEXT_THREADS', 4)
+os.environ.setdefault('HTML_TO_FULLTEXT_MAX_IN_FLIGHT', '2')
+
+# the batch endpoint's process pool, per worker; the workers already
+# use every core
+os.environ.setdefault('HTML_TO_FULLTEXT_PROCESSES', '1')
+
+backlog = env_int('HTML_TO_FULLTEXT_BACKLOG', 256)
+timeout = env_int('HTML_TO_FULLTEXT_TIMEOUT_SECONDS', 120)
+graceful_timeout = 30
+keepalive = 5
+
+# restart workers every so often, so that memory leaked by parsing
+# doesn't pile up
+max_requests = env_int('HTML_TO_FULLTEXT_MAX_REQUESTS', 1000)
+max_requests_jitter = max_requests // 10
@@ -1,20 +1,323 @@
 #!/usr/bin/env python
+import collections
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 import falcon
 import newspaper
 
+from article_parser import html_to_article
+from result_cache import DiskResultCache, ResultCache, document_key
+
+
+# part of the cache keys, so that results of another version aren't used
+extractor_version = 'newspaper {}'.format(getattr(newspaper, '__version__', ''))
+
+
+MB = 1024 * 1024
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, 0)) or default
+
+
+def copy_limited(stream, fw, max_bytes, chunk_size=64*1024):
+    """copy `stream` to `fw`, raising 413 once more than `max_bytes`
+    were read. a Content-Length is only a claim, and chunked requests
+    don't have one.
+    """
+    total = 0
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        total += len(chunk)
+        if max_bytes and total > max_bytes:
+            raise falcon.HTTPPayloadTooLarge(
+                title='request body too large',
+                description='at most {} bytes are accepted'.format(max_bytes),
+            )
+        fw.write(chunk)
+
+
+def check_content_length(req, max_bytes):
+    if max_bytes and (req.content_length or 0) > max_bytes:
+        raise falcon.HTTPPayloadTooLarge(
+            title='request body too large',
+            description='at most {} bytes are accepted'.format(max_bytes),
+        )
+
+
+class Backpressure:
+    """Middleware that bounds the requests a worker process works on
+
+    At most `max_in_flight` requests are handled at once; any more are
+    answered right away with 503 and a Retry-After header, instead of
+    queueing without limit. Streamed responses hold their slot until
+    they've been sent.
+    """
+    def __init__(self, max_in_flight, retry_after_seconds=1):
+        self.max_in_flight = max_in_flight
+        self.retry_after_seconds = retry_after_seconds
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+    def process_request(self, req, resp):
+        if not self.slots.acquire(blocking=False):
+            raise falcon.HTTPServiceUnavailable(
+                title='overloaded',
+                description='{} requests are in progress already'.format(self.max_in_flight),
+                retry_after=self.retry_after_seconds,
+            )
+        req.context['has_slot'] = True
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not req.context.get('has_slot'):
+            return
+        if resp.stream is None:
+            self.slots.release()
+        else:
+            resp.stream = self._release_after(resp.stream)
+
+    def _release_after(self, stream):
+        try:
+            yield from stream
+        finally:
+            self.slots.release()
+
+
 class HtmlToFulltextResource:
+    """`cache` is a result_cache.ResultCache, or None
+    """
+    def __init__(self, max_body_bytes=None, cache=None):
+        self.max_body_bytes = max_body_bytes
+        self.cache = cache
+
     def on_post(self, req, resp):
-        chunk = req.stream.read()
+        check_content_length(req, self.max_body_bytes)
+        body = tempfile.SpooledTemporaryFile(max_size=self.max_body_bytes or 16*MB)
+        with body:
+            copy_limited(req.stream, body, self.max_body_bytes)
+            body.seek(0)
+            chunk = body.read()
 
         url = req.params.get('url', None)
-        article = newspaper.Article(url, fetch_images=False)
-
-        article.download(input_html=chunk)
-        article.parse()
-        full_text = article.text.replace('\x00', '')
-        # full_html = article.html.replace('\x00', '')
-        # title = article.title.replace('\x00', '')
+        key = result = None
+        if self.cache is not None:
+            key = document_key(url, chunk, extractor_version)
+            result = self.cache.get(key)
+        if result is None:
+            result = html_to_article(url, chunk)
+            if self.cache is not None:
+                self.cache.put(key, result)
+        full_text, title, full_html = result
         resp.body = full_text
 
-api = falcon.API()
-api.add_route('/html_to_fulltext', HtmlToFulltextResource())
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError('document stream ended in the middle of a document')
+        data += more
+    return data
+
+
+def read_ndjson_documents(stream):
+    """one json object per line: {"id": ..., "url": ..., "html": ...}
+    """
+    for line in iter(stream.readline, b''):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode())
+        except ValueError as e:
+            # answered with an error line, like any other bad document
+            yield {'invalid': 'invalid json: {}'.format(e)}
+
+
+def read_length_prefixed_documents(stream):
+    """per document: a 4 byte big-endian length and that many bytes
+    of json header ({"id": ..., "url": ...}), then a 4 byte length and
+    that many bytes of html
+    """
+    while True:
+        prefix = stream.read(4)
+        if not prefix:
+            return
+        if len(prefix) < 4:
+            prefix += read_exactly(stream, 4 - len(prefix))
+        header_length, = struct.unpack('>I', prefix)
+        document = json.loads(read_exactly(stream, header_length).decode())
+        html_length, = struct.unpack('>I', read_exactly(stream, 4))
+        document['html'] = read_exactly(stream, html_length)
+        yield document
+
+
+class HtmlToFulltextBatchResource:
+    """Convert many documents over one connection
+
+    The request body is a stream of documents, as NDJSON
+    (Content-Type: application/x-ndjson, the default) or length
+    prefixed (Content-Type: application/octet-stream); see the
+    read_*_documents functions. The response streams one json line per
+    document, in request order:
+
+        {"id": ..., "url": ..., "text": ..., "title": ..., "html": ...}
+
+    or {"id": ..., "url": ..., "error": ...} for documents that failed.
+
+    Documents are parsed in a pool of `processes` worker processes,
+    and their results sent as soon as they and all documents before
+    them are done; at most `max_pending` are held in memory at once.
+
+    The request body is spooled (to disk above `spool_max_bytes`)
+    before the response starts, because most clients, requests
+    included, only read the response once they've sent the whole body;
+    if the server answered while the upload was still going on, both
+    sides could end up waiting for the other's socket buffer.
+    """
+    def __init__(self, processes=None, max_pending=None, spool_max_bytes=16*MB, max_body_bytes=None, cache=None):
+        self.cache = cache
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.processes
+        self.spool_max_bytes = spool_max_bytes
+        self.max_body_bytes = max_body_bytes
+        # created on first use, so that every gunicorn worker process
+        # gets a pool of its own after forking
+        self.pool = None
+
+    @staticmethod
+    def pool_context():
+        """forking a threaded (gthread) worker copies locks that other
+        threads may hold, so the pool's processes are started by a fork
+        server, which has newspaper imported already, or spawned where
+        there is none
+        """
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['article_parser'])
+            return context
+        return multiprocessing.get_context('spawn')
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=self.pool_context())
+        return self.pool
+
+    def on_post(self, req, resp):
+        check_content_length(req, self.max_body_bytes)
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes)
+        try:
+            copy_limited(req.stream, body, self.max_body_bytes)
+        except falcon.HTTPPayloadTooLarge:
+            body.close()
+            raise
+        body.seek(0)
+        if (req.content_type or '').startswith('application/octet-stream'):
+            documents = read_length_prefixed_documents(body)
+        else:
+            documents = read_ndjson_documents(body)
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self.convert(documents, body)
+
+    def convert(self, documents, body):
+        with body:
+            yield from self._convert(documents)
+
+    def _convert(self, documents):
+        pending = collections.deque()
+        for document in documents:
+            pending.append((document,) + self.submit(document))
+            while len(pending) >= self.max_pending or (pending and pending[0][2].done()):
+                yield self.result_line(*pending.popleft())
+        while pending:
+            yield self.result_line(*pending.popleft())
+
+    def submit(self, document):
+        """returns (cache key, future of the result); the key is None
+        if the result came from the cache or can't be cached
+        """
+        future = Future()
+        if 'html' not in document:
+            future.set_exception(ValueError(document.get('invalid', 'document has no html')))
+            return None, future
+        if self.cache is None:
+            return None, self.submit_to_pool(document)
+        key = document_key(document.get('url'), document['html'], extractor_version)
+        result = self.cache.get(key)
+        if result is not None:
+            future.set_result(result)
+            return None, future
+        return key, self.submit_to_pool(document)
+
+    def submit_to_pool(self, document):
+        try:
+            return self.get_pool().submit(html_to_article, document.get('url'), document['html'])
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for using too much memory);
+            # start over with a fresh pool
+            self.pool = None
+            return self.get_pool().submit(html_to_article, document.get('url'), document['html'])
+
+    def result_line(self, document, key, future):
+        result = {'id': document.get('id'), 'url': document.get('url')}
+        try:
+            result['text'], result['title'], result['html'] = future.result()
+            if key is not None:
+                self.cache.put(key, future.result())
+        except Exception as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return (json.dumps(result) + '\n').encode()
+
+
+class StatsResource:
+    """counters of the worker process that answers; with more than
+    one worker, request it a few times
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def on_get(self, req, resp):
+        stats = {'pid': os.getpid()}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        resp.content_type = 'application/json'
+        resp.body = json.dumps(stats)
+
+
+# settings per worker process; see gunicorn_config.py
+cache = None
+cache_mb = int(os.environ.get('HTML_TO_FULLTEXT_CACHE_MB', 64))
+if cache_mb:
+    disk_cache = None
+    if os.environ.get('HTML_TO_FULLTEXT_CACHE_FILE'):
+        disk_cache = DiskResultCache(
+            os.environ['HTML_TO_FULLTEXT_CACHE_FILE'],
+            max_bytes=env_int('HTML_TO_FULLTEXT_CACHE_FILE_MB', 1024) * MB,
+        )
+    cache = ResultCache(cache_mb * MB, disk=disk_cache)
+
+middleware = list()
+max_in_flight = env_int('HTML_TO_FULLTEXT_MAX_IN_FLIGHT', None)
+if max_in_flight:
+    middleware.append(Backpressure(
+        max_in_flight,
+        retry_after_seconds=env_int('HTML_TO_FULLTEXT_RETRY_AFTER_SECONDS', 1),
+    ))
+
+api = falcon.API(middleware=middleware)
+api.add_route('/html_to_fulltext', HtmlToFulltextResource(
+    max_body_bytes=env_int('HTML_TO_FULLTEXT_MAX_BODY_MB', 20) * MB,
+    cache=cache,
+))
+api.add_route('/html_to_fulltext/batch', HtmlToFulltextBatchResource(
+    processes=env_int('HTML_TO_FULLTEXT_PROCESSES', None),
+    max_body_bytes=env_int('HTML_TO_FULLTEXT_MAX_BATCH_MB', 1024) * MB,
+    cache=cache,
+))
+api.add_route('/stats', StatsResource(cache))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Load test the html_to_fulltext server
+
+Sends documents from `concurrency` threads for `duration` seconds and
+reports latency percentiles, documents per second and how many
+requests were turned away with 503.
+
+usage:
+    ./load_test_html_to_fulltext.py page1.html page2.html ... --concurrency 16
+    ./load_test_html_to_fulltext.py page.html --batch-size 50
+"""
+import argparse
+import collections
+import json
+import threading
+import time
+
+import requests
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest:
+    def __init__(self, server, pages, batch_size=0):
+        self.server = server
+        self.pages = pages
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.latencies = list()
+        self.statuses = collections.Counter()
+        self.documents = 0
+
+    def request(self, sess, i):
+        if not self.batch_size:
+            resp = sess.post(
+                self.server + '/html_to_fulltext',
+                data=self.pages[i % len(self.pages)],
+                params={'url': 'http://example.com/{}'.format(i)},
+            )
+            return resp.status_code, int(resp.status_code == 200)
+
+        body = b''.join(
+            (json.dumps({
+                'id': j,
+                'url': 'http://example.com/{}'.format(j),
+                'html': self.pages[j % len(self.pages)].decode(errors='replace'),
+            }) + '\n').encode()
+            for j in range(i, i + self.batch_size)
+        )
+        resp = sess.post(
+            self.server + '/html_to_fulltext/batch',
+            data=body,
+            headers={'Content-Type': 'application/x-ndjson'},
+        )
+        documents = 0
+        if resp.status_code == 200:
+            documents = sum(
+                'error' not in json.loads(line.decode())
+                for line in resp.content.splitlines()
+            )
+        return resp.status_code, documents
+
+    def worker(self, worker_id, deadline):
+        sess = requests.Session()
+        i = worker_id * 1000000
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                status, documents = self.request(sess, i)
+            except requests.exceptions.ConnectionError:
+                status, documents = 'connection error', 0
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.statuses[status] += 1
+                if status == 200:
+                    self.latencies.append(latency)
+                    self.documents += documents
+            i += max(1, self.batch_size)
+
+    def run(self, concurrency, duration_seconds):
+        deadline = time.time() + duration_seconds
+        threads = [
+            threading.Thread(target=self.worker, args=(n, deadline))
+            for n in range(concurrency)
+        ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def report(self, seconds):
+        latencies = sorted(self.latencies)
+        print('requests: {}'.format(dict(self.statuses)))
+        print('latency of successful requests: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 90),
+            1000 * percentile(latencies, 99),
+        ))
+        print('{:.1f} docs/sec'.format(self.documents / seconds))
+
+
+def run_main():
+    args = parse_cl_args()
+    pages = list()
+    for filepath in args.files:
+        with open(filepath, 'rb') as fr:
+            pages.append(fr.read())
+    load_test = LoadTest(args.server, pages, batch_size=args.batch_size)
+    seconds = load_test.run(args.concurrency, args.duration)
+    load_test.report(seconds)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(description='load test the html_to_fulltext server')
+    argParser.add_argument('files', nargs='+', help='html files to send')
+    argParser.add_argument('--server', default='http://localhost:7295')
+    argParser.add_argument('--concurrency', default=8, type=int)
+    argParser.add_argument('--duration', default=10, type=float, help='seconds')
+    argParser.add_argument(
+        '--batch-size', default=0, type=int,
+        help='send this many documents per request to the batch endpoint',
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
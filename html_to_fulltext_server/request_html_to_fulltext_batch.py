@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""Convert saved html files over one connection
+
+usage:
+    ./request_html_to_fulltext_batch.py page1.html page2.html ...
+"""
+import json
+import sys
+
+import requests
+
+
+def ndjson_documents(filepaths):
+    for filepath in filepaths:
+        with open(filepath, 'r', errors='replace') as fr:
+            document = {'id': filepath, 'url': None, 'html': fr.read()}
+        yield (json.dumps(document) + '\n').encode()
+
+
+# the generator makes requests send the body chunked, as it's read
+resp = requests.post(
+    'http://localhost:7295/html_to_fulltext/batch',
+    data=ndjson_documents(sys.argv[1:]),
+    headers={'Content-Type': 'application/x-ndjson'},
+    stream=True,
+)
+for line in resp.iter_lines():
+    result = json.loads(line.decode())
+    print(result['id'], result.get('title') or result.get('error'))
@@ -0,0 +1,180 @@
+"""Cache of extraction results, keyed by the hash of the document,
+its url and the version of the extractor
+
+The same page is often submitted again (re-crawls, one article linked
+from several newsletters), so results are kept in an in-process LRU
+bounded by bytes, and optionally in a sqlite file that all gunicorn
+workers share and that survives restarts.
+"""
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def document_key(url, html, version=''):
+    """the url is part of the key because newspaper uses it, e.g. to
+    resolve links, and the `version` of the extractor because another
+    version may extract other text
+    """
+    if isinstance(html, str):
+        html = html.encode()
+    key = hashlib.blake2b(digest_size=16)
+    # with their lengths, so that one part can't run into the next
+    for part in (version.encode(), (url or '').encode()):
+        key.update('{}:'.format(len(part)).encode())
+        key.update(part)
+    key.update(html)
+    return key.hexdigest()
+
+
+def result_size(result):
+    return sum(len(value) for value in result)
+
+
+class DiskResultCache:
+    """sqlite file shared by the worker processes, bounded by bytes
+    """
+    def __init__(self, filepath, max_bytes):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filepath, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                result TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_results_last_access
+            ON results (last_access)
+        ''')
+        # the total size, kept up to date by every worker process
+        self.conn.execute('CREATE TABLE IF NOT EXISTS totals (bytes INTEGER)')
+        if self.conn.execute('SELECT COUNT(*) FROM totals').fetchone()[0] == 0:
+            self.conn.execute('INSERT INTO totals VALUES (0)')
+        self.conn.commit()
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT bytes FROM totals').fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT result FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE results SET last_access = ? WHERE key = ?',
+                (time.time(), key),
+            )
+            self.conn.commit()
+        return tuple(json.loads(row[0]))
+
+    def put(self, key, result):
+        size = result_size(result)
+        with self.lock, self.conn:
+            old = self.conn.execute(
+                'SELECT size FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (key, json.dumps(result), size, time.time()),
+            )
+            self.conn.execute(
+                'UPDATE totals SET bytes = bytes + ?',
+                (size - (old[0] if old else 0),),
+            )
+            self._evict()
+
+    def _evict(self):
+        total_bytes = self.conn.execute('SELECT bytes FROM totals').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        # down to 90% of the limit, so that eviction doesn't happen
+        # on every put
+        target = self.max_bytes * 0.9
+        evict = list()
+        for key, size in self.conn.execute(
+                'SELECT key, size FROM results ORDER BY last_access'):
+            if total_bytes <= target:
+                break
+            evict.append((key,))
+            total_bytes -= size
+        self.conn.executemany('DELETE FROM results WHERE key = ?', evict)
+        self.conn.execute('UPDATE totals SET bytes = ?', (total_bytes,))
+
+
+class ResultCache:
+    """In-process LRU of at most `max_bytes`, in front of an optional
+    DiskResultCache. Results are (full_text, title, html) tuples.
+    """
+    def __init__(self, max_bytes, disk=None):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.total_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                self.memory_hits += 1
+                return result
+        if self.disk is not None:
+            result = self.disk.get(key)
+            if result is not None:
+                self.disk_hits += 1
+                self._remember(key, result)
+                return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.disk is not None:
+            self.disk.put(key, result)
+
+    def _remember(self, key, result):
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.results.pop(key, None)
+            if old is not None:
+                self.total_bytes -= result_size(old)
+            self.results[key] = result
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.results.popitem(last=False)
+                self.total_bytes -= result_size(evicted)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self.results),
+                'memory_bytes': self.total_bytes,
+                'memory_max_bytes': self.max_bytes,
+            }
+        if self.disk is not None:
+            stats['disk_bytes'] = self.disk.total_bytes
+            stats['disk_max_bytes'] = self.disk.max_bytes
+        return stats
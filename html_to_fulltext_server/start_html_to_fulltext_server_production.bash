@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+cd "$(dirname "$0")"
+gunicorn -c gunicorn_config.py html_to_fulltext:api
@@ -0,0 +1,50 @@
+"""Lightweight queries
+
+Helpers for reading rows without hydrating whole ORM objects, and for
+scanning whole tables in constant memory.
+"""
+
+
+def stream(query, batch_size=1000):
+    """iterate over `query` `batch_size` rows at a time, with a
+    server-side cursor where the database supports one, instead of
+    loading the whole result first.
+
+    the cursor stays open while iterating, so don't commit the
+    session in between; use in_batches() for that.
+    """
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def columns(sess, *cols, criteria=(), batch_size=1000):
+    """stream tuples of only `cols`, e.g.
+
+        for aid, url, title in columns(sess, Article.aid, Article.url, Article.title):
+            ...
+    """
+    return stream(sess.query(*cols).filter(*criteria), batch_size)
+
+
+def in_batches(query, id_col, batch_size=1000):
+    """yield lists of up to `batch_size` rows of `query` in order of
+    `id_col`, which must be unique and part of the rows.
+
+    every batch is a query of its own (keyset pagination), so rows
+    may be changed and the session committed between batches.
+    """
+    last_id = None
+    while True:
+        batch_query = query
+        if last_id is not None:
+            batch_query = batch_query.filter(id_col > last_id)
+        rows = batch_query.order_by(id_col).limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last_id = getattr(rows[-1], id_col.key)
+
+
+def exists(query):
+    """whether `query` has any rows, without loading one
+    """
+    return query.session.query(query.exists()).scalar()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Recall and latency of the similarity indexes
+
+Queries --queries random articles of a store with ExactIndex and with
+IVFIndex at every --n-probe, and prints each one's median and p99
+latency per query and, for IVFIndex, its recall@k: the share of the
+exact k nearest articles it found. Also times training the IVF lists
+and an incremental update() after a shard is added.
+
+Without --store, it runs on a synthetic corpus of --articles in a
+temporary directory: articles draw most of their words from one of
+--topics topics and the rest from a shared background vocabulary, both
+Zipf distributed, so that there are neighbourhoods to find.
+
+usage:
+    python benchmark_similarity.py --articles 100000 --json before.json
+    # ... change something ...
+    python benchmark_similarity.py --articles 100000 --compare before.json
+    python benchmark_similarity.py --store article_vectors
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.download_newsletter_archives.benchmark_fixture import (
+    compare_results, save_results,
+)
+from chromatic_news.recommender.similarity_index import ExactIndex, IVFIndex
+from chromatic_news.recommender.vector_store import VectorStore
+
+
+def zipf_probabilities(size):
+    probabilities = 1 / np.arange(1, size + 1)
+    return probabilities / probabilities.sum()
+
+
+def synthetic_rows(rng, num_articles, n_features, topics=50, topic_words=2000,
+                   background_words=50000, words_per_article=300, topic_share=0.6):
+    """(indptr, indices, data) of `num_articles` rows of 1 + log(count)
+    """
+    topic_features = rng.randint(0, n_features, size=(topics, topic_words))
+    background_features = rng.randint(0, n_features, size=background_words)
+    article_topics = rng.randint(0, topics, size=num_articles)
+    num_topic_words = int(words_per_article * topic_share)
+    rows = np.repeat(np.arange(num_articles), words_per_article)
+    columns = np.hstack([
+        topic_features[
+            article_topics[:, None],
+            rng.choice(topic_words, size=(num_articles, num_topic_words), p=zipf_probabilities(topic_words)),
+        ],
+        background_features[rng.choice(
+            background_words, size=(num_articles, words_per_article - num_topic_words),
+            p=zipf_probabilities(background_words),
+        )],
+    ]).ravel()
+    counts = scipy.sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+        shape=(num_articles, n_features),
+    )
+    counts.sum_duplicates()
+    counts.sort_indices()
+    return counts.indptr, counts.indices, 1 + np.log(counts.data)
+
+
+def synthetic_store(directory, num_articles, n_features, topics, seed, first_aid=1):
+    store = VectorStore(directory, n_features)
+    rng = np.random.RandomState(seed)
+    indptr, indices, data = synthetic_rows(rng, num_articles, n_features, topics)
+    store.add_shard(np.arange(first_aid, first_aid + num_articles), indptr, indices, data)
+    return store
+
+
+def latencies(index, queries, k):
+    """seconds of every query, and the aids found
+    """
+    seconds = list()
+    found = list()
+    for i in range(queries.shape[0]):
+        start = time.perf_counter()
+        aids, scores = index.search(queries[i], k)
+        seconds.append(time.perf_counter() - start)
+        found.append(aids[0])
+    return np.array(seconds), found
+
+
+def recall(found, exact):
+    return np.mean([
+        len(np.intersect1d(approximate_aids, exact_aids)) / max(len(exact_aids), 1)
+        for approximate_aids, exact_aids in zip(found, exact)
+    ])
+
+
+def summary(seconds):
+    return {
+        'p50_ms': 1000 * np.percentile(seconds, 50),
+        'p99_ms': 1000 * np.percentile(seconds, 99),
+    }
+
+
+def run_main():
+    args = parse_cl_args()
+    tmp_dir = None
+    if args.store:
+        store = VectorStore(args.store)
+        ivf_directory = tempfile.mkdtemp(prefix='chromatic_news_ivf_')
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='chromatic_news_vectors_')
+        start = time.perf_counter()
+        store = synthetic_store(tmp_dir, args.articles, args.n_features, args.topics, args.seed)
+        print('{} synthetic articles in {:.1f}s'.format(args.articles, time.perf_counter() - start))
+        ivf_directory = os.path.join(tmp_dir, 'ivf')
+
+    try:
+        results = dict()
+        exact = ExactIndex(store)
+        rng = np.random.RandomState(args.seed)
+        queries = exact.vectors(rng.choice(exact.aids, min(args.queries, len(exact)), replace=False))
+
+        seconds, exact_found = latencies(exact, queries, args.k)
+        results['exact'] = summary(seconds)
+        print('{:<16} p50 {:8.2f}ms  p99 {:8.2f}ms'.format(
+            'exact', results['exact']['p50_ms'], results['exact']['p99_ms'],
+        ))
+
+        start = time.perf_counter()
+        ivf = IVFIndex(store, directory=ivf_directory, n_lists=args.n_lists, dims=args.dims, seed=args.seed)
+        results['ivf_train'] = {'seconds': time.perf_counter() - start}
+        print('ivf: {} lists trained on {} articles in {:.2f}s'.format(
+            len(ivf.centroids), len(ivf), results['ivf_train']['seconds'],
+        ))
+        for n_probe in args.n_probe:
+            ivf.n_probe = n_probe
+            seconds, found = latencies(ivf, queries, args.k)
+            name = 'ivf_probe_{}'.format(n_probe)
+            results[name] = summary(seconds)
+            results[name]['recall_at_{}'.format(args.k)] = recall(found, exact_found)
+            print('{:<16} p50 {:8.2f}ms  p99 {:8.2f}ms  recall@{} {:.3f}'.format(
+                name, results[name]['p50_ms'], results[name]['p99_ms'],
+                args.k, results[name]['recall_at_{}'.format(args.k)],
+            ))
+
+        if tmp_dir is not None:
+            # what a vectorize_articles.py run that found new articles adds
+            num_new = max(args.articles // 100, 1)
+            rng = np.random.RandomState(args.seed + 1)
+            store.add_shard(
+                np.arange(args.articles + 1, args.articles + num_new + 1),
+                *synthetic_rows(rng, num_new, args.n_features, args.topics),
+            )
+            start = time.perf_counter()
+            ivf.update()
+            results['ivf_update'] = {'seconds': time.perf_counter() - start}
+            print('ivf: update() with {} new articles in {:.2f}s'.format(
+                num_new, results['ivf_update']['seconds'],
+            ))
+    finally:
+        shutil.rmtree(tmp_dir or ivf_directory, ignore_errors=True)
+
+    if args.json:
+        save_results(results, args.json)
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='measure recall and latency of the similarity indexes',
+    )
+    argParser.add_argument(
+        '--store', default=None, metavar='DIR',
+        help="vectors of vectorize_articles.py. default: a synthetic corpus",
+    )
+    argParser.add_argument('--articles', default=20000, type=int, help='synthetic articles')
+    argParser.add_argument('--topics', default=50, type=int, help='topics of the synthetic articles')
+    argParser.add_argument('--n-features', default=2**20, type=int)
+    argParser.add_argument('--queries', default=200, type=int)
+    argParser.add_argument('-k', default=10, type=int)
+    argParser.add_argument('--n-probe', default=[1, 4, 8, 16], type=int, nargs='+')
+    argParser.add_argument('--n-lists', default=None, type=int, help="default: sqrt(articles)")
+    argParser.add_argument('--dims', default=128, type=int, help='dimensions of the projection')
+    argParser.add_argument('--seed', default=0, type=int)
+    argParser.add_argument('--json', default=None, metavar='FILE', help='save the results')
+    argParser.add_argument(
+        '--compare', default=None, metavar='FILE',
+        help='compare with results saved with --json',
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
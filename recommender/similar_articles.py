@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""The articles most similar to some articles
+
+Prints the aid and cosine score of the -k articles nearest to all the
+given aids together (e.g. the ones a user liked), or with --each, to
+every one of them, from the vectors of vectorize_articles.py. Uses the
+approximate IVFIndex, which is brought up to date with the store
+first, or with --exact, scores every article; see similarity_index.py.
+
+usage:
+    python similar_articles.py 12 345 678 -k 20
+    python similar_articles.py 12 --exact --titles
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.recommender.similarity_index import ExactIndex, IVFIndex
+from chromatic_news.recommender.vector_store import VectorStore, default_directory
+
+
+def load_index(args):
+    store = VectorStore(args.store)
+    if args.exact:
+        return ExactIndex(store)
+    return IVFIndex(store, n_lists=args.n_lists, n_probe=args.n_probe)
+
+
+def titles_of(aids, db=None):
+    """{aid: title}, from the database of config.py or `db`
+    """
+    from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+        Article, get_engine, use_database,
+    )
+    from chromatic_news.dbutils import Base
+    if db:
+        use_database(db)
+    Base.set_sess(get_engine())
+    with Base.get_session() as sess:
+        query = sess.query(Article.aid, Article.title).filter(Article.aid.in_(aids))
+        return dict(query.all())
+
+
+def run_main():
+    args = parse_cl_args()
+    if not os.path.exists(os.path.join(args.store, 'meta.json')):
+        print('no vectors in {}; run vectorize_articles.py first; exiting'.format(args.store))
+        exit(1)
+    index = load_index(args)
+    try:
+        if args.each:
+            result_aids, scores = index.search(index.vectors(args.aids), args.k, exclude=args.aids)
+            results = [
+                [(aid, score) for aid, score in zip(row_aids.tolist(), row_scores.tolist()) if score != -float('inf')]
+                for row_aids, row_scores in zip(result_aids, scores)
+            ]
+        else:
+            results = [index.similar_to(args.aids, args.k)]
+    except KeyError as e:
+        print('{}; exiting'.format(e.args[0]))
+        exit(1)
+
+    titles = dict()
+    if args.titles:
+        titles = titles_of([aid for result in results for aid, score in result], args.db)
+    for number, result in enumerate(results):
+        if args.each:
+            print('{}similar to {}:'.format('\n' if number else '', args.aids[number]))
+        for aid, score in result:
+            print('{}\t{:.4f}{}'.format(aid, score, '\t' + (titles.get(aid) or '') if args.titles else ''))
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='list the articles most similar to some articles',
+    )
+    argParser.add_argument('aids', nargs='+', type=int)
+    argParser.add_argument('-k', default=10, type=int, help="articles to list. default %(default)s")
+    argParser.add_argument(
+        '--each', default=False, action='store_true',
+        help="the articles similar to every aid, rather than to all of them",
+    )
+    argParser.add_argument(
+        '--exact', default=False, action='store_true',
+        help="score every article instead of using the approximate index",
+    )
+    argParser.add_argument(
+        '--n-probe', default=8, type=int,
+        help="lists of the approximate index to score. default %(default)s",
+    )
+    argParser.add_argument(
+        '--n-lists', default=None, type=int,
+        help="lists of the approximate index when it's trained. default: sqrt(articles)",
+    )
+    argParser.add_argument(
+        '--store', default=default_directory, metavar='DIR',
+        help="directory of the vectors. default %(default)s",
+    )
+    argParser.add_argument(
+        '--titles', default=False, action='store_true',
+        help="print the titles of the articles, from the database",
+    )
+    argParser.add_argument(
+        '--db', default=None, metavar='URL',
+        help="database url to use instead of the one in config.py,\n"
+            "e.g. sqlite:///chromatic.db",
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,344 @@
+"""Nearest neighbours of articles by the cosine of their tf-idf vectors
+
+ExactIndex scores every article: the matrix of the store is multiplied
+with the queries `block_size` rows at a time, and only the best k of
+each block are kept, so memory stays bounded however big the corpus is.
+It's exact, and fast enough for up to some hundred thousand articles.
+
+IVFIndex (an inverted file index) only scores the articles in the
+clusters that are closest to the query. The tf-idf rows are projected
+to `dims` dense dimensions with a sparse random projection, and grouped
+by spherical k-means into `n_lists` lists; a query is projected the
+same way and its `n_probe` nearest lists are scored exactly with the
+sparse vectors. More probes find more of the true neighbours (recall)
+at the cost of latency; see benchmark_similarity.py.
+
+Both read a VectorStore, and update() picks up the articles that were
+vectorized since the index was loaded. IVFIndex keeps the centroids and
+the list of every article in `<store>/ivf/`, one file per shard of the
+store, so updating it only projects the new shard. Since idf changes as
+articles are added, new articles are assigned with the current weights;
+the lists are trained again once the store has grown `retrain_growth`
+times since they were.
+
+usage:
+    index = IVFIndex(VectorStore('article_vectors'))
+    index.update()
+    for aid, score in index.similar_to([liked_aid, other_liked_aid], k=10):
+        ...
+"""
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+def top_k(scores, k):
+    """column indices of the `k` largest scores of every row of the
+    dense `scores`, best first
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, columns, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1)
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class ExactIndex:
+    """usage:
+        index = ExactIndex(VectorStore('article_vectors'))
+        aids, scores = index.search(index.vectors([aid]), k=10)
+    """
+    def __init__(self, store, block_size=20000, dense_queries=16):
+        self.store = store
+        self.block_size = block_size
+        self.dense_queries = dense_queries
+        self.update()
+
+    def update(self):
+        """load the articles vectorized since
+        """
+        shards = self.store.shards()
+        self.shard_names = list(self.store.meta['shards'])
+        self.shard_sizes = [len(aids) for aids, matrix in shards]
+        self.aids = np.concatenate([aids for aids, matrix in shards]) if shards else np.zeros(0, dtype=np.int64)
+        # shards of articles committed late aren't in order of aid
+        self.sorted_rows = np.argsort(self.aids, kind='stable')
+        self.sorted_aids = self.aids[self.sorted_rows]
+        self.matrix = self.store.tfidf(shards)
+        # sliced once; slicing a csr matrix copies it
+        self.blocks = [
+            (start, self.matrix[start:start+self.block_size])
+            for start in range(0, len(self.aids), self.block_size)
+        ]
+
+    def __len__(self):
+        return len(self.aids)
+
+    def rows_of(self, aids):
+        """the rows of `aids`; KeyError for aids that aren't indexed
+        """
+        aids = np.asarray(list(aids), dtype=np.int64)
+        positions = np.searchsorted(self.sorted_aids, aids)
+        found = positions < len(self.aids)
+        found[found] = self.sorted_aids[positions[found]] == aids[found]
+        if not found.all():
+            raise KeyError('articles not vectorized: {}'.format(', '.join(str(aid) for aid in aids[~found])))
+        return self.sorted_rows[positions]
+
+    def vectors(self, aids):
+        """the tf-idf rows of `aids`, one query per article
+        """
+        return self.matrix[self.rows_of(aids)]
+
+    def profile(self, aids):
+        """one query for articles like all of `aids`: the normalized
+        sum of their vectors
+        """
+        vector = scipy.sparse.csr_matrix(self.vectors(aids).sum(axis=0), dtype=np.float32)
+        norm = np.sqrt(vector.multiply(vector).sum())
+        if norm:
+            vector = vector / norm
+        return scipy.sparse.csr_matrix(vector, dtype=np.float32)
+
+    def similar_to(self, aids, k=10):
+        """[(aid, score)] of the `k` articles most like all of `aids`,
+        without them
+        """
+        result_aids, scores = self.search(self.profile(aids), k, exclude=aids)
+        return [
+            (aid, score)
+            for aid, score in zip(result_aids[0].tolist(), scores[0].tolist())
+            if score != -np.inf
+        ]
+
+    def _exclude(self, exclude):
+        return self.rows_of(exclude) if len(exclude) else np.zeros(0, dtype=np.int64)
+
+    def search(self, queries, k=10, exclude=()):
+        """the aids and cosine scores of the `k` nearest articles of
+        every row of `queries` (a csr matrix), best first. there are
+        fewer than k when there aren't that many articles, and places
+        no article could fill have a score of -inf
+        """
+        excluded = self._exclude(exclude)
+        queries = scipy.sparse.csr_matrix(queries, dtype=np.float32)
+        # dense columns, since csr times dense is much faster than times
+        # sparse; a few at a time, each is n_features long
+        results = [
+            self._search_blocks(queries[first:first+self.dense_queries], k, excluded)
+            for first in range(0, queries.shape[0], self.dense_queries)
+        ]
+        if not results:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+        best_rows = np.vstack([rows for rows, scores in results])
+        return self.aids[best_rows], np.vstack([scores for rows, scores in results])
+
+    def _search_blocks(self, queries, k, excluded):
+        queries_t = queries.T.toarray()
+        best_rows = np.zeros((queries.shape[0], 0), dtype=np.int64)
+        best_scores = np.zeros((queries.shape[0], 0), dtype=np.float32)
+        for start, block in self.blocks:
+            scores = block.dot(queries_t).T
+            in_block = excluded[(excluded >= start) & (excluded < start + block.shape[0])]
+            scores[:, in_block - start] = -np.inf
+            columns = top_k(scores, k)
+            rows = np.hstack([best_rows, columns + start])
+            scores = np.hstack([best_scores, np.take_along_axis(scores, columns, axis=1)])
+            best = top_k(scores, k)
+            best_rows = np.take_along_axis(rows, best, axis=1)
+            best_scores = np.take_along_axis(scores, best, axis=1)
+        return best_rows, best_scores
+
+
+class IVFIndex(ExactIndex):
+    """ExactIndex's queries, answered from the `n_probe` lists nearest
+    to each query. The index is stored in `directory`, by default
+    `<store>/ivf/`; other parameters only apply when it is trained.
+    """
+    def __init__(self, store, directory=None, n_lists=None, n_probe=8, dims=128,
+                 seed=0, retrain_growth=2, block_size=20000, dense_queries=16):
+        self.directory = directory or os.path.join(store.directory, 'ivf')
+        self.meta = {
+            'dims': dims,
+            'seed': seed,
+            'n_lists': n_lists,
+            'trained_on': 0,
+            'shards': [],
+        }
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json')) as fr:
+                self.meta = json.load(fr)
+        self.n_probe = n_probe
+        self.retrain_growth = retrain_growth
+        self.centroids = None
+        self.lists = np.zeros(0, dtype=np.int32)
+        super().__init__(store, block_size, dense_queries)
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def project(self, matrix):
+        return normalize_rows(random_projection(matrix, self.meta['dims'], self.meta['seed']))
+
+    def update(self):
+        """load the articles vectorized since, and add them to the
+        lists, or train the lists again if the store has grown enough
+        """
+        super().update()
+        indexed = self.meta['shards']
+        if (
+            self.meta['trained_on'] == 0
+            or len(self) >= self.retrain_growth * self.meta['trained_on']
+            # the store was rebuilt
+            or indexed != self.shard_names[:len(indexed)]
+        ):
+            self.train()
+            return
+        self.centroids = np.load(self._path('centroids.npy'))
+        new_shards = self.shard_names[len(indexed):]
+        start = 0
+        for shard, size in zip(self.shard_names, self.shard_sizes):
+            if shard in new_shards:
+                np.save(self._path('lists-{}.npy'.format(shard)), self.assign(self.matrix[start:start+size]))
+            start += size
+        if new_shards:
+            self._save_meta(dict(self.meta, shards=self.shard_names))
+        self._load_lists()
+
+    def train(self, sample_size=50000, iterations=10):
+        """cluster (a sample of) the articles and assign all of them
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        n_lists = self.meta['n_lists'] or default_n_lists(len(self))
+        n_lists = max(1, min(n_lists, len(self)))
+        rng = np.random.RandomState(self.meta['seed'])
+        sample = np.arange(len(self))
+        if len(sample) > sample_size:
+            sample = np.sort(rng.choice(len(self), sample_size, replace=False))
+        self.centroids = spherical_kmeans(
+            self.project(self.matrix[sample]), n_lists, iterations, rng,
+        ) if len(self) else np.zeros((0, self.meta['dims']), dtype=np.float32)
+        np.save(self._path('centroids.npy'), self.centroids)
+        start = 0
+        for shard, size in zip(self.shard_names, self.shard_sizes):
+            np.save(self._path('lists-{}.npy'.format(shard)), self.assign(self.matrix[start:start+size]))
+            start += size
+        self._save_meta(dict(self.meta, n_lists=n_lists, trained_on=len(self), shards=self.shard_names))
+        self._load_lists()
+
+    def assign(self, matrix):
+        """the nearest list of every row of `matrix`
+        """
+        lists = [
+            nearest(self.project(matrix[start:start+self.block_size]), self.centroids)
+            for start in range(0, matrix.shape[0], self.block_size)
+        ]
+        if not lists:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate(lists).astype(np.int32)
+
+    def _save_meta(self, meta):
+        # replaced last, like the store's, so that a killed update
+        # leaves the index as it was
+        tmp_filepath = self._path('meta.json.tmp')
+        with open(tmp_filepath, 'w') as fw:
+            json.dump(meta, fw, indent=2)
+        os.replace(tmp_filepath, self._path('meta.json'))
+        self.meta = meta
+
+    def _load_lists(self):
+        lists = [np.load(self._path('lists-{}.npy'.format(shard))) for shard in self.shard_names]
+        self.lists = np.concatenate(lists) if lists else np.zeros(0, dtype=np.int32)
+        # the rows of list l are members[offsets[l]:offsets[l+1]]
+        self.members = np.argsort(self.lists, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=len(self.centroids)))])
+
+    def candidates(self, probes):
+        return np.sort(np.concatenate([
+            self.members[self.offsets[l]:self.offsets[l+1]] for l in probes
+        ] + [np.zeros(0, dtype=np.int64)]))
+
+    def search(self, queries, k=10, exclude=()):
+        """like ExactIndex.search, but only scores the articles in the
+        `n_probe` lists nearest to each query
+        """
+        excluded = self._exclude(exclude)
+        queries = scipy.sparse.csr_matrix(queries, dtype=np.float32)
+        num_queries = queries.shape[0]
+        probes = top_k(self.project(queries).dot(self.centroids.T), self.n_probe)
+        best_rows = np.zeros((num_queries, k), dtype=np.int64)
+        best_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        for i in range(num_queries):
+            rows = self.candidates(probes[i])
+            scores = self.matrix[rows].dot(queries[i].T).T.toarray()
+            scores[:, np.isin(rows, excluded)] = -np.inf
+            best = top_k(scores, k)[0]
+            best_rows[i, :len(best)] = rows[best]
+            best_scores[i, :len(best)] = scores[0, best]
+        return self.aids[best_rows], best_scores
+
+
+def default_n_lists(num_articles):
+    """about sqrt(n) lists, so that a probe scores about sqrt(n)
+    articles
+    """
+    return int(min(max(np.sqrt(num_articles), 1), 4096))
+
+
+def random_projection(matrix, dims, seed, nonzeros_per_feature=4):
+    """`matrix` times a random (n_features x dims) matrix of
+    +-1 entries, `nonzeros_per_feature` per row, as a dense array.
+    The entries of a feature are hashed from it rather than drawn, so
+    the projection is the same for every call with the same `seed`
+    without the matrix ever being built.
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    num_rows = matrix.shape[0]
+    rows = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(matrix.indptr))
+    features = matrix.indices.astype(np.int64)
+    prime = 2**31 - 1
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, size=(nonzeros_per_feature, 2)).astype(np.int64)
+    b = rng.randint(0, prime, size=(nonzeros_per_feature, 2)).astype(np.int64)
+    projected = np.zeros(num_rows * dims)
+    for j in range(nonzeros_per_feature):
+        dimensions = (a[j, 0] * features + b[j, 0]) % prime % dims
+        signs = ((a[j, 1] * features + b[j, 1]) % prime % 2) * 2 - 1
+        projected += np.bincount(
+            rows * dims + dimensions, weights=matrix.data * signs, minlength=num_rows * dims,
+        )
+    return projected.reshape(num_rows, dims).astype(np.float32)
+
+
+def nearest(vectors, centroids, block_size=10000):
+    """the index of the nearest of `centroids` of every row of
+    `vectors`, both normalized
+    """
+    return np.concatenate([
+        np.argmax(vectors[start:start+block_size].dot(centroids.T), axis=1)
+        for start in range(0, len(vectors), block_size)
+    ] + [np.zeros(0, dtype=np.int64)])
+
+
+def spherical_kmeans(vectors, n_clusters, iterations, rng):
+    """`n_clusters` normalized centroids of the normalized `vectors`
+    """
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        # clusters that lost all their vectors keep their centroid
+        empty = np.bincount(assignments, minlength=n_clusters) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize_rows(sums).astype(np.float32)
+    return centroids
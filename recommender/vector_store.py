@@ -0,0 +1,185 @@
+"""Article vectors on disk
+
+The term counts of every vectorized article, as sparse rows keyed by
+aid, in a directory of .npy files that are memory mapped when they're
+read:
+
+    meta.json         n_features, number of articles, the last aid,
+                      the shards and the current df file
+    df-NNNNN.npy      document frequency of every feature
+    vocabulary.tsv    token<TAB>feature of every token seen
+    NNNNN/            one shard per run, or per --shard-size articles
+                      or --shard-seconds:
+        aids.npy      int64, ascending
+        indptr.npy    int32 csr row pointers
+        indices.npy   int32 feature of every nonzero
+        data.npy      float32 1 + log(count) of every nonzero
+
+Shards only ever get added, so new articles are vectorized without
+touching the old ones. A shard may hold articles with a lower aid than
+the last one stored, ones that were committed late, so aids() is in the
+order of the shards rather than sorted. Counts rather than tf-idf weights are stored
+because idf changes with every article that's added; tfidf() weighs
+them with the current document frequencies when the matrix is loaded.
+
+meta.json is replaced last when a shard is added, so a run that is
+killed leaves the store as it was before the shard.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse
+
+
+default_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'article_vectors')
+
+
+class VectorStore:
+    """usage:
+        store = VectorStore('article_vectors')
+        aids, matrix = store.aids(), store.tfidf()
+    """
+    def __init__(self, directory, n_features=2**20):
+        self.directory = directory
+        self.meta = {
+            'n_features': n_features,
+            'num_articles': 0,
+            'last_aid': None,
+            'shards': [],
+            'df_file': None,
+        }
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json')) as fr:
+                self.meta = json.load(fr)
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    @property
+    def n_features(self):
+        return self.meta['n_features']
+
+    @property
+    def num_articles(self):
+        return self.meta['num_articles']
+
+    @property
+    def last_aid(self):
+        return self.meta['last_aid']
+
+    def _load(self, *names):
+        return np.load(self._path(*names), mmap_mode='r')
+
+    def shards(self):
+        """[(aids, csr matrix of term counts)], memory mapped
+        """
+        shards = list()
+        for shard in self.meta['shards']:
+            aids = self._load(shard, 'aids.npy')
+            matrix = scipy.sparse.csr_matrix(
+                (
+                    self._load(shard, 'data.npy'),
+                    self._load(shard, 'indices.npy'),
+                    self._load(shard, 'indptr.npy'),
+                ),
+                shape=(len(aids), self.n_features),
+                copy=False,
+            )
+            shards.append((aids, matrix))
+        return shards
+
+    def document_frequencies(self):
+        if self.meta['df_file'] is None:
+            return np.zeros(self.n_features, dtype=np.int64)
+        return self._load(self.meta['df_file'])
+
+    def idf(self):
+        """smoothed, like scikit-learn's: log((1 + n) / (1 + df)) + 1
+        """
+        df = self.document_frequencies()
+        return (np.log((1 + self.num_articles) / (1 + df.astype(np.float64))) + 1).astype(np.float32)
+
+    def aids(self):
+        if not self.meta['shards']:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([aids for aids, matrix in self.shards()])
+
+    def tfidf(self, shards=None):
+        """the l2 normalized tf-idf rows of all articles, in the order
+        of aids(), or of the (aids, matrix) `shards`
+        """
+        if shards is None:
+            shards = self.shards()
+        if not shards:
+            return scipy.sparse.csr_matrix((0, self.n_features), dtype=np.float32)
+        matrix = scipy.sparse.vstack([matrix for aids, matrix in shards], format='csr')
+        return weigh(matrix, self.idf())
+
+    def vocabulary(self):
+        """{token: feature}
+        """
+        vocabulary = dict()
+        if os.path.exists(self._path('vocabulary.tsv')):
+            with open(self._path('vocabulary.tsv'), encoding='utf-8') as fr:
+                for line in fr:
+                    token, feature = line.rstrip('\n').split('\t')
+                    vocabulary[token] = int(feature)
+        return vocabulary
+
+    def add_shard(self, aids, indptr, indices, data, new_tokens=()):
+        """store the rows of the articles `aids` (ascending, none of
+        them stored yet) and the tokens first seen with them,
+        {token: feature}
+        """
+        if not len(aids):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        number = len(self.meta['shards']) + 1
+        shard = '{:05d}'.format(number)
+        # left behind by a run that was killed before its meta.json
+        shutil.rmtree(self._path(shard), ignore_errors=True)
+        os.makedirs(self._path(shard))
+        np.save(self._path(shard, 'aids.npy'), np.asarray(aids, dtype=np.int64))
+        np.save(self._path(shard, 'indptr.npy'), np.asarray(indptr, dtype=np.int32))
+        np.save(self._path(shard, 'indices.npy'), np.asarray(indices, dtype=np.int32))
+        np.save(self._path(shard, 'data.npy'), np.asarray(data, dtype=np.float32))
+
+        # every article counts a feature once; its indices are unique
+        df = self.document_frequencies() + np.bincount(
+            np.asarray(indices, dtype=np.int64), minlength=self.n_features,
+        )
+        df_file = 'df-{}.npy'.format(shard)
+        np.save(self._path(df_file), df)
+
+        if new_tokens:
+            # a killed run may write tokens twice; vocabulary() keeps one
+            with open(self._path('vocabulary.tsv'), 'a', encoding='utf-8') as fw:
+                for token, feature in new_tokens.items():
+                    fw.write('{}\t{}\n'.format(token, feature))
+
+        old_df_file = self.meta['df_file']
+        meta = dict(self.meta)
+        meta.update({
+            'num_articles': self.num_articles + len(aids),
+            'last_aid': max(int(aids[-1]), self.last_aid or 0),
+            'shards': self.meta['shards'] + [shard],
+            'df_file': df_file,
+        })
+        tmp_filepath = self._path('meta.json.tmp')
+        with open(tmp_filepath, 'w') as fw:
+            json.dump(meta, fw, indent=2)
+        os.replace(tmp_filepath, self._path('meta.json'))
+        self.meta = meta
+        if old_df_file is not None:
+            os.remove(self._path(old_df_file))
+
+
+def weigh(matrix, idf):
+    """`matrix`'s rows times `idf`, l2 normalized
+    """
+    matrix = matrix.multiply(idf.reshape(1, -1)).tocsr().astype(np.float32)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return scipy.sparse.diags(1 / norms).dot(matrix).tocsr().astype(np.float32)
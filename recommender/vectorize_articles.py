@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""Turn the full_text of the articles into tf-idf vectors
+
+Reads the articles a batch at a time in order of aid, as plain rows of
+aid and text (texts in the blob store are fetched with one query per
+batch), and appends the term counts of every article to a VectorStore;
+see vector_store.py for the layout. Tokens are hashed into
+--n-features columns, so no vocabulary has to be built before the
+counts can be, and the whole corpus is read once.
+
+A store is only ever appended to: the next run vectorizes the articles
+with a larger aid than the last one stored, and those of the last
+--rescan-aids aids below it that aren't stored, which were committed
+after a higher aid had been. Use --rebuild after changing --n-features
+or the tokenizer.
+
+usage:
+    python vectorize_articles.py --store article_vectors
+
+    from chromatic_news.recommender.vector_store import VectorStore
+    store = VectorStore('article_vectors')
+    aids, matrix = store.aids(), store.tfidf()
+"""
+import os
+from os.path import dirname
+import sys
+import argparse
+from collections import Counter
+import math
+import re
+import shutil
+import time
+import zlib
+
+import numpy as np
+from sqlalchemy import func
+
+this_dir = dirname(os.path.abspath(__file__))
+sys.path.append(dirname(dirname(this_dir)))
+
+from chromatic_news.dbutils import Base, create_tables
+from chromatic_news.queryutils import in_batches
+from chromatic_news.download_newsletter_archives.blob_store import BlobNotFound
+from chromatic_news.recommender.vector_store import VectorStore, default_directory
+from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+    Article, SABase,
+    get_engine, make_blob_store, required_blob_store, schema_name, use_database,
+)
+
+
+token_pattern = re.compile(r'\w\w+')
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+class HashingVectorizer:
+    """term counts of texts, in `n_features` columns by the crc32 of
+    their tokens. `vocabulary` ({token: feature}) are the tokens seen
+    before; the ones seen for the first time are collected in
+    new_tokens.
+    """
+    def __init__(self, n_features, vocabulary=None):
+        self.n_features = n_features
+        self.vocabulary = vocabulary or dict()
+        self.new_tokens = dict()
+
+    def feature(self, token):
+        feature = self.vocabulary.get(token)
+        if feature is None:
+            feature = zlib.crc32(token.encode()) % self.n_features
+            self.vocabulary[token] = feature
+            self.new_tokens[token] = feature
+        return feature
+
+    def counts(self, text):
+        """(features, 1 + log(count) of each), in order of feature
+        """
+        counts = dict()
+        for token, count in Counter(tokenize(text)).items():
+            feature = self.feature(token)
+            # tokens that hash to the same feature count together
+            counts[feature] = counts.get(feature, 0) + count
+        features = sorted(counts)
+        return features, [1 + math.log(counts[feature]) for feature in features]
+
+
+class ShardWriter:
+    """collects rows until there are `shard_size` of them or
+    `shard_seconds` have passed, then adds them to `store` as a shard,
+    so that a killed run loses little work
+    """
+    def __init__(self, store, vectorizer, shard_size, shard_seconds=None):
+        self.store = store
+        self.vectorizer = vectorizer
+        self.shard_size = shard_size
+        self.shard_seconds = shard_seconds
+        self._reset()
+
+    def _reset(self):
+        self.started = time.time()
+        self.aids = list()
+        self.indptr = [0]
+        self.indices = list()
+        self.data = list()
+
+    def add(self, aid, text):
+        features, weights = self.vectorizer.counts(text)
+        self.aids.append(aid)
+        self.indices.extend(features)
+        self.data.extend(weights)
+        self.indptr.append(len(self.indices))
+        if len(self.aids) >= self.shard_size:
+            self.flush()
+        elif self.shard_seconds and time.time() - self.started >= self.shard_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self.aids:
+            return
+        self.store.add_shard(
+            np.array(self.aids, dtype=np.int64),
+            np.array(self.indptr, dtype=np.int32),
+            np.array(self.indices, dtype=np.int32),
+            np.array(self.data, dtype=np.float32),
+            self.vectorizer.new_tokens,
+        )
+        self.vectorizer.new_tokens = dict()
+        self._reset()
+
+
+def articles_to_vectorize(sess, start_after=None):
+    """the articles with text and an aid above `start_after`
+    """
+    query = sess.query(
+        Article.aid, Article._full_text, Article.full_text_hash,
+    ).filter(
+        func.coalesce(Article.full_text_hash, Article._full_text) != None,
+    )
+    if start_after is not None:
+        query = query.filter(Article.aid > start_after)
+    return query
+
+
+def texts_of(rows, blob_store):
+    """[(aid, full_text)] of the batch `rows`
+    """
+    stored = blob_store.get_texts(row.full_text_hash for row in rows if row.full_text_hash is not None)
+    texts = list()
+    for row in rows:
+        text = row._full_text
+        if row.full_text_hash is not None:
+            text = stored[row.full_text_hash]
+        if text:
+            texts.append((row.aid, text))
+    return texts
+
+
+def vectorize(batches, blob_store, writer, skip=()):
+    """add the articles of `batches` to `writer`, except the aids in
+    `skip`
+    """
+    start = time.time()
+    read = vectorized = 0
+    for rows in batches:
+        read += len(rows)
+        last_aid = rows[-1].aid
+        rows = [row for row in rows if row.aid not in skip]
+        for aid, text in texts_of(rows, blob_store):
+            writer.add(aid, text)
+            vectorized += 1
+        print('{} articles read, {} vectorized, up to aid {} ({:.0f} articles/sec)'.format(
+            read, vectorized, last_aid, read / max(time.time() - start, 1e-6),
+        ))
+    writer.flush()
+    return vectorized
+
+
+def rescan_window(store, rescan_aids):
+    """(aid to start after, aids stored above it): the articles above
+    last_aid, and the last `rescan_aids` aids below it, since an aid is
+    taken when a row is inserted but only seen once it's committed
+    """
+    if store.last_aid is None:
+        return None, set()
+    start_after = max(store.last_aid - rescan_aids, 0)
+    aids = store.aids()
+    return start_after, set(aids[aids > start_after].tolist())
+
+
+def run_main():
+    args = parse_cl_args()
+    if args.rebuild and os.path.exists(os.path.join(args.store, 'meta.json')):
+        shutil.rmtree(args.store)
+    store = VectorStore(args.store, n_features=args.n_features or 2**20)
+    if args.n_features and args.n_features != store.n_features:
+        print('{} has {} features; use --rebuild to change them; exiting'.format(
+            args.store, store.n_features,
+        ))
+        exit(1)
+
+    if args.db:
+        use_database(args.db)
+    engine = get_engine()
+    Base.set_sess(engine)
+    create_tables(engine, SABase, schema_name)
+    vectorizer = HashingVectorizer(store.n_features, store.vocabulary())
+    writer = ShardWriter(store, vectorizer, args.shard_size, args.shard_seconds)
+    start_after, stored = rescan_window(store, args.rescan_aids)
+    with Base.get_session() as sess:
+        blob_store = make_blob_store(sess, args)
+        batches = in_batches(
+            articles_to_vectorize(sess, start_after),
+            Article.aid, batch_size=args.batch_size,
+        )
+        try:
+            vectorized = vectorize(batches, blob_store, writer, skip=stored)
+        except BlobNotFound as e:
+            # the articles up to the last shard stay vectorized; the
+            # next run starts after them
+            print("texts missing from the blob store: {}; exiting".format(e.args[0]))
+            exit(1)
+    print('done: {} articles vectorized, {} in {}'.format(
+        vectorized, store.num_articles, args.store,
+    ))
+
+
+def parse_cl_args():
+    argParser = argparse.ArgumentParser(
+        description='turn the full_text of the articles into tf-idf vectors',
+    )
+    argParser.add_argument(
+        '--store', default=default_directory, metavar='DIR',
+        help="directory of the vectors. default %(default)s",
+    )
+    argParser.add_argument(
+        '--n-features', default=None, type=int,
+        help="columns the tokens are hashed into. default: the store's, or 2**20",
+    )
+    argParser.add_argument('--batch-size', default=1000, type=int)
+    argParser.add_argument(
+        '--shard-size', default=10000, type=int,
+        help="articles per shard. default %(default)s",
+    )
+    argParser.add_argument(
+        '--shard-seconds', default=300, type=int,
+        help="also store the articles vectorized so far as a shard after\n"
+            "this many seconds; 0 turns it off. default %(default)s",
+    )
+    argParser.add_argument(
+        '--rescan-aids', default=10000, type=int,
+        help="also vectorize articles that aren't stored among this many\n"
+            "aids below the last one stored, which were committed late.\n"
+            "default %(default)s",
+    )
+    argParser.add_argument(
+        '--rebuild', default=False, action='store_true',
+        help="vectorize all articles again, into a new store",
+    )
+    argParser.add_argument(
+        '--db', default=None, metavar='URL',
+        help="database url to use instead of the one in config.py,\n"
+            "e.g. sqlite:///chromatic.db",
+    )
+    argParser.add_argument(
+        '--blob-store', default='db', metavar='db|DIR', type=required_blob_store,
+        help="the blobs table (db) or a directory. default %(default)s",
+    )
+    argParser.add_argument('--compression-level', default=None, type=int)
+    argParser.add_argument(
+        '--compression-dictionary', default=None, metavar='FILE',
+        help="zstd dictionary of the stored texts; only needed when it\n"
+            "isn't saved in the blob store",
+    )
+    return argParser.parse_args()
+
+
+if __name__ == '__main__':
+    run_main()
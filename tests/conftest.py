@@ -0,0 +1,16 @@
+"""Makes the checkout importable as chromatic_news, the way the scripts
+import it, through a symlink when the checkout has another name
+"""
+import os
+from os.path import basename, dirname
+import sys
+import tempfile
+
+repo_dir = dirname(dirname(os.path.abspath(__file__)))
+
+if basename(repo_dir) == 'chromatic_news':
+    sys.path.insert(0, dirname(repo_dir))
+else:
+    package_parent = tempfile.mkdtemp(prefix='chromatic_news_tests_')
+    os.symlink(repo_dir, os.path.join(package_parent, 'chromatic_news'))
+    sys.path.insert(0, package_parent)
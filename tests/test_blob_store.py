@@ -0,0 +1,117 @@
+import pytest
+from sqlalchemy import Column, Integer, LargeBinary, MetaData, TEXT, Table, create_engine
+from sqlalchemy.orm import sessionmaker
+
+from chromatic_news.download_newsletter_archives import blob_store
+from chromatic_news.download_newsletter_archives.blob_store import (
+    BlobNotFound, Compressor, DatabaseBlobStore, DictionaryNotLoaded,
+    DirectoryBlobStore, content_hash, dictionary_key,
+)
+
+page = b'<html><body>' + b'<p>the same paragraph, again and again</p>' * 200 + b'</body></html>'
+
+
+@pytest.fixture
+def sess():
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    table = Table(
+        'blobs', metadata,
+        Column('hash', TEXT, primary_key=True),
+        Column('data', LargeBinary),
+        Column('size', Integer),
+    )
+    metadata.create_all(engine)
+    sess = sessionmaker(bind=engine)()
+    sess.blobs = table
+    yield sess
+    sess.close()
+
+
+def test_compression_round_trip():
+    compressor = Compressor()
+    blob = compressor.compress(page)
+    assert len(blob) < len(page) / 10
+    assert compressor.decompress(blob) == page
+    assert compressor.decompress(blob_store.RAW + page) == page
+
+
+def test_bodies_compressed_differently_are_read_side_by_side(monkeypatch):
+    zstd_blob = Compressor().compress(page)
+    monkeypatch.setattr(blob_store, 'zstandard', None)
+    zlib_compressor = Compressor()
+    zlib_blob = zlib_compressor.compress(page)
+    assert zlib_blob[:1] == blob_store.ZLIB
+    assert zlib_compressor.decompress(zlib_blob) == page
+    monkeypatch.undo()
+    assert Compressor().decompress(zlib_blob) == Compressor().decompress(zstd_blob) == page
+
+
+def test_directory_store(tmp_path):
+    store = DirectoryBlobStore(str(tmp_path))
+    key = store.put_text('some text')
+    assert key == content_hash(b'some text')
+    assert store.put_text('some text') == key
+    assert DirectoryBlobStore(str(tmp_path)).get_text(key) == 'some text'
+    with pytest.raises(BlobNotFound):
+        store.get_text(content_hash(b'other text'))
+
+
+def test_database_store_only_knows_committed_blobs(sess):
+    store = DatabaseBlobStore(sess, sess.blobs)
+    key = store.put(page)
+    assert key not in store.known
+    sess.rollback()
+    assert not store.pending
+    with pytest.raises(BlobNotFound):
+        store.get(key)
+    # stored again, since it wasn't known
+    assert store.put(page) == key
+    sess.commit()
+    assert key in store.known
+    assert store.get(key) == page
+
+
+def test_get_texts_reports_missing_keys(sess):
+    store = DatabaseBlobStore(sess, sess.blobs)
+    keys = [store.put_text('a'), store.put_text('b')]
+    sess.commit()
+    assert store.get_texts(keys) == {keys[0]: 'a', keys[1]: 'b'}
+    missing = content_hash(b'c')
+    with pytest.raises(BlobNotFound) as e:
+        store.get_texts(keys + [missing])
+    assert missing in str(e.value)
+
+
+def test_known_hashes_are_capped(sess, monkeypatch):
+    monkeypatch.setattr(DatabaseBlobStore, 'max_known', 3)
+    store = DatabaseBlobStore(sess, sess.blobs)
+    keys = [store.put_text(str(i)) for i in range(5)]
+    sess.commit()
+    assert list(store.known) == keys[2:]
+    # forgotten hashes are looked up in the table instead
+    assert store.put_text('0') == keys[0]
+    assert store.get_text(keys[0]) == '0'
+
+
+def test_readers_find_the_dictionary_in_the_store(sess):
+    zstandard = pytest.importorskip('zstandard')
+    samples = [
+        '<html><p>article {} about {}</p><div class="footer">unsubscribe</div></html>'.format(i, i * 7).encode()
+        for i in range(300)
+    ]
+    dictionary = zstandard.train_dictionary(2048, samples).as_bytes()
+    writer = DatabaseBlobStore(sess, sess.blobs, Compressor(dictionary=dictionary))
+    key = writer.put(samples[0])
+    sess.commit()
+    dict_id = writer.compressor.dictionary.dict_id()
+    assert writer.get(dictionary_key(dict_id)) == dictionary
+
+    reader = DatabaseBlobStore(sess, sess.blobs)
+    assert reader.get(key) == samples[0]
+    assert reader.get_texts([key]) == {key: samples[0].decode()}
+
+    sess.execute(sess.blobs.delete().where(sess.blobs.c.hash == dictionary_key(dict_id)))
+    with pytest.raises(DictionaryNotLoaded) as e:
+        DatabaseBlobStore(sess, sess.blobs).get(key)
+    assert e.value.dict_id == dict_id
@@ -0,0 +1,46 @@
+from chromatic_news.download_newsletter_archives.canonicalize import Canonicalizer
+
+
+def test_strips_tracking_params_and_fragment():
+    canonicalize = Canonicalizer()
+    assert canonicalize(
+        'https://Example.com:443/a/b?utm_source=x&id=3&mc_cid=9#top'
+    ) == 'https://example.com/a/b?id=3'
+
+
+def test_sorts_query_without_reencoding_it():
+    canonicalize = Canonicalizer()
+    assert canonicalize('http://example.com/?b=a%20b&a=1') == 'http://example.com/?a=1&b=a%20b'
+    # a parameter without a value stays one
+    assert canonicalize('http://example.com/p?12345') == 'http://example.com/p?12345'
+    assert Canonicalizer(sort_query=False)('http://example.com/?b=2&a=1') == 'http://example.com/?b=2&a=1'
+
+
+def test_trailing_slash_is_kept_by_default():
+    assert Canonicalizer()('http://example.com/a/') == 'http://example.com/a/'
+    stripping = Canonicalizer(strip_trailing_slash=True)
+    assert stripping('http://example.com/a/') == 'http://example.com/a'
+    assert stripping('http://example.com/') == 'http://example.com/'
+
+
+def test_unwraps_redirectors():
+    canonicalizer = Canonicalizer()
+    wrapped = 'https://www.google.com/url?q=https://example.com/story?id%3D1%26utm_medium%3Demail&sa=D'
+    assert canonicalizer.canonicalize(wrapped) == 'https://example.com/story?id=1'
+    # what's fetched is the wrapped url as it was, not the canonical form
+    assert canonicalizer.unwrap(wrapped) == 'https://example.com/story?id=1&utm_medium=email'
+    assert canonicalizer.unwrap('http://example.com/a/?x') == 'http://example.com/a/?x'
+
+
+def test_rules_from_file(tmp_path):
+    rules = tmp_path / 'rules.txt'
+    rules.write_text(
+        '# comment\n'
+        'strip_param ref\n'
+        'redirector go.example.com /r to\n'
+        'sort_query no\n'
+    )
+    canonicalizer = Canonicalizer.from_file(str(rules))
+    assert canonicalizer('http://go.example.com/r?to=http://a.com/?z=1%26ref=2%26utm_source=3') == 'http://a.com/?z=1&utm_source=3'
+    assert canonicalizer.fingerprint != Canonicalizer().fingerprint
+    assert Canonicalizer().fingerprint == Canonicalizer().fingerprint
@@ -0,0 +1,62 @@
+"""Smoke test: every command line script starts and prints its --help
+
+The scripts import the package as chromatic_news, from the directory
+above the checkout, so they're run through a chromatic_news symlink to
+it. PYTHONPATH is cleared, so that nothing imported by the environment
+(e.g. sqlalchemy.orm) hides an import a script is missing.
+
+usage:
+    python -m pytest tests
+"""
+import os
+from os.path import dirname
+import subprocess
+import sys
+
+import pytest
+
+repo_dir = dirname(dirname(os.path.abspath(__file__)))
+
+scripts = [
+    'download_newsletter_archives/benchmark_crawl.py',
+    'download_newsletter_archives/benchmark_fixture.py',
+    'download_newsletter_archives/benchmark_functions.py',
+    'download_newsletter_archives/benchmark_links.py',
+    'download_newsletter_archives/benchmark_startup.py',
+    'download_newsletter_archives/compress_pages.py',
+    'download_newsletter_archives/download_newsletter_archives.py',
+    'download_newsletter_archives/reextract_articles.py',
+    'recommender/benchmark_similarity.py',
+    'recommender/similar_articles.py',
+    'recommender/vectorize_articles.py',
+]
+# import download_newsletter_archives.py, which needs config.py
+needs_config = {
+    'download_newsletter_archives/benchmark_functions.py',
+    'download_newsletter_archives/compress_pages.py',
+    'download_newsletter_archives/download_newsletter_archives.py',
+    'download_newsletter_archives/reextract_articles.py',
+    'recommender/vectorize_articles.py',
+}
+has_config = os.path.exists(os.path.join(repo_dir, 'download_newsletter_archives', 'config.py'))
+
+
+@pytest.fixture(scope='module')
+def package_dir(tmp_path_factory):
+    parent = tmp_path_factory.mktemp('package')
+    os.symlink(repo_dir, str(parent / 'chromatic_news'))
+    return str(parent / 'chromatic_news')
+
+
+@pytest.mark.parametrize('script', scripts)
+def test_help(script, package_dir):
+    if script in needs_config and not has_config:
+        pytest.skip('needs download_newsletter_archives/config.py')
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    proc = subprocess.run(
+        [sys.executable, os.path.join(package_dir, script), '--help'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, timeout=120,
+    )
+    assert proc.returncode == 0, proc.stderr.decode()
+    assert proc.stdout.decode().startswith('usage:')
@@ -0,0 +1,56 @@
+from chromatic_news.download_newsletter_archives.domain_matcher import DomainMatcher
+
+
+def test_bare_domain_matches_it_and_its_subdomains():
+    matcher = DomainMatcher(['Example.com.'])
+    assert matcher.matches('http://example.com/a')
+    assert matcher.matches('https://news.EXAMPLE.com:8080/a')
+    assert not matcher.matches('http://notexample.com/')
+    assert not matcher.matches('http://example.com.au/')
+
+
+def test_subdomains_only():
+    matcher = DomainMatcher(['*.example.com'])
+    assert matcher.matches('http://a.b.example.com/')
+    assert not matcher.matches('http://example.com/')
+
+
+def test_exact_host_only():
+    matcher = DomainMatcher(['=example.com'])
+    assert matcher.matches('http://example.com/')
+    assert not matcher.matches('http://www.example.com/')
+
+
+def test_legacy_substring_rules():
+    matcher = DomainMatcher(['example.com/ads'])
+    assert matcher.matches('http://cdn.example.com/ads/1.png')
+    assert matcher.matches('http://other.com/?u=HTTP://EXAMPLE.COM/ADS')
+    assert not matcher.matches('http://example.com/news')
+
+
+def test_comments_and_urls_without_host():
+    matcher = DomainMatcher(['# example.com', '', 'a.com'])
+    assert len(matcher) == 1
+    assert 'http://a.com/' in matcher
+    assert not matcher.matches('mailto:x@a.com')
+    assert not matcher.matches('http://[invalid/')
+    assert list(DomainMatcher(['b.com', '=c.com', '*.d.com', 'e.com/x'])) == ['b.com', '=c.com', '*.d.com', 'e.com/x']
+
+
+def test_refresh_reads_appended_lines(tmp_path):
+    filepath = tmp_path / 'ignore_domains.txt'
+    filepath.write_text('a.com\n')
+    matcher = DomainMatcher.from_file(str(filepath))
+    with open(filepath, 'a') as fw:
+        fw.write('b.com\nc.c')
+    matcher.refresh()
+    assert matcher.matches('http://b.com/') and not matcher.matches('http://c.c/')
+    # the incomplete line is read once it's complete
+    with open(filepath, 'a') as fw:
+        fw.write('om\n')
+    matcher.refresh()
+    assert matcher.matches('http://c.com/') and len(matcher) == 3
+    # a rewritten file is read again from the start
+    filepath.write_text('d.com\n')
+    matcher.refresh()
+    assert list(matcher) == ['d.com']
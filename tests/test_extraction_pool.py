@@ -0,0 +1,35 @@
+import os
+import time
+
+import pytest
+
+from chromatic_news.download_newsletter_archives.extraction import (
+    ExtractionFailed, ExtractionPool,
+)
+
+
+def test_a_job_past_its_timeout_is_killed_and_the_pool_goes_on():
+    with ExtractionPool(processes=1, timeout_seconds=3) as pool:
+        first_pid = pool.submit(os.getpid).result()
+        started = time.monotonic()
+        with pytest.raises(ExtractionFailed, match='timed out after 3 seconds'):
+            pool.submit(time.sleep, 60).result()
+        assert time.monotonic() - started < 30
+        # the job ran in a fresh worker
+        assert pool.submit(os.getpid).result() != first_pid
+
+
+def test_errors_fail_only_their_job():
+    with ExtractionPool(processes=2, timeout_seconds=30) as pool:
+        futures = [pool.submit(divmod, 7, d) for d in (2, 0, 3)]
+        assert futures[0].result() == (3, 1)
+        with pytest.raises(ExtractionFailed, match='ZeroDivisionError'):
+            futures[1].result()
+        assert futures[2].result() == (2, 1)
+
+
+def test_no_jobs_after_shutdown():
+    pool = ExtractionPool(processes=1)
+    pool.shutdown()
+    with pytest.raises(RuntimeError):
+        pool.submit(os.getpid)
@@ -0,0 +1,155 @@
+import pytest
+from sqlalchemy import Column, Float, Index, Integer, MetaData, TEXT, Table, create_engine
+from sqlalchemy.orm import sessionmaker
+
+from chromatic_news.download_newsletter_archives import frontier as frontier_module
+from chromatic_news.download_newsletter_archives.frontier import (
+    ARCHIVE, ARTICLE, DONE, FAILED, IN_PROGRESS, NEWSLETTER, PENDING, Frontier,
+)
+
+metadata = MetaData()
+table = Table(
+    'frontier', metadata,
+    Column('fid', Integer, primary_key=True, autoincrement=True),
+    Column('kind', TEXT, nullable=False),
+    Column('key', TEXT, nullable=False),
+    Column('url', TEXT, nullable=False),
+    Column('parent_url', TEXT),
+    Column('priority', Integer, nullable=False),
+    Column('state', TEXT, nullable=False),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('worker', TEXT),
+    Column('lease_expires', Float),
+    Column('error', TEXT),
+    Index('ix_frontier_kind_key', 'kind', 'key', unique=True),
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frontier_module, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def sessionmaker_(tmp_path):
+    # a file, so that every worker has its own connection
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'frontier.db'))
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def worker(sessionmaker_, worker_id, **kwargs):
+    return Frontier(
+        sessionmaker_(), table, canonicalize=lambda url: url.split('?')[0],
+        worker_id=worker_id, **kwargs
+    )
+
+
+def states(frontier):
+    return {
+        url: (state, attempts)
+        for url, state, attempts in frontier.sess.execute(
+            table.select().with_only_columns([table.c.url, table.c.state, table.c.attempts])
+        )
+    }
+
+
+def test_adds_each_canonical_url_once(sessionmaker_, clock):
+    frontier = worker(sessionmaker_, 'a')
+    frontier.add(['http://a.com/1?utm_source=x', 'http://a.com/1', 'http://a.com/2'], ARTICLE)
+    frontier.add(['http://a.com/2?ref=y'], ARTICLE)
+    # another kind is another entry
+    frontier.add(['http://a.com/2'], NEWSLETTER)
+    frontier.sess.commit()
+    assert frontier.counts() == {(ARTICLE, PENDING): 2, (NEWSLETTER, PENDING): 1}
+
+
+def test_claims_articles_first_and_never_twice(sessionmaker_, clock):
+    a = worker(sessionmaker_, 'a')
+    b = worker(sessionmaker_, 'b')
+    a.add(['http://archive.com/'], ARCHIVE)
+    a.add(['http://nl.com/1'], NEWSLETTER)
+    a.add(['http://a.com/1', 'http://a.com/2'], ARTICLE)
+    a.sess.commit()
+    claimed = a.claim(2)
+    assert [entry.url for entry in claimed] == ['http://a.com/1', 'http://a.com/2']
+    assert [entry.url for entry in b.claim(10)] == ['http://nl.com/1', 'http://archive.com/']
+    assert a.claim(10) == [] and b.claim(10) == []
+    assert not a.is_finished()
+
+
+def test_done_and_fail(sessionmaker_, clock):
+    frontier = worker(sessionmaker_, 'a', max_attempts=2)
+    frontier.add(['http://a.com/1', 'http://a.com/2', 'http://a.com/3'], ARTICLE)
+    frontier.sess.commit()
+    done, retried, given_up = frontier.claim(3)
+    frontier.done(done)
+    frontier.fail(retried, 'timed out')
+    frontier.fail(given_up, 'not found', retry=False)
+    frontier.sess.commit()
+    assert states(frontier) == {
+        'http://a.com/1': (DONE, 1),
+        'http://a.com/2': (PENDING, 1),
+        'http://a.com/3': (FAILED, 1),
+    }
+    retried, = frontier.claim(3)
+    assert retried.attempts == 2
+    frontier.fail(retried, 'timed out')
+    frontier.sess.commit()
+    # max_attempts reached
+    assert states(frontier)['http://a.com/2'] == (FAILED, 2)
+    assert frontier.is_finished()
+
+
+def test_expired_leases_are_taken_over(sessionmaker_, clock):
+    a = worker(sessionmaker_, 'a', lease_seconds=60, max_attempts=2)
+    b = worker(sessionmaker_, 'b', lease_seconds=60, max_attempts=2)
+    a.add(['http://a.com/1'], ARTICLE)
+    a.sess.commit()
+    entry, = a.claim()
+    clock.now += 30
+    assert b.claim() == []
+    clock.now += 31
+    taken_over, = b.claim()
+    assert taken_over.attempts == 2
+    # a's lease is gone, so its late result is ignored
+    a.done(entry)
+    a.sess.commit()
+    assert states(a)['http://a.com/1'] == (IN_PROGRESS, 2)
+    # the entry killed both workers, so it isn't tried a third time
+    clock.now += 61
+    assert a.claim() == []
+    assert states(a)['http://a.com/1'] == (FAILED, 2)
+
+
+def test_release_gives_back_the_entries_of_a_killed_worker(sessionmaker_, clock):
+    killed = worker(sessionmaker_, 'a')
+    killed.add(['http://a.com/1'], ARTICLE)
+    killed.sess.commit()
+    killed.claim()
+    restarted = worker(sessionmaker_, 'a')
+    restarted.release()
+    entry, = restarted.claim()
+    assert entry.url == 'http://a.com/1'
+
+
+def test_reset(sessionmaker_, clock):
+    frontier = worker(sessionmaker_, 'a')
+    frontier.add(['http://archive.com/'], ARCHIVE)
+    frontier.add(['http://a.com/1'], ARTICLE)
+    frontier.sess.commit()
+    for entry in frontier.claim(2):
+        frontier.done(entry)
+    frontier.sess.commit()
+    frontier.reset(kind=ARCHIVE)
+    assert frontier.counts() == {(ARCHIVE, PENDING): 1, (ARTICLE, DONE): 1}
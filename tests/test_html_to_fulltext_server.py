@@ -0,0 +1,65 @@
+import json
+import os
+from os.path import dirname
+import sys
+
+import pytest
+
+falcon = pytest.importorskip('falcon')
+pytest.importorskip('newspaper')
+import falcon.testing
+
+# the server imports its modules from its own directory, as gunicorn
+# runs it
+server_dir = os.path.join(dirname(dirname(os.path.abspath(__file__))), 'html_to_fulltext_server')
+sys.path.insert(0, server_dir)
+import html_to_fulltext
+from html_to_fulltext import Backpressure, HtmlToFulltextBatchResource
+
+page = (
+    '<html><head><title>Title</title></head><body><article>'
+    + '<p>A fairly long sentence about science and the news in this article.</p>' * 20
+    + '</article></body></html>'
+)
+
+
+def test_pool_processes_are_not_forked_from_the_worker():
+    context = HtmlToFulltextBatchResource.pool_context()
+    assert context.get_start_method() in ('forkserver', 'spawn')
+
+
+def test_batch_answers_in_request_order():
+    api = falcon.API()
+    resource = HtmlToFulltextBatchResource(processes=2, cache=html_to_fulltext.cache)
+    api.add_route('/batch', resource)
+    documents = [{'id': i, 'url': 'http://a.com/{}'.format(i), 'html': page} for i in range(3)]
+    documents.insert(1, {'id': 'no html'})
+    body = '\n'.join(json.dumps(document) for document in documents) + '\nnot json\n'
+    try:
+        response = falcon.testing.TestClient(api).simulate_post('/batch', body=body)
+    finally:
+        if resource.pool is not None:
+            resource.pool.shutdown()
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [result['id'] for result in results] == [0, 'no html', 1, 2, None]
+    assert results[0]['title'] == 'Title' and 'science' in results[0]['text']
+    assert 'no html' in results[1]['error'] and 'invalid json' in results[4]['error']
+
+
+def test_backpressure_turns_requests_away():
+    backpressure = Backpressure(max_in_flight=1, retry_after_seconds=3)
+
+    class Slow:
+        def on_get(self, req, resp):
+            # a second request while this one is in flight
+            with pytest.raises(falcon.HTTPServiceUnavailable) as e:
+                backpressure.process_request(falcon.Request(falcon.testing.create_environ()), None)
+            assert e.value.headers['Retry-After'] == '3'
+            resp.body = 'ok'
+
+    api = falcon.API(middleware=[backpressure])
+    api.add_route('/slow', Slow())
+    client = falcon.testing.TestClient(api)
+    assert client.simulate_get('/slow').text == 'ok'
+    # the slot was given back
+    assert client.simulate_get('/slow').text == 'ok'
@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+
+import pytest
+
+from chromatic_news.download_newsletter_archives.politeness import (
+    DomainScheduler, TokenBucket, parse_retry_after,
+)
+
+
+def test_parse_retry_after():
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    assert parse_retry_after(' 120 ') == 120
+    assert parse_retry_after('Mon, 01 Jan 2024 12:00:30 GMT', now=now) == 30
+    # a date that passed already
+    assert parse_retry_after('Mon, 01 Jan 2024 11:00:00 GMT', now=now) == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after('-5') is None
+    assert parse_retry_after(None) is None
+
+
+def test_token_bucket_allows_bursts_then_the_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take(0)
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0
+    bucket.take(0.5)
+    # refilled to no more than the burst
+    assert bucket.delay(100) == 0
+    for _ in range(3):
+        bucket.take(100)
+    assert bucket.delay(100) == pytest.approx(0.5)
+
+
+def test_backoff_doubles_and_honors_retry_after():
+    scheduler = DomainScheduler(base_backoff_seconds=1, max_backoff_seconds=5)
+    url = 'http://a.com/1'
+    assert [scheduler.record_response(url, 503) for _ in range(4)] == [1, 2, 4, 5]
+    assert scheduler.record_response(url, 429, {'Retry-After': '3'}) == 3
+    assert scheduler.record_response(url, 200) is None
+    assert scheduler.record_response(url, 429) == 1
+    # other domains aren't backed off
+    assert scheduler.record_response('http://b.com/', 503) == 1
+    assert scheduler.stats['a.com'].backoffs == 6
+
+
+def test_requests_in_flight_are_capped_per_domain():
+    scheduler = DomainScheduler(rate=1000, burst=10, max_in_flight=2)
+    in_flight = {'a.com': 0, 'b.com': 0}
+    most = dict(in_flight)
+
+    async def request(url, domain):
+        async with scheduler.slot(url):
+            in_flight[domain] += 1
+            most[domain] = max(most[domain], in_flight[domain])
+            await asyncio.sleep(0.01)
+            in_flight[domain] -= 1
+
+    async def crawl():
+        await asyncio.gather(*(
+            request('http://{}/{}'.format(domain, i), domain)
+            for i in range(6) for domain in in_flight
+        ))
+    asyncio.run(crawl())
+    assert most == {'a.com': 2, 'b.com': 2}
+    assert scheduler.stats['a.com'].requests == 6
+    assert scheduler.stats['a.com'].max_queue_depth >= 4
@@ -0,0 +1,135 @@
+from concurrent.futures import wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import pytest
+
+from chromatic_news.download_newsletter_archives import extraction
+from chromatic_news.download_newsletter_archives.extraction import (
+    ExtractionFailed, ExtractionServerError, RemoteExtractor,
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """answers the batch endpoint with the html upper-cased as the text,
+    a chunk per document like gunicorn; `statuses` are answered first,
+    one per request
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def write_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        documents = [
+            json.loads(line)
+            for line in self.rfile.read(int(self.headers['Content-Length'])).splitlines()
+        ]
+        self.server.batches.append([document['html'] for document in documents])
+        if self.server.statuses:
+            self.send_response(self.server.statuses.pop(0))
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for document in documents:
+                result = {'id': document['id'], 'url': document['url']}
+                if document['html'] == 'slow':
+                    time.sleep(1)
+                if document['html'] == 'bad':
+                    result['error'] = 'ArticleException: no text'
+                else:
+                    result.update(text=document['html'].upper(), title='title', html='')
+                self.write_chunk((json.dumps(result) + '\n').encode())
+            self.write_chunk(b'')
+        except OSError:
+            # the client gave up
+            pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    server.batches = list()
+    server.statuses = list()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def extractor_for(server, **kwargs):
+    return RemoteExtractor('http://localhost:{}/'.format(server.server_port), **kwargs)
+
+
+def test_pages_submitted_together_are_sent_together(server):
+    with extractor_for(server, batch_size=3, batch_wait_seconds=0.5) as extractor:
+        futures = [
+            extractor.submit('http://a.com/{}'.format(i), 'page {}'.format(i).encode(), 'text/html')
+            for i in range(4)
+        ]
+        results = [future.result() for future in futures]
+    assert [text for text, html, title in results] == ['PAGE 0', 'PAGE 1', 'PAGE 2', 'PAGE 3']
+    assert results[0][1:] == ('page 0', 'title')
+    assert server.batches == [['page 0', 'page 1', 'page 2'], ['page 3']]
+
+
+def test_failed_pages_and_timeouts_fail_alone(server):
+    with extractor_for(server, timeout_seconds=0.3, batch_wait_seconds=0.5) as extractor:
+        futures = [extractor.submit('http://a.com/', html, 'text/html') for html in (b'a', b'slow', b'bad', b'b')]
+        wait(futures)
+    assert futures[0].result()[0] == 'A'
+    with pytest.raises(ExtractionFailed, match='timed out'):
+        futures[1].result()
+    with pytest.raises(ExtractionFailed, match='no text'):
+        futures[2].result()
+    assert futures[3].result()[0] == 'B'
+    # the pages after the one that timed out were sent again
+    assert server.batches == [['a', 'slow', 'bad', 'b'], ['bad', 'b']]
+
+
+@pytest.mark.parametrize('status', [502, 503, 504])
+def test_gateway_errors_are_retried(server, status):
+    server.statuses = [status, status]
+    with extractor_for(server) as extractor:
+        assert extractor.extract('http://a.com/', b'page', 'text/html')[0] == 'PAGE'
+    assert len(server.batches) == 3
+
+
+def test_gives_up_after_max_retries(server, monkeypatch):
+    sleeps = list()
+    monkeypatch.setattr(extraction.time, 'sleep', sleeps.append)
+    server.statuses = [502] * 3
+    with extractor_for(server, max_retries=2) as extractor:
+        with pytest.raises(ExtractionServerError, match='502 after 2 retries'):
+            extractor.extract('http://a.com/', b'page', 'text/html')
+    assert sleeps == [0, 0]
+
+
+def test_other_server_errors_are_not_retried(server):
+    server.statuses = [500]
+    with extractor_for(server) as extractor:
+        with pytest.raises(ExtractionServerError, match='500'):
+            extractor.extract('http://a.com/', b'page', 'text/html')
+    assert len(server.batches) == 1
+
+
+def test_unreachable_server_backs_off(monkeypatch):
+    sleeps = list()
+    monkeypatch.setattr(extraction.time, 'sleep', sleeps.append)
+    with RemoteExtractor('http://localhost:1', max_retries=3) as extractor:
+        with pytest.raises(ExtractionServerError, match='ConnectionError'):
+            extractor.extract('http://a.com/', b'page', 'text/html')
+    assert sleeps == [1, 2, 4]
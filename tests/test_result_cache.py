@@ -0,0 +1,45 @@
+from chromatic_news.html_to_fulltext_server.result_cache import (
+    DiskResultCache, ResultCache, document_key,
+)
+
+html = '<html><body><p>text</p></body></html>'
+
+
+def test_key_depends_on_url_and_version():
+    key = document_key('http://a.com/1', html, 'newspaper 0.2.8')
+    assert key == document_key('http://a.com/1', html.encode(), 'newspaper 0.2.8')
+    assert key != document_key('http://a.com/2', html, 'newspaper 0.2.8')
+    assert key != document_key('http://a.com/1', html, 'newspaper 0.2.9')
+    assert document_key(None, html) == document_key('', html)
+    # the parts don't run into each other
+    assert document_key('b', html, 'a') != document_key('', html, 'ab')
+
+
+def test_memory_cache_is_bounded_by_bytes():
+    cache = ResultCache(max_bytes=10)
+    cache.put('a', ('1234', '', ''))
+    cache.put('b', ('1234', '', ''))
+    assert cache.get('a') == ('1234', '', '')
+    # evicts the least recently used
+    cache.put('c', ('1234', '', ''))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    # too large to cache at all
+    cache.put('d', ('x' * 11, '', ''))
+    assert cache.get('d') is None
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['misses'], stats['memory_bytes']) == (3, 2, 8)
+
+
+def test_disk_cache_is_shared_and_bounded(tmp_path):
+    filepath = str(tmp_path / 'results.db')
+    ResultCache(100, disk=DiskResultCache(filepath, max_bytes=10)).put('a', ('1234', 'ti', ''))
+    cache = ResultCache(100, disk=DiskResultCache(filepath, max_bytes=10))
+    assert cache.get('a') == ('1234', 'ti', '')
+    assert cache.get('a') == ('1234', 'ti', '')
+    assert (cache.disk_hits, cache.memory_hits) == (1, 1)
+
+    cache.put('b', ('12345', '', ''))
+    # over max_bytes, so the oldest result was dropped
+    assert cache.disk.total_bytes == 5
+    assert cache.disk.get('a') is None
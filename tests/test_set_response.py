@@ -0,0 +1,65 @@
+import os
+from os.path import dirname
+
+import pytest
+
+repo_dir = dirname(dirname(os.path.abspath(__file__)))
+# download_newsletter_archives.py needs config.py
+if not os.path.exists(os.path.join(repo_dir, 'download_newsletter_archives', 'config.py')):
+    pytest.skip('needs download_newsletter_archives/config.py', allow_module_level=True)
+
+from chromatic_news.download_newsletter_archives.download_limits import SpooledContent
+from chromatic_news.download_newsletter_archives.download_newsletter_archives import (
+    Newsletter, empty_response,
+)
+from chromatic_news.download_newsletter_archives.fetcher import FetchedResponse
+
+page = b'<html><body><a href="http://a.com/article">a</a></body></html>'
+
+
+class Archive:
+    nlaid = 1
+
+
+def newsletter(resp):
+    return Newsletter('http://nl.com/1', Archive(), resp=resp)
+
+
+def response(status_code=200, content=page, **kwargs):
+    return FetchedResponse('http://nl.com/1', status_code, {'ETag': '"1"'}, content, **kwargs)
+
+
+def test_stores_the_page():
+    row = newsletter(response())
+    assert not row.page_failed
+    assert (row.status, row.url, row.etag) == (200, 'http://nl.com/1', '"1"')
+    assert row.full_html == page.decode()
+    assert row.extract_article_urls() == ['http://a.com/article']
+
+
+@pytest.mark.parametrize('resp', [
+    response(content=b'', rejected='content type video/mp4'),
+    response(content=SpooledContent('/nonexistent', 10 ** 8)),
+], ids=['rejected', 'spooled'])
+def test_bodies_that_are_no_page_are_not_stored(resp):
+    row = newsletter(resp)
+    assert not row.page_failed
+    assert row.status == 200 and row.etag is None
+    assert not row.has_full_html()
+    assert row.extract_article_urls() == []
+
+
+@pytest.mark.parametrize('resp', [empty_response, response(503, b'busy')], ids=['timeout', '503'])
+def test_failed_responses_are_not_stored(resp):
+    row = newsletter(resp)
+    assert row.page_failed
+    assert getattr(row, 'status', None) is None and not row.has_full_html()
+
+
+def test_a_stored_page_is_kept(monkeypatch):
+    row = newsletter(response())
+    row.set_response(response(content=b'', rejected='body over 10 bytes'))
+    assert row.full_html == page.decode()
+    monkeypatch.setattr(Newsletter, 'commit', classmethod(lambda cls, sess: None))
+    row.refresh(None, resp=response(503, b'busy'))
+    assert row.not_modified and row.full_html == page.decode()
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from chromatic_news.recommender.benchmark_similarity import recall, synthetic_rows, synthetic_store
+from chromatic_news.recommender.similarity_index import ExactIndex, IVFIndex
+
+n_features = 2 ** 14
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    return synthetic_store(str(tmp_path_factory.mktemp('vectors')), 2000, n_features, topics=10, seed=0)
+
+
+def query_rows(index, num_queries=50):
+    return index.matrix[np.random.RandomState(1).choice(len(index), num_queries, replace=False)]
+
+
+def exact_and_ivf(store, tmp_path, k, **kwargs):
+    exact = ExactIndex(store)
+    exact.update()
+    ivf = IVFIndex(store, directory=str(tmp_path / 'ivf'), **kwargs)
+    ivf.update()
+    queries = query_rows(exact)
+    return exact.search(queries, k)[0], ivf.search(queries, k)[0]
+
+
+def test_probing_every_list_is_exact(store, tmp_path):
+    exact, found = exact_and_ivf(store, tmp_path, 10, n_lists=8, n_probe=8)
+    assert (found == exact).all()
+
+
+def test_recall_of_a_few_probes(store, tmp_path):
+    exact, found = exact_and_ivf(store, tmp_path, 10, n_lists=16, n_probe=4)
+    assert recall(found, exact) >= 0.9
+
+
+def test_similar_to_leaves_out_the_query(store, tmp_path):
+    for index in (ExactIndex(store), IVFIndex(store, directory=str(tmp_path / 'ivf'), n_lists=8)):
+        index.update()
+        liked = [int(aid) for aid in index.aids[:2]]
+        similar = index.similar_to(liked, k=5)
+        assert len(similar) == 5
+        assert not set(liked) & {aid for aid, score in similar}
+        scores = [score for aid, score in similar]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_update_assigns_new_shards_without_training(tmp_path):
+    store = synthetic_store(str(tmp_path / 'vectors'), 500, n_features, topics=5, seed=0)
+    index = IVFIndex(store, n_lists=4)
+    index.update()
+    centroids = index.centroids.copy()
+    store.add_shard(np.arange(501, 601), *synthetic_rows(np.random.RandomState(2), 100, n_features, 5))
+    index.update()
+    assert len(index) == len(index.lists) == 600
+    assert index.meta['trained_on'] == 500
+    assert (index.centroids == centroids).all()
+    # a new index reads the lists that were saved
+    reloaded = IVFIndex(store, n_lists=4)
+    reloaded.update()
+    assert (reloaded.lists == index.lists).all()
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import Column, Integer, TEXT, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from chromatic_news.download_newsletter_archives.url_index import UrlIndex, normalize_url
+
+SABase = declarative_base()
+
+
+class Page(SABase):
+    __tablename__ = 'pages'
+    pid = Column(Integer, primary_key=True)
+    url = Column(TEXT)
+    discovery_url = Column(TEXT)
+
+
+@pytest.fixture
+def sess():
+    engine = create_engine('sqlite://')
+    SABase.metadata.create_all(engine)
+    sess = sessionmaker(bind=engine)()
+    yield sess
+    sess.close()
+
+
+def add_pages(sess, *urls):
+    for url, discovery_url in urls:
+        sess.add(Page(url=url, discovery_url=discovery_url))
+    sess.commit()
+
+
+def test_normalize_url():
+    assert normalize_url(' HTTP://Example.COM/A?b=1#top ') == 'http://example.com/A?b=1'
+
+
+def test_loads_the_urls_of_every_row(sess):
+    add_pages(sess, ('http://a.com/1', 'http://t.co/x'), ('http://a.com/2', None))
+    index = UrlIndex().load_from_db(sess, Page.pid, [Page.url, Page.discovery_url])
+    assert len(index) == 3
+    assert 'http://A.com/1#comments' in index
+    assert 'http://t.co/x' in index
+    assert 'http://a.com/3' not in index
+    index.add('http://a.com/3', None)
+    assert 'http://a.com/3' in index
+
+
+def test_only_loads_rows_above_the_high_water_mark(sess):
+    add_pages(sess, ('http://a.com/1', None))
+    index = UrlIndex().load_from_db(sess, Page.pid, [Page.url])
+    assert index.high_water == {'pages': 1}
+    # changed rows below the mark aren't read again
+    sess.query(Page).update({'url': 'http://a.com/changed'})
+    add_pages(sess, ('http://a.com/2', None))
+    index.load_from_db(sess, Page.pid, [Page.url])
+    assert index.high_water == {'pages': 2}
+    assert 'http://a.com/2' in index and 'http://a.com/changed' not in index
+
+
+def test_saved_index_resumes_where_it_stopped(sess, tmp_path):
+    filepath = str(tmp_path / 'pages.urlindex')
+    add_pages(sess, ('http://a.com/1', None))
+    index = UrlIndex(fingerprint='v1').load_from_db(sess, Page.pid, [Page.url])
+    index.add('http://a.com/added')
+    index.save(filepath)
+
+    loaded = UrlIndex.load(filepath, fingerprint='v1')
+    assert len(loaded) == 2 and 'http://a.com/added' in loaded
+    add_pages(sess, ('http://a.com/2', None))
+    loaded.load_from_db(sess, Page.pid, [Page.url])
+    assert 'http://a.com/2' in loaded and len(loaded) == 3
+
+
+def test_index_of_another_normalization_is_not_loaded(tmp_path):
+    filepath = str(tmp_path / 'pages.urlindex')
+    UrlIndex(fingerprint='v1').save(filepath)
+    assert UrlIndex.load(filepath, fingerprint='v2') is None
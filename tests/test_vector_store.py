@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from chromatic_news.recommender.similarity_index import ExactIndex
+from chromatic_news.recommender.vector_store import VectorStore
+
+n_features = 8
+
+
+def rows(*counts):
+    """(indptr, indices, data) of rows given as {feature: weight}
+    """
+    matrix = scipy.sparse.csr_matrix(
+        [[row.get(feature, 0) for feature in range(n_features)] for row in counts],
+        dtype=np.float32,
+    )
+    return matrix.indptr, matrix.indices, matrix.data
+
+
+def test_empty_store(tmp_path):
+    store = VectorStore(str(tmp_path / 'vectors'), n_features=n_features)
+    assert store.last_aid is None
+    assert len(store.aids()) == 0
+    assert store.tfidf().shape == (0, n_features)
+
+
+def test_add_shard(tmp_path):
+    store = VectorStore(str(tmp_path), n_features=n_features)
+    store.add_shard(np.array([1, 2]), *rows({0: 1, 1: 1}, {1: 2}), new_tokens={'a': 0, 'b': 1})
+    store.add_shard(np.array([5]), *rows({2: 1}), new_tokens={'c': 2})
+    assert store.meta['shards'] == ['00001', '00002']
+    assert store.num_articles == 3 and store.last_aid == 5
+    assert store.document_frequencies().tolist()[:3] == [1, 2, 1]
+    # only the current df file is kept
+    assert sorted(path.name for path in tmp_path.glob('df-*')) == ['df-00002.npy']
+
+    reopened = VectorStore(str(tmp_path))
+    assert reopened.n_features == n_features
+    assert reopened.aids().tolist() == [1, 2, 5]
+    assert reopened.vocabulary() == {'a': 0, 'b': 1, 'c': 2}
+
+
+def test_tfidf(tmp_path):
+    store = VectorStore(str(tmp_path), n_features=n_features)
+    store.add_shard(np.array([1, 2, 3]), *rows({0: 1, 1: 1}, {1: 1}, {1: 1, 2: 1}))
+    matrix = store.tfidf().toarray()
+    assert np.allclose(np.linalg.norm(matrix, axis=1), 1)
+    # smoothed idf: log((1 + 3) / (1 + df)) + 1
+    idf = np.log(4 / np.array([2, 4, 2])) + 1
+    assert np.allclose(matrix[0, :3], idf * [1, 1, 0] / np.linalg.norm(idf * [1, 1, 0]))
+    # a feature in every article weighs least
+    assert matrix[2, 1] < matrix[2, 2]
+
+
+def test_killed_shard_is_replaced(tmp_path):
+    store = VectorStore(str(tmp_path), n_features=n_features)
+    store.add_shard(np.array([1]), *rows({0: 1}))
+    # a shard whose meta.json was never written
+    (tmp_path / '00002').mkdir()
+    (tmp_path / '00002' / 'aids.npy').write_bytes(b'garbage')
+    store = VectorStore(str(tmp_path))
+    store.add_shard(np.array([2]), *rows({1: 1}))
+    assert store.aids().tolist() == [1, 2]
+    with open(tmp_path / 'meta.json') as fr:
+        assert json.load(fr)['last_aid'] == 2
+
+
+def test_articles_committed_late_are_found(tmp_path):
+    store = VectorStore(str(tmp_path), n_features=n_features)
+    store.add_shard(np.array([1, 3]), *rows({0: 1}, {1: 1}))
+    store.add_shard(np.array([2, 4]), *rows({2: 1}, {3: 1}))
+    assert store.last_aid == 4
+    assert store.aids().tolist() == [1, 3, 2, 4]
+    index = ExactIndex(store)
+    for aid, feature in [(1, 0), (2, 2), (3, 1), (4, 3)]:
+        assert index.vectors([aid]).toarray()[0, feature] == pytest.approx(1)
+    with pytest.raises(KeyError):
+        index.rows_of([5])
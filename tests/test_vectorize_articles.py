@@ -0,0 +1,74 @@
+import os
+from os.path import dirname
+
+import numpy as np
+import pytest
+
+repo_dir = dirname(dirname(os.path.abspath(__file__)))
+# vectorize_articles.py imports download_newsletter_archives.py, which
+# needs config.py
+if not os.path.exists(os.path.join(repo_dir, 'download_newsletter_archives', 'config.py')):
+    pytest.skip('needs download_newsletter_archives/config.py', allow_module_level=True)
+
+from chromatic_news.recommender import vectorize_articles
+from chromatic_news.recommender.vector_store import VectorStore
+from chromatic_news.recommender.vectorize_articles import (
+    HashingVectorizer, ShardWriter, rescan_window, vectorize,
+)
+
+
+class Row:
+    def __init__(self, aid, text):
+        self.aid = aid
+        self._full_text = text
+        self.full_text_hash = None
+
+
+class NoBlobs:
+    def get_texts(self, keys):
+        return dict()
+
+
+def test_counts_are_hashed_into_features():
+    vectorizer = HashingVectorizer(16)
+    features, weights = vectorizer.counts('The cat saw the other cat, a cat')
+    assert features == sorted(features)
+    assert sorted(vectorizer.new_tokens) == ['cat', 'other', 'saw', 'the']
+    weight_of = dict(zip(features, weights))
+    assert weight_of[vectorizer.vocabulary['cat']] >= 1 + np.log(3)
+
+
+def test_shards_by_size_and_time(tmp_path, monkeypatch):
+    store = VectorStore(str(tmp_path), n_features=64)
+    writer = ShardWriter(store, HashingVectorizer(64), shard_size=2, shard_seconds=60)
+    writer.add(1, 'one text')
+    assert store.num_articles == 0
+    writer.add(2, 'two texts')
+    assert store.meta['shards'] == ['00001']
+
+    now = [1000.0]
+    monkeypatch.setattr(vectorize_articles.time, 'time', lambda: now[0])
+    writer = ShardWriter(store, HashingVectorizer(64, store.vocabulary()), shard_size=100, shard_seconds=60)
+    writer.add(3, 'three')
+    now[0] += 61
+    writer.add(4, 'four')
+    assert store.aids().tolist() == [1, 2, 3, 4]
+    assert len(store.meta['shards']) == 2
+    writer.flush()
+    assert len(store.meta['shards']) == 2
+
+
+def test_articles_committed_late_are_vectorized_once(tmp_path):
+    store = VectorStore(str(tmp_path), n_features=64)
+    assert rescan_window(store, 10) == (None, set())
+    writer = ShardWriter(store, HashingVectorizer(64), shard_size=100)
+    vectorize([[Row(1, 'a text'), Row(3, 'other text'), Row(5, 'more text')]], NoBlobs(), writer)
+    assert store.last_aid == 5
+
+    # aid 4 was committed after aid 5
+    start_after, stored = rescan_window(store, 3)
+    assert (start_after, stored) == (2, {3, 5})
+    rows = [Row(3, 'other text'), Row(4, 'late text'), Row(5, 'more text'), Row(6, 'new text')]
+    assert vectorize([rows], NoBlobs(), writer, skip=stored) == 2
+    assert store.aids().tolist() == [1, 3, 5, 4, 6]
+    assert rescan_window(store, 100) == (0, {1, 3, 4, 5, 6})
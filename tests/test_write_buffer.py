@@ -0,0 +1,93 @@
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, TEXT, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from chromatic_news.dbutils import Base, WriteBuffer, pkey
+
+SABase = declarative_base()
+
+
+class Parent(SABase, Base):
+    __tablename__ = 'parents'
+    pid = pkey('pid')
+    name = Column(TEXT)
+
+
+class Child(SABase, Base):
+    __tablename__ = 'children'
+    cid = pkey('cid')
+    pid = Column(Integer, ForeignKey('parents.pid'))
+    url = Column(TEXT)
+    status = Column(Integer, default=200)
+
+
+@pytest.fixture
+def sess():
+    engine = create_engine('sqlite://')
+    SABase.metadata.create_all(engine)
+    sess = sessionmaker(bind=engine)()
+    yield sess
+    sess.close()
+
+
+def child(url, parent=None):
+    row = Child()
+    row.url = url
+    if parent is not None:
+        row.pid = parent.pid
+    return row
+
+
+def test_flushes_a_full_batch(sess):
+    buffer = WriteBuffer(sess, batch_size=3, flush_interval_seconds=3600)
+    for i in range(2):
+        buffer.add(child('http://a.com/{}'.format(i)))
+    assert len(buffer) == 2
+    assert sess.query(Child).count() == 0
+    buffer.add(child('http://a.com/2'))
+    assert len(buffer) == 0
+    rows = sess.query(Child).order_by(Child.cid).all()
+    assert [row.url for row in rows] == ['http://a.com/{}'.format(i) for i in range(3)]
+    # column defaults are applied to buffered rows too
+    assert all(row.status == 200 and row.created_at is not None for row in rows)
+
+
+def test_flushes_after_the_interval(sess):
+    buffer = WriteBuffer(sess, batch_size=100, flush_interval_seconds=0)
+    buffer.add(child('http://a.com/'))
+    assert len(buffer) == 0
+    assert sess.query(Child).count() == 1
+
+
+def test_rows_are_found_by_their_keys_until_flushed(sess):
+    buffer = WriteBuffer(sess, batch_size=100, flush_interval_seconds=3600)
+    row = child('http://a.com/?utm_source=x')
+    buffer.add(row, keys=(row.url, 'http://a.com/', None))
+    assert buffer.find(Child, 'http://a.com/') is row
+    assert buffer.find(Child, row.url) is row
+    assert buffer.find(Parent, row.url) is None
+    assert buffer.find(Child, None) is None
+    buffer.flush()
+    assert buffer.find(Child, row.url) is None
+    assert sess.query(Child).filter(Child.url == row.url).count() == 1
+
+
+def test_rows_of_the_session_are_committed_first(sess):
+    buffer = WriteBuffer(sess, batch_size=100, flush_interval_seconds=3600)
+    parent = Parent()
+    parent.name = 'archive'
+    sess.add(parent)
+    sess.flush()
+    buffer.add(child('http://a.com/', parent))
+    buffer.flush()
+    sess.rollback()
+    assert sess.query(Parent).one().name == 'archive'
+    assert sess.query(Child).one().pid == parent.pid
+
+
+def test_large_batches_are_chunked_on_sqlite(sess):
+    buffer = WriteBuffer(sess, batch_size=1000, flush_interval_seconds=3600)
+    for i in range(999):
+        buffer.add(child('http://a.com/{}'.format(i)))
+    buffer.flush()
+    assert sess.query(Child).count() == 999